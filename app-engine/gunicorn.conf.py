@@ -0,0 +1,13 @@
+# app-engine/gunicorn.conf.py
+
+import os
+
+bind = f":{os.environ.get('PORT', '8080')}"
+workers = int(os.environ.get('GUNICORN_WORKERS', '1'))
+threads = int(os.environ.get('GUNICORN_THREADS', '8'))
+timeout = 120
+
+def post_worker_init(worker):
+    """ワーカー起動直後にモデル・商品カタログのウォームアップを開始"""
+    from main import start_warm_up
+    start_warm_up()
@@ -1,15 +1,23 @@
 # app-engine/main.py
 
+import time
+_MODULE_IMPORT_STARTED = time.perf_counter()
+
 import os
 import logging
-from flask import Flask, request, jsonify
-from google.cloud import storage
-from google.cloud import bigquery
-import joblib
+from flask import Flask, request, jsonify, g, has_request_context
+import base64
+import hashlib
 import json
+import numpy as np
+from scipy import sparse
 from datetime import datetime, timezone
 import tempfile
-from functools import lru_cache
+import threading
+import shutil
+from collections import OrderedDict
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
 import traceback
 
 # ログ設定
@@ -23,61 +31,928 @@ app = Flask(__name__)
 PROJECT_ID = "test-recommend-engine-20250609"
 DATASET_ID = "recommend_data"
 BUCKET_NAME = f"{PROJECT_ID}-data-lake"
-MODEL_PATH = "models/recommend_model.pkl"
+MODEL_PREFIX = "models/recommend_model"
+MODEL_POINTER_PATH = f"{MODEL_PREFIX}/LATEST.json"
+MODEL_FORMAT_VERSION = 1
+# モデル配列のローカル保存先（同一インスタンスのワーカー間でページを共有）
+MODEL_CACHE_DIR = os.environ.get('MODEL_CACHE_DIR', os.path.join(tempfile.gettempdir(), 'recommend_model'))
+
+# モデル更新のポーリング間隔と失敗時のリトライ間隔（秒）
+MODEL_REFRESH_INTERVAL_SECONDS = float(os.environ.get('MODEL_REFRESH_INTERVAL_SECONDS', '60'))
+MODEL_RETRY_INITIAL_SECONDS = 5.0
+MODEL_RETRY_MAX_SECONDS = 600.0
+# ローカルに残すモデルバージョン数
+MODEL_CACHE_KEEP_VERSIONS = 2
+
+# 事前計算レコメンドの有効期限（時間）。これより古い場合はリアルタイム計算
+PRECOMPUTED_MAX_AGE_HOURS = float(os.environ.get('PRECOMPUTED_MAX_AGE_HOURS', '48'))
+
+# 類似ユーザー検索方式（ivf: 近似インデックス / exact: 全件走査）
+SIMILARITY_SEARCH = os.environ.get('SIMILARITY_SEARCH', 'ivf')
+# IVF検索で走査するクラスタ数（未指定時はモデルの既定値）
+ANN_N_PROBE = int(os.environ['ANN_N_PROBE']) if os.environ.get('ANN_N_PROBE') else None
+N_NEIGHBORS = 10
+
+# ページング用ランキング（ユーザーごとの上位 RANKING_MAX_ITEMS 件）のキャッシュ設定。
+# カーソルは計算時のモデルバージョンに紐づき、モデル差し替え後もキャッシュ内のランキングで応答する
+RANKING_MAX_ITEMS = int(os.environ.get('RANKING_MAX_ITEMS', '500'))
+RANKING_CACHE_TTL_SECONDS = float(os.environ.get('RANKING_CACHE_TTL_SECONDS', '1800'))
+RANKING_CACHE_SIZE = int(os.environ.get('RANKING_CACHE_SIZE', '2000'))
+
+# /recommend・/popular の exclude に指定できる商品数の上限
+EXCLUDE_MAX_ITEMS = 100
+
+# バッチレコメンド設定
+BATCH_MAX_USERS = 5000
+BATCH_BLOCK_SIZE = 256
+# 類似ユーザー検索で一度に類似度を計算するユーザー数（一時メモリは ブロック × この値）
+SIMILARITY_CHUNK_SIZE = 16384
+
+# 商品カタログの再読み込み間隔と、存在しない商品IDの再問い合わせ抑止時間（秒）
+CATALOG_TTL_SECONDS = float(os.environ.get('CATALOG_TTL_SECONDS', '3600'))
+CATALOG_NEGATIVE_TTL_SECONDS = float(os.environ.get('CATALOG_NEGATIVE_TTL_SECONDS', '300'))
+CATALOG_RETRY_SECONDS = 60.0
+
+# 新規ユーザーのセグメント判定に使う users テーブルスナップショットの再読み込み間隔（秒）
+USER_SNAPSHOT_TTL_SECONDS = float(os.environ.get('USER_SNAPSHOT_TTL_SECONDS', '3600'))
+USER_SNAPSHOT_RETRY_SECONDS = 60.0
+
+# BigQueryクエリ実行用スレッド数と、ユーザープロファイルのキャッシュ設定
+QUERY_POOL_WORKERS = int(os.environ.get('QUERY_POOL_WORKERS', '8'))
+USER_PROFILE_CACHE_TTL_SECONDS = float(os.environ.get('USER_PROFILE_CACHE_TTL_SECONDS', '60'))
+USER_PROFILE_CACHE_SIZE = 1000
+
+# /recommend のレスポンスキャッシュ設定
+RECOMMEND_CACHE_TTL_SECONDS = float(os.environ.get('RECOMMEND_CACHE_TTL_SECONDS', '60'))
+RECOMMEND_CACHE_SIZE = int(os.environ.get('RECOMMEND_CACHE_SIZE', '10000'))
+
+# 以下のスコアリング関数は vertex-ai/training/trainer.py と同じ実装（tests/test_scoring_parity.py で一致を検証）
+def top_n_items(item_scores, candidates, n):
+    """行ごとに候補アイテムの上位n件を取得
+
+    Args:
+        item_scores: (行数 × アイテム数) のスコア配列
+        candidates: item_scores と同形状の候補マスク
+        n: 取得件数
+
+    Returns:
+        (items, scores): items はアイテムインデックス（候補不足分は -1）、
+        scores は対応するスコア（候補不足分は NaN）
+    """
+    n_rows, n_items = item_scores.shape
+    n = min(n, n_items)
+    if n <= 0:
+        return (np.empty((n_rows, 0), dtype=np.int32),
+                np.empty((n_rows, 0), dtype=np.float32))
+    
+    masked = np.where(candidates, item_scores, -np.inf)
+    top = np.argpartition(-masked, n - 1, axis=1)[:, :n]
+    top_scores = np.take_along_axis(masked, top, axis=1)
+    order = np.argsort(-top_scores, axis=1, kind='stable')
+    top = np.take_along_axis(top, order, axis=1).astype(np.int32)
+    top_scores = np.take_along_axis(top_scores, order, axis=1).astype(np.float32)
+    
+    valid = np.isfinite(top_scores)
+    top[~valid] = -1
+    top_scores[~valid] = np.nan
+    return top, top_scores
+
+def normalize_rows(features):
+    """行ベクトルをL2正規化（ゼロベクトルはそのまま）"""
+    norms = np.linalg.norm(features, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return (features / norms).astype(np.float32)
+
+def search_similar_users_exact(query, normalized_features, k, exclude=None):
+    """全ユーザーとの内積による類似ユーザー検索（厳密）
+
+    Returns:
+        (neighbors, similarities): 類似度の降順
+    """
+    similarities = normalized_features @ query
+    if exclude is not None:
+        similarities[exclude] = -np.inf
+    k = min(k, len(similarities) - (exclude is not None))
+    if k <= 0:
+        return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float32)
+    
+    top = np.argpartition(-similarities, k - 1)[:k]
+    top = top[np.argsort(-similarities[top], kind='stable')]
+    return top, similarities[top]
+
+def search_similar_users_ivf(query, normalized_features, ann_index, k, n_probe, exclude=None):
+    """IVFインデックスによる類似ユーザー検索（近似）
+
+    クエリに近い n_probe 個のクラスタに属するユーザーのみを走査する。
+    n_probe を大きくするほど再現率が上がり、レイテンシも増える。
+    """
+    centroids = ann_index['centroids']
+    offsets = ann_index['list_offsets']
+    members = ann_index['list_members']
+    
+    n_probe = min(n_probe, len(centroids))
+    centroid_scores = centroids @ query
+    probe = np.argpartition(-centroid_scores, n_probe - 1)[:n_probe]
+    candidates = np.concatenate([members[offsets[c]:offsets[c + 1]] for c in probe])
+    if exclude is not None:
+        candidates = candidates[candidates != exclude]
+    
+    k = min(k, len(candidates))
+    if k <= 0:
+        return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float32)
+    
+    similarities = normalized_features[candidates] @ query
+    top = np.argpartition(-similarities, k - 1)[:k]
+    top = top[np.argsort(-similarities[top], kind='stable')]
+    return candidates[top].astype(np.int64), similarities[top]
+
+def top_similar_users_block(normalized_features, user_idxs, k, chunk_size=SIMILARITY_CHUNK_SIZE):
+    """ブロック内の各ユーザーについて類似ユーザー上位k人を厳密に検索（自分自身は除外）
+
+    全ユーザーを chunk_size 人ずつに分けて類似度を計算し、上位k人を逐次更新するため、
+    一時メモリは (ブロック × chunk_size) に収まる。k は ユーザー数 - 1 以下であること。
+
+    Returns:
+        (neighbors, similarities): いずれも (ブロック × k)、行内の順序は不定
+    """
+    user_idxs = np.asarray(user_idxs)
+    queries = normalized_features[user_idxs]
+    n_block = len(user_idxs)
+    best_idx = np.empty((n_block, 0), dtype=np.int64)
+    best_sim = np.empty((n_block, 0), dtype=np.float32)
+    for start in range(0, len(normalized_features), chunk_size):
+        similarities = queries @ normalized_features[start:start + chunk_size].T
+        own = np.flatnonzero((user_idxs >= start) & (user_idxs < start + similarities.shape[1]))
+        similarities[own, user_idxs[own] - start] = -np.inf
+        
+        chunk_idx = np.broadcast_to(np.arange(similarities.shape[1]), similarities.shape)
+        if similarities.shape[1] > k:
+            chunk_idx = np.argpartition(-similarities, k - 1, axis=1)[:, :k]
+            similarities = np.take_along_axis(similarities, chunk_idx, axis=1)
+        
+        merged_sim = np.concatenate([best_sim, similarities], axis=1)
+        merged_idx = np.concatenate([best_idx, chunk_idx + start], axis=1)
+        if merged_sim.shape[1] > k:
+            top = np.argpartition(-merged_sim, k - 1, axis=1)[:, :k]
+            merged_sim = np.take_along_axis(merged_sim, top, axis=1)
+            merged_idx = np.take_along_axis(merged_idx, top, axis=1)
+        best_sim, best_idx = merged_sim, merged_idx
+    return best_idx, best_sim
+
+def score_user_block(normalized_features, user_item_matrix, user_idxs, n_recommendations,
+                     n_neighbors=N_NEIGHBORS, item_filter=None):
+    """複数ユーザーのレコメンドを行列演算でまとめて計算
+
+    類似ユーザーは top_similar_users_block（全ユーザーをチャンクに分けた厳密検索）、
+    類似ユーザーの購入行の集計は近傍重み疎行列 × 購入行列の疎行列積で求める。
+
+    Returns:
+        (items, scores): top_n_items と同形式
+    """
+    n_users, n_items = user_item_matrix.shape
+    n_block = len(user_idxs)
+    rows = np.arange(n_block)
+    n_neighbors = min(n_neighbors, n_users - 1)
+    if n_neighbors <= 0:
+        return top_n_items(np.zeros((n_block, n_items)), np.zeros((n_block, n_items), dtype=bool),
+                           n_recommendations)
+    
+    with timed_stage('similarity_search'):
+        # 類似ユーザー（上位 n_neighbors 人）を重みとする疎行列
+        neighbors, weights = top_similar_users_block(normalized_features, user_idxs, n_neighbors)
+        neighbor_matrix = sparse.csr_matrix(
+            (weights.ravel(), neighbors.ravel(), np.arange(0, n_block * n_neighbors + 1, n_neighbors)),
+            shape=(n_block, n_users)
+        )
+    
+    with timed_stage('neighbor_aggregation'):
+        # 類似度 × 購入行列（疎行列積）
+        item_scores = (neighbor_matrix @ user_item_matrix).toarray()
+        
+        # 類似ユーザーが購入済み かつ 本人が未購入のアイテムのみ候補
+        # （購入スコアは正値のため、|重み| との積の非ゼロ構造が到達アイテムになる）
+        reached = abs(neighbor_matrix) @ user_item_matrix
+        candidates = np.zeros((n_block, n_items), dtype=bool)
+        candidates[np.repeat(rows, np.diff(reached.indptr)), reached.indices] = True
+        purchased = user_item_matrix[user_idxs]
+        candidates[np.repeat(rows, np.diff(purchased.indptr)), purchased.indices] = False
+        if item_filter is not None:
+            candidates &= item_filter
+        
+        return top_n_items(item_scores, candidates, n_recommendations)
+
+def score_items_by_similarity(user_item_matrix, item_similarity, user_idxs, n_recommendations,
+                              item_filter=None):
+    """購入アイテムの類似アイテム行を合計してスコアリング（アイテムベース）
+
+    購入行 × アイテム類似度行列の疎行列積のため、1ユーザーあたり
+    O(購入アイテム数 × 近傍数) で済む。候補は類似アイテムに到達した未購入アイテム
+    （item_filter 指定時はさらにマスクが真のもの）のみ。
+
+    Returns:
+        (items, scores): top_n_items と同形式
+    """
+    n_block = len(user_idxs)
+    n = min(n_recommendations, item_similarity.shape[1])
+    items = np.full((n_block, n), -1, dtype=np.int32)
+    scores = np.full((n_block, n), np.nan, dtype=np.float32)
+    
+    purchased = user_item_matrix[user_idxs]
+    item_scores = (purchased @ item_similarity).tocsr()
+    
+    for row in range(n_block):
+        start, stop = item_scores.indptr[row], item_scores.indptr[row + 1]
+        candidates = item_scores.indices[start:stop]
+        row_scores = item_scores.data[start:stop]
+        bought = purchased.indices[purchased.indptr[row]:purchased.indptr[row + 1]]
+        keep = ~np.isin(candidates, bought)
+        if item_filter is not None:
+            keep &= item_filter[candidates]
+        candidates, row_scores = candidates[keep], row_scores[keep]
+        
+        k = min(n, len(candidates))
+        if k == 0:
+            continue
+        top = np.argpartition(-row_scores, k - 1)[:k]
+        top = top[np.argsort(-row_scores[top], kind='stable')]
+        items[row, :k] = candidates[top]
+        scores[row, :k] = row_scores[top]
+    
+    return items, scores
+
+def score_user_factors(user_factors, item_factors, user_item_matrix, user_idxs, n_recommendations,
+                       item_filter=None):
+    """ユーザー因子とアイテム因子の内積でスコアリング（ALS）
+
+    アイテムごとに1回の内積で済み、本人の未購入アイテム（item_filter 指定時は
+    さらにマスクが真のもの）すべてが候補になる。
+
+    Returns:
+        (items, scores): top_n_items と同形式
+    """
+    n_block = len(user_idxs)
+    item_scores = user_factors[user_idxs] @ item_factors.T
+    candidates = np.ones(item_scores.shape, dtype=bool)
+    purchased = user_item_matrix[user_idxs]
+    candidates[np.repeat(np.arange(n_block), np.diff(purchased.indptr)), purchased.indices] = False
+    if item_filter is not None:
+        candidates &= item_filter
+    return top_n_items(item_scores, candidates, n_recommendations)
+
+def segment_value(value):
+    """セグメントキー用の属性値（欠損は 'unknown'）"""
+    if value is None or (isinstance(value, float) and np.isnan(value)):
+        return 'unknown'
+    return str(value).strip().lower()
+
+def segment_keys(age, gender, city, age_edges):
+    """ユーザー属性のセグメントキー（細かい順: 年代×性別×都市 → 年代×性別 → 年代）
+
+    トレーナーの segment_keys と同じ規則でキーを作る
+    """
+    if age is None or np.isnan(float(age)):
+        bucket = 'unknown'
+    else:
+        bucket = str(int(np.searchsorted(age_edges, float(age), side='right')))
+    gender = segment_value(gender)
+    city = segment_value(city)
+    return [f"{bucket}|{gender}|{city}", f"{bucket}|{gender}", bucket]
+
+def build_item_filter(model, filters):
+    """業務ルール（カテゴリ・価格帯・除外商品）による候補アイテムのマスク
+
+    Args:
+        filters: category / min_price / max_price / exclude を持つ dict
+
+    Returns:
+        アイテムインデックス順の bool 配列（条件がない場合は None）。
+        カテゴリ・価格が不明なアイテムは該当する条件を指定した場合に除外される
+    """
+    if not filters or (filters.get('category') is None and filters.get('min_price') is None
+                       and filters.get('max_price') is None and not filters.get('exclude')):
+        return None
+    
+    n_items = len(model['item_ids'])
+    mask = np.ones(n_items, dtype=bool)
+    
+    category = filters.get('category')
+    if category is not None:
+        code = model['category_index'].get(category)
+        if code is None:
+            mask[:] = False
+        elif model.get('category_bitsets') is not None:
+            mask &= np.unpackbits(model['category_bitsets'][code], count=n_items).astype(bool)
+        else:
+            mask &= np.asarray(model['item_category_codes']) == code
+    
+    min_price, max_price = filters.get('min_price'), filters.get('max_price')
+    if min_price is not None or max_price is not None:
+        prices = model.get('item_prices')
+        if prices is None:
+            mask[:] = False
+        else:
+            if min_price is not None:
+                mask &= prices >= min_price
+            if max_price is not None:
+                mask &= prices <= max_price
+    
+    exclude = filters.get('exclude')
+    if exclude:
+        ids = np.asarray(exclude, dtype=np.int64)
+        positions = np.minimum(np.searchsorted(model['item_ids'], ids), n_items - 1)
+        hit = model['item_ids'][positions] == ids
+        mask[positions[hit]] = False
+    
+    return mask
 
-# グローバル変数
-model = None
-product_cache = {}
+def select_ranked(items, scores, n, item_filter=None):
+    """事前計算済みランキング（不足分 -1）から条件に合う上位n件を選択
+
+    ランキングが打ち切られていて（-1 がない）条件に合う件数が n に満たない場合は、
+    圏外に該当アイテムがある可能性があるため None を返す。
+    """
+    valid = items >= 0
+    keep = valid
+    if item_filter is not None:
+        keep = valid & item_filter[np.where(valid, items, 0)]
+    selected = np.flatnonzero(keep)[:n]
+    if len(selected) < n and valid.all():
+        return None
+    return items[selected], scores[selected]
+
+def build_popularity_ranking(scores, order, category_codes, categories):
+    """人気ランキング（全体・カテゴリ別）を作成
+
+    カテゴリ別ランキングは全体ランキングをカテゴリ番号で安定ソートして
+    グループ化したもので、各カテゴリ内は人気順のまま保たれる。
+    """
+    ranking = {'scores': scores, 'order': order, 'by_category': {}}
+    if category_codes is None or not categories:
+        return ranking
+    
+    ranked_codes = np.asarray(category_codes)[order]
+    grouped = order[np.argsort(ranked_codes, kind='stable')]
+    # カテゴリ不明（-1）を先頭グループとして数える
+    counts = np.bincount(ranked_codes + 1, minlength=len(categories) + 1)
+    offsets = np.concatenate([[0], np.cumsum(counts)])
+    for code, category in enumerate(categories):
+        ranking['by_category'][category] = grouped[offsets[code + 1]:offsets[code + 2]]
+    return ranking
+
+class TTLCache:
+    """スレッドセーフなLRU + TTLキャッシュ"""
+    
+    def __init__(self, maxsize, ttl_seconds):
+        self.maxsize = maxsize
+        self.ttl_seconds = ttl_seconds
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+    
+    def get(self, key, default=None, accept=None):
+        """有効期限内の値を取得（なければ default）
+
+        accept を指定した場合、accept(値) が偽の値はミスとして扱う
+        """
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None or entry[0] <= time.monotonic():
+                if entry is not None:
+                    del self._data[key]
+                self.misses += 1
+                return default
+            if accept is not None and not accept(entry[1]):
+                self.misses += 1
+                return default
+            self._data.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+    
+    def set(self, key, value):
+        """値を格納（上限を超えた分は古い順に破棄）"""
+        with self._lock:
+            self._data[key] = (time.monotonic() + self.ttl_seconds, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+    
+    def clear(self):
+        """全エントリを削除"""
+        with self._lock:
+            self._data.clear()
+    
+    def stats(self):
+        """ヒット率などの統計"""
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                'size': len(self._data),
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': round(self.hits / total, 4) if total else 0.0
+            }
+
+class SingleFlight:
+    """同一キーの同時実行を1回にまとめる
+
+    最初の呼び出し（リーダー）だけが関数を実行し、実行中に同じキーで
+    呼び出したスレッドはその完了を待って同じ結果（または例外）を受け取る。
+    """
+    
+    def __init__(self):
+        self._calls = {}
+        self._lock = threading.Lock()
+    
+    def do(self, key, func):
+        """func を実行、または実行中の同一キーの結果を待つ
+
+        Returns:
+            (result, shared): shared は他の呼び出しの結果を受け取った場合 True
+        """
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = {'done': threading.Event(), 'result': None, 'error': None}
+        
+        if not leader:
+            call['done'].wait()
+            if call['error'] is not None:
+                raise call['error']
+            return call['result'], True
+        
+        try:
+            call['result'] = func()
+        except Exception as e:
+            call['error'] = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call['done'].set()
+        return call['result'], False
+
+# /recommend のレスポンスキャッシュ
+# キー: (user_id, include_product_info, モデルバージョン) / 値: (計算件数, レコメンドリスト)
+# 大きい件数で計算済みのリストは、小さい件数の要求に先頭スライスで応答できる
+recommendation_cache = TTLCache(RECOMMEND_CACHE_SIZE, RECOMMEND_CACHE_TTL_SECONDS)
+# 同一ユーザー・同一条件で実行中の /recommend 計算の合流
+recommendation_flight = SingleFlight()
+
+# ページング用ランキングのキャッシュ
+# キー: (user_id, モデルバージョン, 絞り込み条件) / 値: item_ids（モデルの配列）・items（int32）・scores（float32）
+# モデル差し替え時もクリアしない（古いバージョンのカーソルはTTLの間だけ有効）
+ranking_cache = TTLCache(RANKING_CACHE_SIZE, RANKING_CACHE_TTL_SECONDS)
+
+class Metrics:
+    """プロセス内のレイテンシヒストグラムとカウンタ（Prometheusテキスト形式で出力）"""
+    
+    BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+    
+    def __init__(self):
+        self._histograms = {}
+        self._counters = {}
+        self._lock = threading.Lock()
+    
+    def observe(self, name, labels, seconds):
+        """ヒストグラムに観測値を追加"""
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = {'buckets': [0] * len(self.BUCKETS), 'sum': 0.0, 'count': 0}
+            for i, bound in enumerate(self.BUCKETS):
+                if seconds <= bound:
+                    histogram['buckets'][i] += 1
+            histogram['sum'] += seconds
+            histogram['count'] += 1
+    
+    def inc(self, name, labels=None, value=1):
+        """カウンタを加算"""
+        key = (name, tuple(sorted((labels or {}).items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+    
+    @staticmethod
+    def _format_labels(labels, extra=()):
+        pairs = list(labels) + list(extra)
+        if not pairs:
+            return ''
+        escaped = (str(v).replace('\\', '\\\\').replace('"', '\\"') for _, v in pairs)
+        return '{' + ','.join(f'{k}="{v}"' for (k, _), v in zip(pairs, escaped)) + '}'
+    
+    def render(self, gauges=(), counters=()):
+        """Prometheusテキスト形式で出力
+
+        Args:
+            gauges: (名前, ラベルdict, 値) のリスト
+            counters: 他で集計している単調増加値の (名前, ラベルdict, 値) のリスト
+        """
+        with self._lock:
+            histograms = {key: {'buckets': list(h['buckets']), 'sum': h['sum'], 'count': h['count']}
+                          for key, h in self._histograms.items()}
+            counters = {**self._counters, **{
+                (name, tuple(sorted(labels.items()))): value for name, labels, value in counters
+            }}
+        
+        lines = []
+        typed = set()
+        for (name, labels), histogram in sorted(histograms.items()):
+            if name not in typed:
+                lines.append(f'# TYPE {name} histogram')
+                typed.add(name)
+            for bound, count in zip(self.BUCKETS, histogram['buckets']):
+                lines.append(f'{name}_bucket{self._format_labels(labels, [("le", bound)])} {count}')
+            lines.append(f'{name}_bucket{self._format_labels(labels, [("le", "+Inf")])} {histogram["count"]}')
+            lines.append(f'{name}_sum{self._format_labels(labels)} {histogram["sum"]:.6f}')
+            lines.append(f'{name}_count{self._format_labels(labels)} {histogram["count"]}')
+        for (name, labels), value in sorted(counters.items()):
+            if name not in typed:
+                lines.append(f'# TYPE {name} counter')
+                typed.add(name)
+            lines.append(f'{name}{self._format_labels(labels)} {value}')
+        # 同名メトリクスの行はまとめて出力する
+        for name, labels, value in sorted(gauges, key=lambda gauge: gauge[0]):
+            if name not in typed:
+                lines.append(f'# TYPE {name} gauge')
+                typed.add(name)
+            lines.append(f'{name}{self._format_labels(sorted(labels.items()))} {value}')
+        return '\n'.join(lines) + '\n'
+
+metrics = Metrics()
+
+@contextmanager
+def timed_stage(stage):
+    """処理段階のレイテンシを計測
+
+    ヒストグラム recommend_stage_latency_seconds に記録し、リクエスト中であれば
+    Server-Timing ヘッダ用に段階ごとの所要時間を保持する。
+    """
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - started
+        metrics.observe('recommend_stage_latency_seconds', {'stage': stage}, elapsed)
+        if has_request_context():
+            stages = g.setdefault('stage_timings', {})
+            stages[stage] = stages.get(stage, 0.0) + elapsed
+
+def file_sha256(path):
+    """ファイルのSHA-256チェックサム"""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def file_matches_entry(path, entry):
+    """ローカルファイルが manifest のエントリ（サイズ・チェックサム）と一致するか"""
+    if 'size' in entry and os.path.getsize(path) != entry['size']:
+        return False
+    return file_sha256(path) == entry['sha256']
+
+def lookup_user_index(model, user_id):
+    """ユーザーIDから行インデックスを取得（未知ユーザーは None）"""
+    user_ids = model['user_ids']
+    idx = int(np.searchsorted(user_ids, user_id))
+    if idx < len(user_ids) and user_ids[idx] == user_id:
+        return idx
+    return None
 
 class RecommendationAPI:
     """レコメンドAPI"""
     
     def __init__(self):
         self.model = None
-        self.bq_client = bigquery.Client(project=PROJECT_ID)
-        self.storage_client = storage.Client(project=PROJECT_ID)
+        self.model_generation = None
+        self.model_loaded_at = None
+        self.last_model_error = None
+        self._refresher_pid = None
+        self._bq_client = None
+        self._storage_client = None
+        # モデルの読み込み・差し替えは1スレッドずつ（他の呼び出しは完了を待つ）
+        self._model_lock = threading.RLock()
+        self._client_lock = threading.Lock()
+    
+    @property
+    def bq_client(self):
+        """BigQueryクライアント（初回使用時に生成）"""
+        if self._bq_client is None:
+            with self._client_lock:
+                if self._bq_client is None:
+                    from google.cloud import bigquery
+                    self._bq_client = bigquery.Client(project=PROJECT_ID)
+        return self._bq_client
+    
+    @property
+    def storage_client(self):
+        """Cloud Storageクライアント（初回使用時に生成）"""
+        if self._storage_client is None:
+            with self._client_lock:
+                if self._storage_client is None:
+                    from google.cloud import storage
+                    self._storage_client = storage.Client(project=PROJECT_ID)
+        return self._storage_client
         
     def load_model(self):
-        """モデル読み込み"""
-        if self.model is not None:
-            return self.model
-            
+        """モデル取得
+
+        初回のみリクエスト内で読み込み、以降の更新はバックグラウンドの
+        リフレッシャーが行う。初回読み込みは1スレッドだけが実行し、同時に来た
+        リクエストはその完了を待つ。呼び出し側は戻り値のモデルを使い続けるため、
+        切り替え中のリクエストは古いモデルのまま完了する。
+        """
+        model = self.model
+        if model is None:
+            with self._model_lock:
+                if self.model is None:
+                    try:
+                        self.refresh_model()
+                    except Exception as e:
+                        logger.error(f"モデル読み込みエラー: {str(e)}")
+                        self.last_model_error = str(e)
+                if self.model is None:
+                    # 読み込めるまではダミーモデルで応答し、リフレッシャーが再試行する
+                    logger.warning("モデルを読み込めません。ダミーモデルを使用します。")
+                    self.create_dummy_model()
+                model = self.model
+        
+        self.start_model_refresher()
+        return model
+    
+    def refresh_model(self, force=False):
+        """LATEST.json の世代が変わっていれば新しいモデルを読み込んで差し替え
+
+        初回読み込みとリフレッシャーが同時に走らないよう _model_lock 内で実行する。
+
+        Returns:
+            差し替えた場合 True
+        """
+        with self._model_lock:
+            return self._refresh_model(force)
+    
+    def _refresh_model(self, force):
+        """refresh_model の本体（_model_lock 取得済み）"""
+        bucket = self.storage_client.bucket(BUCKET_NAME)
+        pointer_blob = bucket.get_blob(MODEL_POINTER_PATH)
+        if pointer_blob is None:
+            raise FileNotFoundError(f"モデルポインタが見つかりません: {MODEL_POINTER_PATH}")
+        
+        current = self.model
+        if (not force and current is not None and not current.get('dummy')
+                and pointer_blob.generation == self.model_generation):
+            return False
+        
+        logger.info(f"モデル読み込み開始 (generation={pointer_blob.generation})")
+        with timed_stage('model_load'):
+            pointer = json.loads(pointer_blob.download_as_bytes())
+            model_dir = self.download_model_artifact(bucket, pointer['prefix'], pointer['version'])
+            new_model = self.open_model_artifact(model_dir)
+            self.validate_model(new_model)
+        metrics.inc('recommend_model_loads_total')
+        
+        # 参照の差し替えはアトミック
+        self.model = new_model
+        self.model_generation = pointer_blob.generation
+        self.model_loaded_at = datetime.now(timezone.utc).isoformat()
+        self.last_model_error = None
+        recommendation_cache.clear()
+        logger.info(f"モデル読み込み完了: {new_model['version']} ({new_model['trained_at']})")
+        
+        self.cleanup_model_cache(keep=new_model['version'])
+        return True
+    
+    def start_model_refresher(self):
+        """モデル更新スレッドを起動（プロセスごとに1本）"""
+        if MODEL_REFRESH_INTERVAL_SECONDS <= 0 or self._refresher_pid == os.getpid():
+            return
+        with self._client_lock:
+            if self._refresher_pid == os.getpid():
+                return
+            self._refresher_pid = os.getpid()
+        thread = threading.Thread(target=self._refresh_loop, name='model-refresher', daemon=True)
+        thread.start()
+    
+    def _refresh_loop(self):
+        """モデル更新ループ（失敗時は指数バックオフで再試行）"""
+        delay = MODEL_REFRESH_INTERVAL_SECONDS
+        while True:
+            # ダミーモデル使用中は短い間隔で再試行する
+            if self.model is None or self.model.get('dummy'):
+                delay = min(delay, MODEL_RETRY_INITIAL_SECONDS)
+            time.sleep(delay)
+            try:
+                self.refresh_model()
+                delay = MODEL_REFRESH_INTERVAL_SECONDS
+            except Exception as e:
+                self.last_model_error = str(e)
+                delay = min(max(delay * 2, MODEL_RETRY_INITIAL_SECONDS), MODEL_RETRY_MAX_SECONDS)
+                logger.error(f"モデル更新エラー（{delay:.0f}秒後に再試行）: {str(e)}")
+    
+    def validate_model(self, model):
+        """差し替え前のモデル整合性チェック"""
+        n_users = len(model['user_ids'])
+        n_items = len(model['item_ids'])
+        user_item_matrix = model['user_item_matrix']
+        
+        if n_users == 0 or n_items == 0:
+            raise ValueError("ユーザーまたはアイテムが空のモデルです")
+        if user_item_matrix.shape != (n_users, n_items):
+            raise ValueError(f"購入行列の形状が不正です: {user_item_matrix.shape}")
+        if model['normalized_user_features'].shape[0] != n_users:
+            raise ValueError("ユーザー特徴量の件数が一致しません")
+        if model['precomputed_items'] is not None and model['precomputed_items'].shape[0] != n_users:
+            raise ValueError("事前計算レコメンドの件数が一致しません")
+        if np.any(np.diff(model['user_ids']) <= 0):
+            raise ValueError("ユーザーIDが昇順ではありません")
+        
+        # 1ユーザー分のスコアリングが通ることを確認
+        if model['algorithm'] == 'als':
+            if model['user_factors'].shape[0] != n_users or model['item_factors'].shape[0] != n_items:
+                raise ValueError("ALS因子の件数が一致しません")
+            if model['user_factors'].shape[1] != model['item_factors'].shape[1]:
+                raise ValueError("ユーザー因子とアイテム因子の次元が一致しません")
+            _, scores = score_user_factors(
+                model['user_factors'], model['item_factors'], user_item_matrix, [0], N_NEIGHBORS
+            )
+            similarities = scores[~np.isnan(scores)]
+        elif model['algorithm'] == 'item_item':
+            if model['item_similarity'].shape != (n_items, n_items):
+                raise ValueError(f"アイテム類似度行列の形状が不正です: {model['item_similarity'].shape}")
+            _, scores = score_items_by_similarity(user_item_matrix, model['item_similarity'], [0], N_NEIGHBORS)
+            similarities = scores[~np.isnan(scores)]
+        else:
+            similar_users, similarities = self.find_similar_users(model, 0)
+        if not np.all(np.isfinite(similarities)):
+            raise ValueError("類似度に不正な値が含まれます")
+    
+    def cleanup_model_cache(self, keep):
+        """古いモデルバージョンのローカルファイルを削除
+
+        削除済みファイルのメモリマップは開いているプロセスで有効なままのため、
+        処理中のリクエストには影響しない。
+        """
         try:
-            logger.info("モデル読み込み開始")
-            
-            # GCSからモデルダウンロード
-            bucket = self.storage_client.bucket(BUCKET_NAME)
-            blob = bucket.blob(MODEL_PATH)
-            
-            if not blob.exists():
-                logger.warning("モデルファイルが見つかりません。ダミーモデルを使用します。")
-                return self.create_dummy_model()
-            
-            # 一時ファイルにダウンロード
-            with tempfile.NamedTemporaryFile(delete=False, suffix='.pkl') as tmp_file:
-                blob.download_to_filename(tmp_file.name)
-                model_data = joblib.load(tmp_file.name)
-                os.unlink(tmp_file.name)
+            versions = sorted(
+                name for name in os.listdir(MODEL_CACHE_DIR)
+                if os.path.isdir(os.path.join(MODEL_CACHE_DIR, name))
+            )
+            others = [v for v in versions if v != keep]
+            stale = others[:max(0, len(others) - (MODEL_CACHE_KEEP_VERSIONS - 1))]
+            for version in stale:
+                shutil.rmtree(os.path.join(MODEL_CACHE_DIR, version), ignore_errors=True)
+        except OSError as e:
+            logger.warning(f"モデルキャッシュ削除エラー: {str(e)}")
+    
+    def download_model_artifact(self, bucket, prefix, version):
+        """モデルアーティファクトをローカルにダウンロード
+
+        manifest は毎回 GCS から取得し、ローカルに既にあるファイルはサイズと
+        チェックサムが manifest と一致する場合のみ再利用する。ダウンロードした
+        ファイルはチェックサム検証後にアトミックに配置する。
+
+        Returns:
+            ローカルのモデルディレクトリ
+        """
+        model_dir = os.path.join(MODEL_CACHE_DIR, version)
+        os.makedirs(model_dir, exist_ok=True)
+        
+        manifest = json.loads(bucket.blob(f"{prefix}/manifest.json").download_as_bytes())
+        if manifest.get('format_version') != MODEL_FORMAT_VERSION:
+            raise ValueError(f"未対応のモデル形式です: {manifest.get('format_version')}")
+        if manifest.get('version') != version:
+            raise ValueError(f"manifest のバージョンがポインタと一致しません: {manifest.get('version')} != {version}")
+        
+        for name, entry in manifest['files'].items():
+            path = os.path.join(model_dir, entry['file'])
+            if os.path.exists(path) and file_matches_entry(path, entry):
+                continue
             
-            # モデルデータを復元
-            self.model = {
-                'svd_model': model_data['svd_model'],
-                'scaler': model_data['scaler'],
-                'user_features': model_data['user_features'],
-                'user_mapping': model_data['user_mapping'],
-                'item_mapping': model_data['item_mapping'],
-                'reverse_user_mapping': model_data['reverse_user_mapping'],
-                'reverse_item_mapping': model_data['reverse_item_mapping'],
-                'user_item_matrix': model_data['user_item_matrix'],
-                'trained_at': model_data.get('trained_at', 'unknown')
+            fd, tmp_path = tempfile.mkstemp(dir=model_dir, suffix='.tmp')
+            os.close(fd)
+            try:
+                bucket.blob(f"{prefix}/{entry['file']}").download_to_filename(tmp_path)
+                if file_sha256(tmp_path) != entry['sha256']:
+                    raise ValueError(f"チェックサム不一致: {entry['file']}")
+                os.replace(tmp_path, path)
+            finally:
+                if os.path.exists(tmp_path):
+                    os.unlink(tmp_path)
+        
+        # manifest は全ファイル配置後に書き込む
+        fd, tmp_path = tempfile.mkstemp(dir=model_dir, suffix='.tmp')
+        with os.fdopen(fd, 'w') as f:
+            json.dump(manifest, f)
+        os.replace(tmp_path, os.path.join(model_dir, 'manifest.json'))
+        
+        return model_dir
+    
+    def open_model_artifact(self, model_dir):
+        """モデル配列をメモリマップで開く"""
+        with open(os.path.join(model_dir, 'manifest.json')) as f:
+            manifest = json.load(f)
+        files = manifest['files']
+        
+        def load(name):
+            entry = files.get(name)
+            if entry is None:
+                return None
+            array = np.load(os.path.join(model_dir, entry['file']), mmap_mode='r')
+            if list(array.shape) != entry['shape'] or str(array.dtype) != entry['dtype']:
+                raise ValueError(f"配列の形状・型が manifest と一致しません: {name}")
+            return array
+        
+        n_users, n_items = manifest['n_users'], manifest['n_items']
+        user_item_matrix = sparse.csr_matrix(
+            (load('matrix_data'), load('matrix_indices'), load('matrix_indptr')),
+            shape=(n_users, n_items),
+            copy=False
+        )
+        
+        # 人気ランキング（読み込み時に1回だけ作成）
+        categories = manifest.get('categories', [])
+        category_codes = load('item_category_codes')
+        popularity_scores = load('popularity_scores')
+        popularity_order = load('popularity_order')
+        if popularity_scores is None:
+            popularity_scores = np.asarray(user_item_matrix.sum(axis=0)).ravel().astype(np.float32)
+            popularity_order = np.argsort(-popularity_scores, kind='stable').astype(np.int32)
+        popularity = {
+            'total': build_popularity_ranking(
+                popularity_scores, popularity_order, category_codes, categories
+            )
+        }
+        if 'popularity_decayed_scores' in files:
+            popularity['decayed'] = build_popularity_ranking(
+                load('popularity_decayed_scores'), load('popularity_decayed_order'),
+                category_codes, categories
+            )
+        
+        # 新規ユーザー向けセグメント別ランキング（キー → 行番号）
+        segments = None
+        if 'segment_items' in files:
+            segment_manifest = manifest['segments']
+            segments = {
+                'index': {key: row for row, key in enumerate(segment_manifest['keys'])},
+                'age_edges': np.asarray(segment_manifest['age_edges'], dtype=np.float64),
+                'items': load('segment_items'),
+                'scores': load('segment_scores')
             }
-            
-            logger.info(f"モデル読み込み完了: {self.model['trained_at']}")
-            return self.model
-            
-        except Exception as e:
-            logger.error(f"モデル読み込みエラー: {str(e)}")
-            return self.create_dummy_model()
+        
+        algorithm = manifest.get('algorithm', 'user_user')
+        item_similarity = None
+        user_factors = None
+        item_factors = None
+        if algorithm == 'als':
+            user_factors = load('user_features')
+            item_factors = load('item_factors')
+        elif algorithm == 'item_item':
+            item_similarity = sparse.csr_matrix(
+                (load('item_similarity_data'), load('item_similarity_indices'), load('item_similarity_indptr')),
+                shape=(n_items, n_items),
+                copy=False
+            )
+        elif algorithm != 'user_user':
+            raise ValueError(f"未対応のアルゴリズムです: {algorithm}")
+        
+        ann_index = None
+        if 'ann_centroids' in files:
+            ann_index = {
+                'centroids': load('ann_centroids'),
+                'list_offsets': load('ann_list_offsets'),
+                'list_members': load('ann_list_members'),
+                'n_probe': manifest.get('ann_n_probe') or 8
+            }
+        
+        return {
+            'version': manifest['version'],
+            'path': model_dir,
+            'algorithm': algorithm,
+            'n_components': manifest['n_components'],
+            'item_similarity': item_similarity,
+            'item_neighbors': manifest.get('item_neighbors'),
+            'n_neighbors': manifest.get('n_neighbors') or N_NEIGHBORS,
+            'user_factors': user_factors,
+            'item_factors': item_factors,
+            'user_ids': load('user_ids'),
+            'item_ids': load('item_ids'),
+            'normalized_user_features': load('normalized_user_features'),
+            'user_item_matrix': user_item_matrix,
+            'precomputed_items': load('precomputed_items'),
+            'precomputed_scores': load('precomputed_scores'),
+            'precomputed_at': manifest.get('precomputed_at'),
+            'ann_index': ann_index,
+            'popularity': popularity,
+            'segments': segments,
+            'categories': categories,
+            'category_index': {category: code for code, category in enumerate(categories)},
+            'category_bitsets': load('category_bitsets'),
+            'item_category_codes': category_codes,
+            'item_prices': load('item_prices'),
+            'trained_at': manifest.get('trained_at', 'unknown')
+        }
     
     def create_dummy_model(self):
         """ダミーモデル作成"""
@@ -90,9 +965,72 @@ class RecommendationAPI:
         }
         return self.model
     
-    def get_recommendations(self, user_id, n_recommendations=5):
-        """レコメンド取得"""
-        model = self.load_model()
+    def get_precomputed_recommendations(self, model, user_idx, n_recommendations, item_filter=None):
+        """事前計算済みレコメンドの参照
+
+        item_filter 指定時は事前計算済みリストをマスクで絞り込む。
+        事前計算テーブルがない・件数が足りない・有効期限切れの場合は None を返す
+        """
+        precomputed_items = model.get('precomputed_items')
+        if precomputed_items is None or n_recommendations > precomputed_items.shape[1]:
+            return None
+        
+        try:
+            precomputed_at = datetime.fromisoformat(model['precomputed_at'])
+            if precomputed_at.tzinfo is None:
+                precomputed_at = precomputed_at.replace(tzinfo=timezone.utc)
+        except (TypeError, ValueError):
+            return None
+        
+        age_hours = (datetime.now(timezone.utc) - precomputed_at).total_seconds() / 3600
+        if age_hours > PRECOMPUTED_MAX_AGE_HOURS:
+            return None
+        
+        if item_filter is None:
+            items = precomputed_items[user_idx, :n_recommendations]
+            scores = model['precomputed_scores'][user_idx, :n_recommendations]
+        else:
+            selected = select_ranked(precomputed_items[user_idx], model['precomputed_scores'][user_idx],
+                                     n_recommendations, item_filter)
+            if selected is None:
+                return None
+            items, scores = selected
+        return [
+            {
+                'product_id': int(model['item_ids'][item_idx]),
+                'score': float(score)
+            }
+            for item_idx, score in zip(items, scores)
+            if item_idx >= 0
+        ]
+    
+    def find_similar_users(self, model, user_idx, k=None):
+        """類似ユーザー検索
+
+        IVFインデックスがあり SIMILARITY_SEARCH=ivf の場合は近似検索、
+        それ以外は全ユーザーを走査する厳密検索。k の既定値はモデルの近傍数
+        """
+        k = k or model.get('n_neighbors') or N_NEIGHBORS
+        normalized_features = model['normalized_user_features']
+        query = normalized_features[user_idx]
+        ann_index = model.get('ann_index')
+        
+        if SIMILARITY_SEARCH == 'ivf' and ann_index is not None:
+            n_probe = ANN_N_PROBE or ann_index.get('n_probe', 8)
+            return search_similar_users_ivf(
+                query, normalized_features, ann_index, k, n_probe, exclude=user_idx
+            )
+        return search_similar_users_exact(query, normalized_features, k, exclude=user_idx)
+    
+    def get_recommendations(self, user_id, n_recommendations=5, filters=None, model=None):
+        """レコメンド取得
+
+        Args:
+            filters: 業務ルール（build_item_filter 参照）。上位N件の選択前に
+                スコアへのマスクとして適用するため、条件に合う商品でN件を返す
+            model: 使用するモデル（省略時は現在のモデル）
+        """
+        model = model or self.load_model()
         
         if model.get('dummy'):
             # ダミーモデルの場合
@@ -103,48 +1041,72 @@ class RecommendationAPI:
         
         try:
             # 実際のモデルでレコメンド
-            from sklearn.metrics.pairwise import cosine_similarity
-            import numpy as np
+            user_idx = lookup_user_index(model, user_id)
+            if user_idx is None:
+                # 新規ユーザーの場合、属性セグメントまたは全体の人気商品を返す
+                return self.get_cold_start_items(model, user_id, n_recommendations, filters)
             
-            if user_id not in model['user_mapping']:
-                # 新規ユーザーの場合、人気商品を返す
-                return self.get_popular_items(n_recommendations)
+            item_filter = build_item_filter(model, filters)
             
-            user_idx = model['user_mapping'][user_id]
-            user_vector = model['user_features'][user_idx].reshape(1, -1)
+            # 事前計算済みの場合は配列参照のみで返す
+            with timed_stage('precomputed_lookup'):
+                precomputed = self.get_precomputed_recommendations(
+                    model, user_idx, n_recommendations, item_filter
+                )
+            if precomputed is not None:
+                metrics.inc('recommend_precomputed_hits_total')
+                return precomputed
             
-            # 全ユーザーとの類似度計算
-            similarities = cosine_similarity(user_vector, model['user_features'])[0]
+            if model['algorithm'] in ('item_item', 'als'):
+                with timed_stage('item_scoring'):
+                    if model['algorithm'] == 'als':
+                        # ユーザー因子 × アイテム因子の内積
+                        items, scores = score_user_factors(
+                            model['user_factors'], model['item_factors'], model['user_item_matrix'],
+                            [user_idx], n_recommendations, item_filter
+                        )
+                    else:
+                        # 購入アイテムの類似アイテムを集計（事前計算済みの類似度行列を参照）
+                        items, scores = score_items_by_similarity(
+                            model['user_item_matrix'], model['item_similarity'], [user_idx],
+                            n_recommendations, item_filter
+                        )
+                return [
+                    {
+                        'product_id': int(model['item_ids'][item_idx]),
+                        'score': float(score)
+                    }
+                    for item_idx, score in zip(items[0], scores[0])
+                    if item_idx >= 0
+                ]
             
-            # 類似ユーザー取得
-            similar_users = np.argsort(similarities)[::-1][1:11]  # 上位10人
+            # 類似ユーザー取得（上位 n_neighbors 人）
+            with timed_stage('similarity_search'):
+                similar_users, similarities = self.find_similar_users(model, user_idx)
             
-            # 類似ユーザーの購入履歴から推薦
-            recommendations = {}
-            for similar_user_idx in similar_users:
-                similar_user_purchases = model['user_item_matrix'].iloc[similar_user_idx]
-                for item_idx, score in similar_user_purchases.items():
-                    if score > 0:  # 購入済み
-                        if item_idx not in recommendations:
-                            recommendations[item_idx] = 0
-                        recommendations[item_idx] += score * similarities[similar_user_idx]
-            
-            # 既に購入済みの商品を除外
-            user_purchases = model['user_item_matrix'].iloc[user_idx]
-            for item_idx in user_purchases[user_purchases > 0].index:
-                recommendations.pop(item_idx, None)
-            
-            # スコア順でソート
-            sorted_recommendations = sorted(
-                recommendations.items(), 
-                key=lambda x: x[1], 
-                reverse=True
-            )[:n_recommendations]
+            with timed_stage('neighbor_aggregation'):
+                # 類似ユーザーの購入履歴から推薦（類似度 × 購入行列の疎行列積）
+                user_item_matrix = model['user_item_matrix']
+                neighbor_rows = user_item_matrix[similar_users]
+                item_scores = neighbor_rows.T @ similarities
+                
+                # 類似ユーザーが購入済み かつ 本人が未購入のアイテムのみ候補
+                candidates = np.zeros(user_item_matrix.shape[1], dtype=bool)
+                candidates[neighbor_rows.indices[neighbor_rows.data > 0]] = True
+                start, stop = user_item_matrix.indptr[user_idx], user_item_matrix.indptr[user_idx + 1]
+                candidates[user_item_matrix.indices[start:stop]] = False
+                if item_filter is not None:
+                    candidates &= item_filter
+                
+                # スコア上位を取得
+                items, scores = top_n_items(item_scores[np.newaxis, :], candidates[np.newaxis, :], n_recommendations)
             
             # 商品IDに変換
             result = []
-            for item_idx, score in sorted_recommendations:
-                product_id = model['reverse_item_mapping'][item_idx]
+            for item_idx, score in zip(items[0], scores[0]):
+                if item_idx < 0:
+                    break
+                product_id = model['item_ids'][item_idx]
                 result.append({
                     'product_id': int(product_id),
                     'score': float(score)
@@ -154,10 +1116,176 @@ class RecommendationAPI:
             
         except Exception as e:
             logger.error(f"レコメンド生成エラー: {str(e)}")
-            return self.get_popular_items(n_recommendations)
+            metrics.inc('recommend_fallback_to_popular_total', {'reason': 'error'})
+            return self.get_popular_items(n_recommendations, filters=filters)
+    
+    def get_ranked_items(self, model, user_id, filters=None):
+        """ページング用にユーザーのランキング（上位 RANKING_MAX_ITEMS 件）を計算
+
+        Returns:
+            {'item_ids', 'items', 'scores'}: items は item_ids へのインデックス（int32）
+        """
+        recommendations = self.get_recommendations(user_id, RANKING_MAX_ITEMS, filters, model=model)
+        product_ids = np.array([item['product_id'] for item in recommendations], dtype=np.int64)
+        scores = np.array([item['score'] for item in recommendations], dtype=np.float32)
+        
+        item_ids = model.get('item_ids')
+        if item_ids is None:
+            # ダミーモデルはID一覧をその場で作成
+            item_ids = np.unique(product_ids)
+        positions = np.minimum(np.searchsorted(item_ids, product_ids), max(len(item_ids) - 1, 0))
+        known = item_ids[positions] == product_ids
+        return {
+            'item_ids': item_ids,
+            'items': positions[known].astype(np.int32),
+            'scores': scores[known]
+        }
+    
+    def get_batch_recommendations(self, user_ids, n_recommendations=5):
+        """複数ユーザーのレコメンドを一括取得
+
+        Returns:
+            {user_id: レコメンドリスト}
+        """
+        model = self.load_model()
+        
+        if model.get('dummy'):
+            return {user_id: self.get_recommendations(user_id, n_recommendations) for user_id in user_ids}
+        
+        results = {}
+        pending_ids = []
+        pending_idxs = []
+        popular = None
+        
+        for user_id in dict.fromkeys(user_ids):
+            user_idx = lookup_user_index(model, user_id)
+            if user_idx is None:
+                results[user_id] = self.get_cold_start_items(model, user_id, n_recommendations)
+                continue
+            precomputed = self.get_precomputed_recommendations(model, user_idx, n_recommendations)
+            if precomputed is not None:
+                results[user_id] = precomputed
+            else:
+                pending_ids.append(user_id)
+                pending_idxs.append(user_idx)
+        
+        # 残りのユーザーをブロック単位の行列演算でスコアリング
+        pending_idxs = np.asarray(pending_idxs, dtype=np.int64)
+        for start in range(0, len(pending_idxs), BATCH_BLOCK_SIZE):
+            block_ids = pending_ids[start:start + BATCH_BLOCK_SIZE]
+            try:
+                if model['algorithm'] == 'als':
+                    items, scores = score_user_factors(
+                        model['user_factors'],
+                        model['item_factors'],
+                        model['user_item_matrix'],
+                        pending_idxs[start:start + BATCH_BLOCK_SIZE],
+                        n_recommendations
+                    )
+                elif model['algorithm'] == 'item_item':
+                    items, scores = score_items_by_similarity(
+                        model['user_item_matrix'],
+                        model['item_similarity'],
+                        pending_idxs[start:start + BATCH_BLOCK_SIZE],
+                        n_recommendations
+                    )
+                else:
+                    items, scores = score_user_block(
+                        model['normalized_user_features'],
+                        model['user_item_matrix'],
+                        pending_idxs[start:start + BATCH_BLOCK_SIZE],
+                        n_recommendations,
+                        n_neighbors=model['n_neighbors']
+                    )
+            except Exception as e:
+                logger.error(f"バッチレコメンド生成エラー: {str(e)}")
+                metrics.inc('recommend_fallback_to_popular_total', {'reason': 'error'}, len(block_ids))
+                if popular is None:
+                    popular = self.get_popular_items(n_recommendations)
+                for user_id in block_ids:
+                    results[user_id] = [dict(item) for item in popular]
+                continue
+            
+            for user_id, row_items, row_scores in zip(block_ids, items, scores):
+                results[user_id] = [
+                    {
+                        'product_id': int(model['item_ids'][item_idx]),
+                        'score': float(score)
+                    }
+                    for item_idx, score in zip(row_items, row_scores)
+                    if item_idx >= 0
+                ]
+        
+        return results
+    
+    def get_segment_items(self, model, user_id, n_recommendations, item_filter=None):
+        """ユーザー属性セグメントの事前計算済みランキング参照
+
+        細かいセグメントから順にキーを引き、最初に見つかったランキングを返す。
+        ランキングが n_recommendations 件に満たない場合は得られた分だけ返す。
+        セグメント情報がない・ユーザー属性が不明な場合は None を返す
+        """
+        segments = model.get('segments')
+        if segments is None:
+            return None
+        
+        demographics = user_directory.get(user_id)
+        if demographics is None:
+            return None
+        
+        keys = segment_keys(demographics['age'], demographics['gender'], demographics['city'],
+                            segments['age_edges'])
+        for key in keys:
+            row = segments['index'].get(key)
+            if row is None:
+                continue
+            items = segments['items'][row]
+            keep = items >= 0
+            if item_filter is not None:
+                keep &= item_filter[np.where(keep, items, 0)]
+            selected = np.flatnonzero(keep)[:n_recommendations]
+            items, scores = items[selected], segments['scores'][row][selected]
+            return [
+                {
+                    'product_id': int(model['item_ids'][item_idx]),
+                    'score': float(score)
+                }
+                for item_idx, score in zip(items, scores)
+                if item_idx >= 0
+            ]
+        return None
+    
+    def get_cold_start_items(self, model, user_id, n_recommendations, filters=None):
+        """新規ユーザー向けレコメンド（セグメント別ランキング → 全体の人気商品）
+
+        セグメント別ランキングが件数に満たない場合は、全体の人気商品で補う
+        """
+        try:
+            with timed_stage('segment_lookup'):
+                segment = self.get_segment_items(
+                    model, user_id, n_recommendations, build_item_filter(model, filters)
+                )
+            if segment is not None:
+                metrics.inc('recommend_segment_hits_total')
+                if len(segment) < n_recommendations:
+                    seen = {item['product_id'] for item in segment}
+                    popular = self.get_popular_items(n_recommendations + len(segment), filters=filters)
+                    segment += [item for item in popular if item['product_id'] not in seen]
+                return segment[:n_recommendations]
+        except Exception as e:
+            logger.error(f"セグメント別レコメンド取得エラー: {str(e)}")
+        
+        metrics.inc('recommend_fallback_to_popular_total', {'reason': 'unknown_user'})
+        return self.get_popular_items(n_recommendations, filters=filters)
     
-    def get_popular_items(self, n_items=5):
-        """人気商品取得"""
+    def get_popular_items(self, n_items=5, category=None, ranking='total', filters=None):
+        """人気商品取得
+
+        Args:
+            category: 指定時はそのカテゴリ内の人気順
+            ranking: 'total'（累計）または 'decayed'（時間減衰）
+            filters: 業務ルール（build_item_filter 参照）。ランキングをマスクで絞り込む
+        """
         model = self.load_model()
         
         if model.get('dummy'):
@@ -167,16 +1295,25 @@ class RecommendationAPI:
             ]
         
         try:
-            # アイテムの総購入スコア計算
-            item_scores = model['user_item_matrix'].sum(axis=0).sort_values(ascending=False)
-            
-            result = []
-            for item_idx, score in item_scores.head(n_items).items():
-                product_id = model['reverse_item_mapping'][item_idx]
-                result.append({
-                    'product_id': int(product_id),
-                    'score': float(score)
-                })
+            with timed_stage('popularity'):
+                # 事前計算済みランキングのスライス
+                popularity = model['popularity'].get(ranking, model['popularity']['total'])
+                if category is not None:
+                    ranked = popularity['by_category'].get(category, popularity['order'][:0])
+                else:
+                    ranked = popularity['order']
+                item_filter = build_item_filter(model, filters)
+                if item_filter is not None:
+                    ranked = ranked[item_filter[ranked]]
+                top_items = ranked[:n_items]
+                
+                result = []
+                for item_idx, score in zip(top_items, popularity['scores'][top_items]):
+                    product_id = model['item_ids'][item_idx]
+                    result.append({
+                        'product_id': int(product_id),
+                        'score': float(score)
+                    })
             
             return result
             
@@ -191,41 +1328,628 @@ class RecommendationAPI:
 # API インスタンス
 recommend_api = RecommendationAPI()
 
-@lru_cache(maxsize=100)
-def get_product_info(product_id):
-    """商品情報取得（キャッシュ付き）"""
-    try:
+# BigQueryクエリを並行実行する共有スレッドプール
+query_executor = ThreadPoolExecutor(max_workers=QUERY_POOL_WORKERS, thread_name_prefix='bq-query')
+
+def run_query(query, parameters=None):
+    """パラメータ付きBigQueryクエリを実行してDataFrameを返す
+
+    query_and_wait は小さな結果をジョブ作成なしの高速パスで返す
+    """
+    from google.cloud import bigquery
+    job_config = bigquery.QueryJobConfig(query_parameters=parameters or [])
+    return recommend_api.bq_client.query_and_wait(query, job_config=job_config).to_dataframe()
+
+user_profile_cache = TTLCache(USER_PROFILE_CACHE_SIZE, USER_PROFILE_CACHE_TTL_SECONDS)
+
+def fetch_user_profile(user_id):
+    """ユーザー情報と購入履歴を並行取得
+
+    Returns:
+        プロファイルの dict（ユーザーが存在しない場合は None）
+    """
+    user_query = f"""
+    SELECT user_id, age, gender, city, registration_date
+    FROM `{PROJECT_ID}.{DATASET_ID}.users`
+    WHERE user_id = @user_id
+    LIMIT 1
+    """
+    
+    purchase_query = f"""
+    SELECT 
+        t.product_id,
+        p.product_name,
+        p.category,
+        SUM(t.quantity) as total_quantity,
+        AVG(t.price) as avg_price,
+        COUNT(*) as purchase_count,
+        MAX(t.timestamp) as last_purchase
+    FROM `{PROJECT_ID}.{DATASET_ID}.transactions` t
+    LEFT JOIN `{PROJECT_ID}.{DATASET_ID}.products` p ON t.product_id = p.product_id
+    WHERE t.user_id = @user_id
+    GROUP BY t.product_id, p.product_name, p.category
+    ORDER BY purchase_count DESC, last_purchase DESC
+    LIMIT 10
+    """
+    
+    from google.cloud import bigquery
+    parameters = [bigquery.ScalarQueryParameter('user_id', 'INT64', user_id)]
+    user_future = query_executor.submit(run_query, user_query, parameters)
+    purchase_future = query_executor.submit(run_query, purchase_query, parameters)
+    
+    user_result = user_future.result()
+    purchase_result = purchase_future.result()
+    
+    if len(user_result) == 0:
+        return None
+    
+    purchase_history = purchase_result.to_dict('records') if len(purchase_result) > 0 else []
+    return {
+        'user_info': user_result.to_dict('records')[0],
+        'purchase_history': purchase_history,
+        'purchase_summary': {
+            'total_products': len(purchase_history),
+            'total_purchases': int(purchase_result['purchase_count'].sum()) if len(purchase_result) > 0 else 0
+        }
+    }
+
+def placeholder_product_info(product_id, found=True):
+    """商品情報が得られない場合の代替情報
+
+    found=False はBigQueryエラー時（情報不明）、found=True はテーブルに存在しない商品
+    """
+    if found:
+        return {
+            'product_id': product_id,
+            'product_name': f'テスト商品{product_id}',
+            'category': 'テストカテゴリ',
+            'price': 1000.0,
+            'brand': 'テストブランド'
+        }
+    return {
+        'product_id': product_id,
+        'product_name': f'商品{product_id}',
+        'category': 'unknown',
+        'price': 0.0,
+        'brand': 'unknown'
+    }
+
+class ProductCatalog:
+    """商品カタログ
+
+    products テーブル全体を product_id 昇順の列指向配列として保持し、
+    CATALOG_TTL_SECONDS ごとに再読み込みする。スナップショットにない商品は
+    1回の IN UNNEST(@product_ids) クエリでまとめて取得し、存在しなかった ID は
+    CATALOG_NEGATIVE_TTL_SECONDS の間だけ再問い合わせしない。
+    BigQueryエラーはキャッシュしない。
+    """
+    
+    COLUMNS = ['product_id', 'product_name', 'category', 'price', 'brand']
+    
+    def __init__(self, ttl_seconds=None, negative_ttl_seconds=None):
+        self.ttl_seconds = ttl_seconds if ttl_seconds is not None else CATALOG_TTL_SECONDS
+        self.negative_ttl_seconds = (negative_ttl_seconds if negative_ttl_seconds is not None
+                                     else CATALOG_NEGATIVE_TTL_SECONDS)
+        self._snapshot = None
+        self._loaded_at = 0.0
+        self._next_refresh_at = 0.0
+        self._extra = {}
+        self._missing = {}
+        self._lock = threading.Lock()
+        self._refresh_lock = threading.Lock()
+    
+    def _build_snapshot(self, df):
+        """DataFrameから列指向スナップショットを作成"""
+        df = df.sort_values('product_id')
+        return {
+            'product_id': df['product_id'].to_numpy(dtype=np.int64),
+            'product_name': df['product_name'].astype(object).to_numpy(),
+            'category': df['category'].astype(object).to_numpy(),
+            'price': df['price'].to_numpy(dtype=np.float64),
+            'brand': df['brand'].astype(object).to_numpy()
+        }
+    
+    def refresh(self):
+        """products テーブル全体を読み込み、スナップショットを差し替え"""
         query = f"""
         SELECT product_id, product_name, category, price, brand
         FROM `{PROJECT_ID}.{DATASET_ID}.products`
-        WHERE product_id = {product_id}
-        LIMIT 1
         """
+        snapshot = self._build_snapshot(run_query(query))
+        with self._lock:
+            self._snapshot = snapshot
+            self._loaded_at = time.monotonic()
+            self._next_refresh_at = self._loaded_at + self.ttl_seconds
+            self._extra = {}
+            self._missing = {}
+        logger.info(f"商品カタログ読み込み完了: {len(snapshot['product_id'])}件")
+    
+    def ensure_fresh(self):
+        """TTL切れの場合に再読み込み（失敗時は既存スナップショットを継続使用）
+
+        読み込みは1スレッドだけが行う。スナップショットがあれば他のスレッドは
+        待たずに既存のものを使い、初回読み込み中のみ完了を待つ。
+        """
+        if time.monotonic() < self._next_refresh_at:
+            return
+        if not self._refresh_lock.acquire(blocking=self._snapshot is None):
+            return
+        try:
+            # 待っている間に他のスレッドが読み込み済みなら何もしない
+            if time.monotonic() < self._next_refresh_at:
+                return
+            try:
+                self.refresh()
+            except Exception as e:
+                logger.error(f"商品カタログ読み込みエラー: {str(e)}")
+                # 失敗時はリクエストごとに再試行せず、一定時間待つ
+                self._next_refresh_at = time.monotonic() + min(self.ttl_seconds, CATALOG_RETRY_SECONDS)
+        finally:
+            self._refresh_lock.release()
+    
+    def _lookup_snapshot(self, product_ids):
+        """スナップショットから商品情報を取得"""
+        snapshot = self._snapshot
+        if snapshot is None or len(snapshot['product_id']) == 0:
+            return {}
         
-        result = recommend_api.bq_client.query(query).to_dataframe()
-        if len(result) > 0:
-            return result.iloc[0].to_dict()
-        else:
-            # ダミー商品情報
-            return {
-                'product_id': product_id,
-                'product_name': f'テスト商品{product_id}',
-                'category': 'テストカテゴリ',
-                'price': 1000.0,
-                'brand': 'テストブランド'
+        ids = np.asarray(product_ids, dtype=np.int64)
+        positions = np.searchsorted(snapshot['product_id'], ids)
+        positions = np.minimum(positions, len(snapshot['product_id']) - 1)
+        hit = snapshot['product_id'][positions] == ids
+        
+        found = {}
+        for product_id, pos in zip(ids[hit], positions[hit]):
+            found[int(product_id)] = {
+                'product_id': int(product_id),
+                'product_name': snapshot['product_name'][pos],
+                'category': snapshot['category'][pos],
+                'price': float(snapshot['price'][pos]),
+                'brand': snapshot['brand'][pos]
             }
-    except Exception as e:
-        logger.error(f"商品情報取得エラー: {str(e)}")
+        return found
+    
+    def _fetch(self, product_ids):
+        """スナップショットにない商品を1回のクエリで取得"""
+        query = f"""
+        SELECT product_id, product_name, category, price, brand
+        FROM `{PROJECT_ID}.{DATASET_ID}.products`
+        WHERE product_id IN UNNEST(@product_ids)
+        """
+        from google.cloud import bigquery
+        result = run_query(query, [
+            bigquery.ArrayQueryParameter('product_ids', 'INT64', product_ids)
+        ])
+        return {int(row['product_id']): row for row in result.to_dict('records')}
+    
+    def get_many(self, product_ids):
+        """複数商品の情報を取得
+
+        Returns:
+            {product_id: 商品情報}
+        """
+        product_ids = sorted({int(pid) for pid in product_ids})
+        if not product_ids:
+            return {}
+        
+        self.ensure_fresh()
+        products = self._lookup_snapshot(product_ids)
+        
+        now = time.monotonic()
+        unresolved = []
+        for product_id in product_ids:
+            if product_id in products:
+                continue
+            if product_id in self._extra:
+                products[product_id] = self._extra[product_id]
+            elif self._missing.get(product_id, 0) > now:
+                products[product_id] = placeholder_product_info(product_id)
+            else:
+                unresolved.append(product_id)
+        
+        if unresolved:
+            try:
+                fetched = self._fetch(unresolved)
+            except Exception as e:
+                logger.error(f"商品情報取得エラー: {str(e)}")
+                for product_id in unresolved:
+                    products[product_id] = placeholder_product_info(product_id, found=False)
+                return products
+            
+            with self._lock:
+                for product_id in unresolved:
+                    if product_id in fetched:
+                        self._extra[product_id] = fetched[product_id]
+                        products[product_id] = fetched[product_id]
+                    else:
+                        # 存在しない商品は一定時間だけ再問い合わせしない
+                        self._missing[product_id] = now + self.negative_ttl_seconds
+                        products[product_id] = placeholder_product_info(product_id)
+        
+        return products
+    
+    def get(self, product_id):
+        """単一商品の情報を取得"""
+        return self.get_many([product_id])[int(product_id)]
+    
+    def stats(self):
+        """カタログの状態"""
+        snapshot = self._snapshot
         return {
-            'product_id': product_id,
-            'product_name': f'商品{product_id}',
-            'category': 'unknown',
-            'price': 0.0,
-            'brand': 'unknown'
+            'n_products': len(snapshot['product_id']) if snapshot is not None else 0,
+            'n_extra': len(self._extra),
+            'n_missing': len(self._missing),
+            'age_seconds': round(time.monotonic() - self._loaded_at, 1) if snapshot is not None else None
+        }
+
+product_catalog = ProductCatalog()
+
+class UserDirectory:
+    """新規ユーザーのセグメント判定用ユーザー属性スナップショット
+
+    users テーブルの年齢・性別・都市を user_id 昇順の列指向配列として保持し、
+    USER_SNAPSHOT_TTL_SECONDS ごとに再読み込みする。リクエスト時には BigQuery に
+    問い合わせないため、スナップショット後に登録されたユーザーは次回の
+    再読み込みまで属性不明（全体の人気商品）として扱う。
+    """
+    
+    def __init__(self, ttl_seconds=None):
+        self.ttl_seconds = ttl_seconds if ttl_seconds is not None else USER_SNAPSHOT_TTL_SECONDS
+        self._snapshot = None
+        self._loaded_at = 0.0
+        self._next_refresh_at = 0.0
+        self._lock = threading.Lock()
+        self._refresh_lock = threading.Lock()
+    
+    def _build_snapshot(self, df):
+        """DataFrameから列指向スナップショットを作成（性別・都市はコード化）"""
+        df = df.sort_values('user_id')
+        gender_codes, genders = df['gender'].factorize()
+        city_codes, cities = df['city'].factorize()
+        return {
+            'user_id': df['user_id'].to_numpy(dtype=np.int64),
+            'age': df['age'].to_numpy(dtype=np.float64, na_value=np.nan),
+            'gender_code': gender_codes.astype(np.int32),
+            'genders': list(genders),
+            'city_code': city_codes.astype(np.int32),
+            'cities': list(cities)
+        }
+    
+    def refresh(self):
+        """users テーブルの属性を読み込み、スナップショットを差し替え"""
+        query = f"""
+        SELECT user_id, age, gender, city
+        FROM `{PROJECT_ID}.{DATASET_ID}.users`
+        """
+        snapshot = self._build_snapshot(run_query(query))
+        with self._lock:
+            self._snapshot = snapshot
+            self._loaded_at = time.monotonic()
+            self._next_refresh_at = self._loaded_at + self.ttl_seconds
+        logger.info(f"ユーザー属性読み込み完了: {len(snapshot['user_id'])}件")
+    
+    def ensure_fresh(self):
+        """TTL切れの場合に再読み込み（失敗時は既存スナップショットを継続使用）
+
+        読み込みは1スレッドだけが行う。スナップショットがあれば他のスレッドは
+        待たずに既存のものを使い、初回読み込み中のみ完了を待つ。
+        """
+        if time.monotonic() < self._next_refresh_at:
+            return
+        if not self._refresh_lock.acquire(blocking=self._snapshot is None):
+            return
+        try:
+            # 待っている間に他のスレッドが読み込み済みなら何もしない
+            if time.monotonic() < self._next_refresh_at:
+                return
+            try:
+                self.refresh()
+            except Exception as e:
+                logger.error(f"ユーザー属性読み込みエラー: {str(e)}")
+                self._next_refresh_at = time.monotonic() + min(self.ttl_seconds, USER_SNAPSHOT_RETRY_SECONDS)
+        finally:
+            self._refresh_lock.release()
+    
+    def get(self, user_id):
+        """ユーザー属性を取得
+
+        Returns:
+            {'age', 'gender', 'city'}（スナップショットにない場合は None）
+        """
+        self.ensure_fresh()
+        snapshot = self._snapshot
+        if snapshot is None or len(snapshot['user_id']) == 0:
+            return None
+        
+        pos = int(np.searchsorted(snapshot['user_id'], user_id))
+        if pos >= len(snapshot['user_id']) or snapshot['user_id'][pos] != user_id:
+            return None
+        
+        gender_code = snapshot['gender_code'][pos]
+        city_code = snapshot['city_code'][pos]
+        return {
+            'age': float(snapshot['age'][pos]),
+            'gender': snapshot['genders'][gender_code] if gender_code >= 0 else None,
+            'city': snapshot['cities'][city_code] if city_code >= 0 else None
+        }
+    
+    def stats(self):
+        """スナップショットの状態"""
+        snapshot = self._snapshot
+        return {
+            'n_users': len(snapshot['user_id']) if snapshot is not None else 0,
+            'age_seconds': round(time.monotonic() - self._loaded_at, 1) if snapshot is not None else None
+        }
+
+user_directory = UserDirectory()
+
+def attach_product_info(items):
+    """レコメンド結果に商品情報を一括付与"""
+    with timed_stage('product_enrichment'):
+        products = product_catalog.get_many(item['product_id'] for item in items)
+        for item in items:
+            item['product_info'] = products[item['product_id']]
+    return items
+
+# 起動状態（ウォームアップ完了まで ready=False）
+# status: starting / ready / degraded（ダミーモデルで応答中）/ failed（再試行待ち）
+startup_state = {
+    'ready': False,
+    'status': 'starting',
+    'model': None,
+    'error': None,
+    'attempts': 0,
+    'module_import_seconds': round(time.perf_counter() - _MODULE_IMPORT_STARTED, 3),
+    'timings': {}
+}
+_warm_up_lock = threading.Lock()
+
+def warm_up():
+    """起動時のウォームアップ（プロセスごとに成功するまで）
+
+    クライアント生成・モデル読み込み・商品カタログ読み込みを先に済ませ、
+    最初のリクエストがこれらの待ち時間を負担しないようにする。失敗した場合は
+    startup_state に記録して ready=False のまま戻り、次の呼び出しで再試行する。
+    """
+    with _warm_up_lock:
+        if startup_state['ready']:
+            return startup_state
+        
+        startup_state['attempts'] += 1
+        timings = {}
+        try:
+            started = time.perf_counter()
+            recommend_api.storage_client
+            recommend_api.bq_client
+            timings['clients'] = time.perf_counter() - started
+            
+            started = time.perf_counter()
+            model = recommend_api.load_model()
+            timings['model'] = time.perf_counter() - started
+            
+            started = time.perf_counter()
+            product_catalog.ensure_fresh()
+            timings['catalog'] = time.perf_counter() - started
+            
+            if model.get('segments') is not None:
+                started = time.perf_counter()
+                user_directory.ensure_fresh()
+                timings['users'] = time.perf_counter() - started
+            
+            # 1件スコアリングしてメモリマップのページを読み込む
+            started = time.perf_counter()
+            if not model.get('dummy'):
+                recommend_api.get_popular_items(1)
+                recommend_api.get_recommendations(int(model['user_ids'][0]), 1)
+            timings['probe'] = time.perf_counter() - started
+        except Exception as e:
+            logger.error(f"ウォームアップエラー（再試行します）: {str(e)}")
+            startup_state['status'] = 'failed'
+            startup_state['error'] = str(e)
+            return startup_state
+        
+        startup_state['timings'] = {name: round(seconds, 3) for name, seconds in timings.items()}
+        startup_state['model'] = 'dummy' if model.get('dummy') else 'loaded'
+        startup_state['status'] = 'degraded' if model.get('dummy') else 'ready'
+        startup_state['error'] = None
+        startup_state['ready'] = True
+        logger.info(
+            f"ウォームアップ完了 ({startup_state['status']}): import={startup_state['module_import_seconds']}秒, "
+            + ", ".join(f"{name}={seconds}秒" for name, seconds in startup_state['timings'].items())
+        )
+        return startup_state
+
+def _warm_up_loop():
+    """成功するまで指数バックオフでウォームアップを再試行"""
+    delay = MODEL_RETRY_INITIAL_SECONDS
+    while not warm_up()['ready']:
+        time.sleep(delay)
+        delay = min(delay * 2, MODEL_RETRY_MAX_SECONDS)
+
+def start_warm_up():
+    """ウォームアップをバックグラウンドで開始（gunicorn ワーカー起動時に呼ばれる）"""
+    thread = threading.Thread(target=_warm_up_loop, name='warm-up', daemon=True)
+    thread.start()
+    return thread
+
+@app.before_request
+def start_request_timer():
+    """リクエスト計測開始"""
+    g.request_started = time.perf_counter()
+    g.stage_timings = {}
+
+@app.after_request
+def record_request_metrics(response):
+    """リクエストのレイテンシ記録と Server-Timing ヘッダ付与（オプトイン）"""
+    started = g.get('request_started')
+    if started is None:
+        return response
+    elapsed = time.perf_counter() - started
+    endpoint = request.url_rule.rule if request.url_rule else 'unmatched'
+    metrics.observe('recommend_request_latency_seconds', {'endpoint': endpoint}, elapsed)
+    metrics.inc('recommend_requests_total', {'endpoint': endpoint, 'status': response.status_code})
+    
+    # ?server_timing=true または X-Server-Timing ヘッダ指定時のみ
+    requested = (request.args.get('server_timing', '').lower() in ('1', 'true')
+                 or request.headers.get('X-Server-Timing', '').lower() in ('1', 'true'))
+    if requested:
+        entries = [f"{stage};dur={seconds * 1000:.2f}" for stage, seconds in g.get('stage_timings', {}).items()]
+        entries.append(f"total;dur={elapsed * 1000:.2f}")
+        response.headers['Server-Timing'] = ', '.join(entries)
+    return response
+
+def parse_bool_flag(value, name):
+    """真偽値パラメータを解析（JSON の真偽値、または文字列 'true' / 'false'）
+
+    Returns:
+        (flag, error): error は不正な場合のメッセージ
+    """
+    if isinstance(value, bool):
+        return value, None
+    if isinstance(value, str) and value.lower() in ('true', 'false'):
+        return value.lower() == 'true', None
+    return None, f'{name}にはtrueまたはfalseを指定してください'
+
+def parse_item_filters(args):
+    """クエリ文字列の業務ルール（category / min_price / max_price / exclude）を解析
+
+    Returns:
+        (filters, error): filters は build_item_filter 用の dict、error は不正な場合のメッセージ
+    """
+    filters = {
+        'category': args.get('category') or None,
+        'min_price': args.get('min_price', type=float),
+        'max_price': args.get('max_price', type=float),
+        'exclude': []
+    }
+    for name in ('min_price', 'max_price'):
+        if args.get(name) and filters[name] is None:
+            return None, f'{name}は数値で指定してください'
+    if (filters['min_price'] is not None and filters['max_price'] is not None
+            and filters['min_price'] > filters['max_price']):
+        return None, 'min_priceはmax_price以下で指定してください'
+    
+    exclude = args.get('exclude', default='')
+    if exclude:
+        try:
+            filters['exclude'] = sorted({int(pid) for pid in exclude.split(',') if pid.strip()})
+        except ValueError:
+            return None, 'excludeはカンマ区切りの商品IDで指定してください'
+        if len(filters['exclude']) > EXCLUDE_MAX_ITEMS:
+            return None, f'excludeは{EXCLUDE_MAX_ITEMS}件以内で指定してください'
+    return filters, None
+
+def filter_digest(filter_key):
+    """絞り込み条件の短いダイジェスト（カーソルと条件の対応確認用）"""
+    return hashlib.sha256(repr(filter_key).encode()).hexdigest()[:16]
+
+def encode_cursor(user_id, version, offset, filter_key):
+    """ページングカーソル（ユーザー・モデルバージョン・次の位置・条件を base64 で符号化）"""
+    payload = json.dumps({'u': user_id, 'v': version, 'o': offset, 'f': filter_digest(filter_key)},
+                         separators=(',', ':'))
+    return base64.urlsafe_b64encode(payload.encode()).decode().rstrip('=')
+
+def decode_cursor(cursor):
+    """ページングカーソルの復号（不正な場合は ValueError）"""
+    try:
+        payload = json.loads(base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)))
+        return int(payload['u']), str(payload['v']), int(payload['o']), str(payload['f'])
+    except (ValueError, KeyError, TypeError) as e:
+        raise ValueError(f"不正なカーソルです: {str(e)}")
+
+def recommend_page(user_id, page_size, include_product_info, filters, offset=None, cursor=None):
+    """ページング付きレコメンド
+
+    最初のページでユーザーのランキング全体を計算して ranking_cache に保存し、
+    以降のページはそのスライスで応答する。カーソルは計算時のモデルバージョンを
+    保持するため、モデル差し替え後も同じランキングの続きを返す。
+    """
+    model = recommend_api.load_model()
+    version = model.get('version', model['trained_at'])
+    filter_key = (filters['category'], filters['min_price'], filters['max_price'], tuple(filters['exclude']))
+    
+    if cursor:
+        try:
+            cursor_user, version, offset, digest = decode_cursor(cursor)
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
+        if cursor_user != user_id or digest != filter_digest(filter_key):
+            return jsonify({'error': 'カーソルがuser_idまたは絞り込み条件と一致しません'}), 400
+    
+    if offset < 0 or offset > RANKING_MAX_ITEMS:
+        return jsonify({'error': f'offsetは0〜{RANKING_MAX_ITEMS}の範囲で指定してください'}), 400
+    
+    ranking_key = (user_id, version, filter_key)
+    ranking = ranking_cache.get(ranking_key)
+    if ranking is None:
+        if version != model.get('version', model['trained_at']):
+            # 旧モデルのランキングが期限切れ（再計算できない）
+            return jsonify({
+                'error': 'カーソルの有効期限が切れました。最初のページから取得し直してください',
+                'model_version': model.get('version')
+            }), 410
+        
+        def compute():
+            ranking = recommend_api.get_ranked_items(model, user_id, filters)
+            ranking_cache.set(ranking_key, ranking)
+            return ranking
+        
+        ranking, shared = recommendation_flight.do(('ranking',) + ranking_key, compute)
+        if shared:
+            metrics.inc('recommend_coalesced_requests_total')
+    else:
+        metrics.inc('recommend_ranking_cache_hits_total')
+    
+    items = ranking['items'][offset:offset + page_size]
+    scores = ranking['scores'][offset:offset + page_size]
+    recommendations = [
+        {
+            'product_id': int(ranking['item_ids'][item_idx]),
+            'score': float(score)
         }
+        for item_idx, score in zip(items, scores)
+    ]
+    if include_product_info:
+        attach_product_info(recommendations)
+    
+    next_offset = offset + len(recommendations)
+    total = len(ranking['items'])
+    with timed_stage('json_serialization'):
+        return jsonify({
+            'user_id': user_id,
+            'recommendations': recommendations,
+            'count': len(recommendations),
+            'offset': offset,
+            'total': total,
+            'next_cursor': encode_cursor(user_id, version, next_offset, filter_key) if next_offset < total else None,
+            'model_version': version,
+            'timestamp': datetime.now(timezone.utc).isoformat()
+        })
 
 # API エンドポイント
 
+@app.route('/_ah/warmup')
+def warmup():
+    """App Engine ウォームアップリクエスト"""
+    try:
+        state = warm_up()
+        if not state['ready']:
+            return jsonify({
+                'status': state['status'],
+                'error': state['error']
+            }), 500
+        return jsonify({
+            'status': state['status'],
+            'model': state['model'],
+            'startup_timings': state['timings']
+        })
+    except Exception as e:
+        logger.error(f"ウォームアップエラー: {str(e)}")
+        return jsonify({
+            'status': 'error',
+            'error': str(e)
+        }), 500
+
 @app.route('/')
 def index():
     """ヘルスチェック"""
@@ -235,23 +1959,55 @@ def index():
         'timestamp': datetime.now(timezone.utc).isoformat(),
         'endpoints': [
             '/recommend',
+            '/recommend/batch',
             '/popular',
             '/health',
+            '/metrics',
             '/model-info'
         ]
     })
 
 @app.route('/health')
 def health():
-    """詳細ヘルスチェック"""
+    """詳細ヘルスチェック（ウォームアップ完了まで 503）"""
     try:
-        # モデル読み込みテスト
+        if not startup_state['ready']:
+            return jsonify({
+                'status': startup_state['status'],
+                'ready': False,
+                'error': startup_state['error'],
+                'attempts': startup_state['attempts'],
+                'timestamp': datetime.now(timezone.utc).isoformat()
+            }), 503
+        
         model = recommend_api.load_model()
-        model_status = 'loaded' if model else 'failed'
+        if not model:
+            model_status = 'failed'
+        elif model.get('dummy'):
+            model_status = 'dummy'
+        else:
+            model_status = 'loaded'
         
         return jsonify({
-            'status': 'healthy',
+            # ダミーモデルで応答中は degraded（リフレッシャーが読み込めれば healthy に戻る）
+            'status': 'degraded' if model_status != 'loaded' else 'healthy',
+            'ready': True,
+            'startup': {
+                'module_import_seconds': startup_state['module_import_seconds'],
+                'timings': startup_state['timings']
+            },
             'model_status': model_status,
+            'model_version': model.get('version') if model else None,
+            'model_generation': recommend_api.model_generation,
+            'model_loaded_at': recommend_api.model_loaded_at,
+            'last_model_error': recommend_api.last_model_error,
+            'catalog': product_catalog.stats(),
+            'users': user_directory.stats(),
+            'cache': {
+                'recommend': recommendation_cache.stats(),
+                'ranking': ranking_cache.stats(),
+                'user_profile': user_profile_cache.stats()
+            },
             'timestamp': datetime.now(timezone.utc).isoformat(),
             'project_id': PROJECT_ID
         })
@@ -262,6 +2018,25 @@ def health():
             'timestamp': datetime.now(timezone.utc).isoformat()
         }), 500
 
+@app.route('/metrics')
+def prometheus_metrics():
+    """Prometheusテキスト形式のメトリクス（プロセス単位）"""
+    model = recommend_api.model or {}
+    gauges = [
+        ('recommend_model_info', {'version': model.get('version', 'dummy' if model.get('dummy') else 'none')}, 1),
+        ('recommend_ready', {}, int(startup_state['ready'])),
+        ('recommend_degraded', {}, int(bool(model.get('dummy')))),
+    ]
+    counters = []
+    for name, cache in (('recommend', recommendation_cache), ('user_profile', user_profile_cache)):
+        stats = cache.stats()
+        counters.append(('recommend_cache_hits_total', {'cache': name}, stats['hits']))
+        counters.append(('recommend_cache_misses_total', {'cache': name}, stats['misses']))
+        gauges.append(('recommend_cache_size', {'cache': name}, stats['size']))
+        gauges.append(('recommend_cache_hit_rate', {'cache': name}, stats['hit_rate']))
+    
+    return app.response_class(metrics.render(gauges, counters), mimetype='text/plain; version=0.0.4')
+
 @app.route('/model-info')
 def model_info():
     """モデル情報取得"""
@@ -278,10 +2053,16 @@ def model_info():
         return jsonify({
             'model_type': 'collaborative_filtering',
             'trained_at': model['trained_at'],
-            'n_users': len(model['user_mapping']),
-            'n_items': len(model['item_mapping']),
+            'model_version': model['version'],
+            'n_users': len(model['user_ids']),
+            'n_items': len(model['item_ids']),
             'matrix_shape': list(model['user_item_matrix'].shape),
-            'n_components': model['svd_model'].n_components
+            'n_components': model['n_components'],
+            'algorithm': model['algorithm'],
+            'item_neighbors': model['item_neighbors'],
+            'n_neighbors': model['n_neighbors'],
+            'n_segments': len(model['segments']['index']) if model.get('segments') else 0,
+            'similarity_search': 'ivf' if SIMILARITY_SEARCH == 'ivf' and model.get('ann_index') else 'exact'
         })
         
     except Exception as e:
@@ -297,7 +2078,11 @@ def recommend():
         # パラメータ取得
         user_id = request.args.get('user_id', type=int)
         n_recommendations = request.args.get('n_recommendations', default=5, type=int)
-        include_product_info = request.args.get('include_product_info', default='true').lower() == 'true'
+        include_product_info, error = parse_bool_flag(
+            request.args.get('include_product_info', default='true'), 'include_product_info'
+        )
+        if error:
+            return jsonify({'error': error}), 400
         
         if not user_id:
             return jsonify({
@@ -310,21 +2095,51 @@ def recommend():
                 'error': 'n_recommendationsは1〜20の範囲で指定してください'
             }), 400
         
-        # レコメンド生成
-        recommendations = recommend_api.get_recommendations(user_id, n_recommendations)
+        filters, error = parse_item_filters(request.args)
+        if error:
+            return jsonify({'error': error}), 400
         
-        # 商品情報付与（オプション）
-        if include_product_info:
-            for rec in recommendations:
-                product_info = get_product_info(rec['product_id'])
-                rec['product_info'] = product_info
+        # offset / cursor 指定時はページング（n_recommendations はページサイズ）
+        offset = request.args.get('offset', type=int)
+        cursor = request.args.get('cursor')
+        if 'offset' in request.args and offset is None:
+            return jsonify({'error': 'offsetは整数で指定してください'}), 400
+        if offset is not None or cursor:
+            return recommend_page(user_id, n_recommendations, include_product_info, filters,
+                                  offset=offset or 0, cursor=cursor)
         
-        return jsonify({
-            'user_id': user_id,
-            'recommendations': recommendations,
-            'count': len(recommendations),
-            'timestamp': datetime.now(timezone.utc).isoformat()
-        })
+        # キャッシュ参照（同一モデル・同一条件で同じ件数以上を計算済みなら先頭を返す）
+        model = recommend_api.load_model()
+        cache_key = (user_id, include_product_info, model.get('version', model['trained_at']),
+                     filters['category'], filters['min_price'], filters['max_price'], tuple(filters['exclude']))
+        cached = recommendation_cache.get(cache_key, accept=lambda entry: entry[0] >= n_recommendations)
+        if cached is not None:
+            metrics.inc('recommend_response_cache_hits_total')
+            recommendations = cached[1][:n_recommendations]
+        else:
+            def compute():
+                # レコメンド生成
+                recommendations = recommend_api.get_recommendations(user_id, n_recommendations, filters)
+                
+                # 商品情報付与（オプション）
+                if include_product_info:
+                    attach_product_info(recommendations)
+                
+                recommendation_cache.set(cache_key, (n_recommendations, recommendations))
+                return recommendations
+            
+            # 同じ条件の計算が実行中なら完了を待って結果を共有
+            recommendations, shared = recommendation_flight.do(cache_key + (n_recommendations,), compute)
+            if shared:
+                metrics.inc('recommend_coalesced_requests_total')
+        
+        with timed_stage('json_serialization'):
+            return jsonify({
+                'user_id': user_id,
+                'recommendations': recommendations,
+                'count': len(recommendations),
+                'timestamp': datetime.now(timezone.utc).isoformat()
+            })
         
     except Exception as e:
         logger.error(f"レコメンドエラー: {str(e)}")
@@ -335,33 +2150,124 @@ def recommend():
             'timestamp': datetime.now(timezone.utc).isoformat()
         }), 500
 
+@app.route('/recommend/batch', methods=['POST'])
+def recommend_batch():
+    """複数ユーザーのレコメンド一括取得"""
+    try:
+        body = request.get_json(silent=True) or {}
+        user_ids = body.get('user_ids')
+        n_recommendations = body.get('n_recommendations', 5)
+        include_product_info, error = parse_bool_flag(
+            body.get('include_product_info', True), 'include_product_info'
+        )
+        if error:
+            return jsonify({'error': error}), 400
+        
+        if not isinstance(user_ids, list) or len(user_ids) == 0:
+            return jsonify({
+                'error': 'user_idsリストが必要です',
+                'example': {'user_ids': [1001, 1002], 'n_recommendations': 5}
+            }), 400
+        
+        if len(user_ids) > BATCH_MAX_USERS:
+            return jsonify({
+                'error': f'user_idsは最大{BATCH_MAX_USERS}件まで指定できます'
+            }), 400
+        
+        try:
+            # bool は int のサブクラスのため明示的に除外
+            if any(isinstance(user_id, bool) for user_id in user_ids):
+                raise TypeError
+            user_ids = [int(user_id) for user_id in user_ids]
+        except (TypeError, ValueError):
+            return jsonify({
+                'error': 'user_idsには整数を指定してください'
+            }), 400
+        
+        if (isinstance(n_recommendations, bool) or not isinstance(n_recommendations, int)
+                or n_recommendations <= 0 or n_recommendations > 20):
+            return jsonify({
+                'error': 'n_recommendationsは1〜20の範囲で指定してください'
+            }), 400
+        
+        # レコメンド一括生成
+        recommendations = recommend_api.get_batch_recommendations(user_ids, n_recommendations)
+        
+        # 商品情報を一括付与（オプション）
+        if include_product_info:
+            attach_product_info([rec for recs in recommendations.values() for rec in recs])
+        
+        results = [
+            {
+                'user_id': user_id,
+                'recommendations': recommendations[user_id],
+                'count': len(recommendations[user_id])
+            }
+            for user_id in dict.fromkeys(user_ids)
+        ]
+        
+        with timed_stage('json_serialization'):
+            return jsonify({
+                'results': results,
+                'count': len(results),
+                'timestamp': datetime.now(timezone.utc).isoformat()
+            })
+        
+    except Exception as e:
+        logger.error(f"バッチレコメンドエラー: {str(e)}")
+        logger.error(traceback.format_exc())
+        return jsonify({
+            'error': 'バッチレコメンド生成に失敗しました',
+            'details': str(e),
+            'timestamp': datetime.now(timezone.utc).isoformat()
+        }), 500
+
 @app.route('/popular')
 def popular():
     """人気商品取得"""
     try:
         # パラメータ取得
         n_items = request.args.get('n_items', default=10, type=int)
-        include_product_info = request.args.get('include_product_info', default='true').lower() == 'true'
+        ranking = request.args.get('ranking', default='total')
+        include_product_info, error = parse_bool_flag(
+            request.args.get('include_product_info', default='true'), 'include_product_info'
+        )
+        if error:
+            return jsonify({'error': error}), 400
         
         if n_items <= 0 or n_items > 50:
             return jsonify({
                 'error': 'n_itemsは1〜50の範囲で指定してください'
             }), 400
         
+        if ranking not in ('total', 'decayed'):
+            return jsonify({
+                'error': 'rankingはtotalまたはdecayedを指定してください'
+            }), 400
+        
+        filters, error = parse_item_filters(request.args)
+        if error:
+            return jsonify({'error': error}), 400
+        # カテゴリはカテゴリ別ランキングで、その他の条件はマスクで絞り込む
+        category = filters.pop('category')
+        
         # 人気商品取得
-        popular_items = recommend_api.get_popular_items(n_items)
+        popular_items = recommend_api.get_popular_items(
+            n_items, category=category, ranking=ranking, filters=filters
+        )
         
         # 商品情報付与（オプション）
         if include_product_info:
-            for item in popular_items:
-                product_info = get_product_info(item['product_id'])
-                item['product_info'] = product_info
+            attach_product_info(popular_items)
         
-        return jsonify({
-            'popular_items': popular_items,
-            'count': len(popular_items),
-            'timestamp': datetime.now(timezone.utc).isoformat()
-        })
+        with timed_stage('json_serialization'):
+            return jsonify({
+                'popular_items': popular_items,
+                'count': len(popular_items),
+                'category': category,
+                'ranking': ranking,
+                'timestamp': datetime.now(timezone.utc).isoformat()
+            })
         
     except Exception as e:
         logger.error(f"人気商品取得エラー: {str(e)}")
@@ -382,52 +2288,20 @@ def user_profile():
                 'error': 'user_idパラメータが必要です'
             }), 400
         
-        # ユーザー情報取得
-        user_query = f"""
-        SELECT user_id, age, gender, city, registration_date
-        FROM `{PROJECT_ID}.{DATASET_ID}.users`
-        WHERE user_id = {user_id}
-        LIMIT 1
-        """
-        
-        user_result = recommend_api.bq_client.query(user_query).to_dataframe()
+        # ユーザー単位の短期キャッシュ（存在しないユーザーも含む）
+        cached = user_profile_cache.get(user_id, default=False)
+        if cached is False:
+            cached = fetch_user_profile(user_id)
+            user_profile_cache.set(user_id, cached)
         
-        if len(user_result) == 0:
+        if cached is None:
             return jsonify({
                 'error': 'ユーザーが見つかりません',
                 'user_id': user_id
             }), 404
         
-        # 購入履歴取得
-        purchase_query = f"""
-        SELECT 
-            t.product_id,
-            p.product_name,
-            p.category,
-            SUM(t.quantity) as total_quantity,
-            AVG(t.price) as avg_price,
-            COUNT(*) as purchase_count,
-            MAX(t.timestamp) as last_purchase
-        FROM `{PROJECT_ID}.{DATASET_ID}.transactions` t
-        LEFT JOIN `{PROJECT_ID}.{DATASET_ID}.products` p ON t.product_id = p.product_id
-        WHERE t.user_id = {user_id}
-        GROUP BY t.product_id, p.product_name, p.category
-        ORDER BY purchase_count DESC, last_purchase DESC
-        LIMIT 10
-        """
-        
-        purchase_result = recommend_api.bq_client.query(purchase_query).to_dataframe()
-        
-        user_info = user_result.iloc[0].to_dict()
-        purchase_history = purchase_result.to_dict('records') if len(purchase_result) > 0 else []
-        
         return jsonify({
-            'user_info': user_info,
-            'purchase_history': purchase_history,
-            'purchase_summary': {
-                'total_products': len(purchase_history),
-                'total_purchases': int(purchase_result['purchase_count'].sum()) if len(purchase_result) > 0 else 0
-            },
+            **cached,
             'timestamp': datetime.now(timezone.utc).isoformat()
         })
         
@@ -442,37 +2316,3 @@ def user_profile():
 if __name__ == '__main__':
     # 開発環境での実行
     app.run(host='127.0.0.1', port=8080, debug=True)
-
-# app-engine/app.yaml
-
-runtime: python39
-
-service: default
-
-basic_scaling:
-  max_instances: 2
-  idle_timeout: 10m
-
-resources:
-  cpu: 1
-  memory_gb: 0.5
-  disk_size_gb: 10
-
-automatic_scaling:
-  min_instances: 0
-  max_instances: 2
-  target_cpu_utilization: 0.6
-
-env_variables:
-  GOOGLE_CLOUD_PROJECT: test-recommend-engine-20250609
-
-# app-engine/requirements.txt
-
-Flask==3.0.0
-google-cloud-bigquery==3.13.0
-google-cloud-storage==2.10.0
-pandas==2.1.4
-numpy==1.24.4
-scikit-learn==1.3.2
-joblib==1.3.2
-gunicorn==21.2.0
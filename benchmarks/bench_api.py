@@ -0,0 +1,267 @@
+# benchmarks/bench_api.py
+
+"""レコメンドAPIのマイクロベンチマーク・負荷テスト
+
+合成モデルとローカルの GCS / BigQuery 代替で app-engine/main.py を動かし、
+各シナリオのスループットと p50 / p95 / p99 レイテンシを計測する。
+
+    python benchmarks/bench_api.py --users 50000 --items 20000 --factors 50 \\
+        --save benchmarks/baselines/local.json
+    python benchmarks/bench_api.py --compare benchmarks/baselines/local.json
+"""
+
+import os
+import sys
+import json
+import time
+import argparse
+import logging
+import platform
+import subprocess
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+
+import numpy as np
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+APP_DIR = os.path.join(BENCH_DIR, '..', 'app-engine')
+sys.path.insert(0, BENCH_DIR)
+
+from fakes import LocalStorageClient, FakeBigQueryClient, build_synthetic_model
+
+logger = logging.getLogger('bench_api')
+
+SCENARIOS = ['score', 'score_batch', 'recommend', 'recommend_cached', 'popular', 'batch']
+
+
+def summarize(latencies, wall_seconds, errors=0):
+    """レイテンシ配列（秒）から統計を作成"""
+    latencies = np.asarray(latencies, dtype=np.float64) * 1000
+    return {
+        'requests': int(len(latencies)),
+        'errors': int(errors),
+        'throughput_rps': round(len(latencies) / wall_seconds, 2) if wall_seconds > 0 else 0.0,
+        'mean_ms': round(float(latencies.mean()), 3) if len(latencies) else 0.0,
+        'p50_ms': round(float(np.percentile(latencies, 50)), 3) if len(latencies) else 0.0,
+        'p95_ms': round(float(np.percentile(latencies, 95)), 3) if len(latencies) else 0.0,
+        'p99_ms': round(float(np.percentile(latencies, 99)), 3) if len(latencies) else 0.0
+    }
+
+
+def run_direct(func, args_list):
+    """関数を直接呼び出して計測（HTTPなし・単一スレッド）"""
+    latencies = []
+    started = time.perf_counter()
+    for args in args_list:
+        t = time.perf_counter()
+        func(*args)
+        latencies.append(time.perf_counter() - t)
+    return summarize(latencies, time.perf_counter() - started)
+
+
+def run_load(app, requests, n_threads):
+    """Flask テストクライアントによるマルチスレッド負荷
+
+    Args:
+        requests: (method, path, json_body) のリスト
+    """
+    latencies = []
+    errors = [0]
+    lock = threading.Lock()
+    local = threading.local()
+    
+    def send(req):
+        client = getattr(local, 'client', None)
+        if client is None:
+            client = local.client = app.test_client()
+        method, path, body = req
+        t = time.perf_counter()
+        response = client.post(path, json=body) if method == 'POST' else client.get(path)
+        elapsed = time.perf_counter() - t
+        with lock:
+            latencies.append(elapsed)
+            if response.status_code != 200:
+                errors[0] += 1
+    
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=n_threads) as executor:
+        list(executor.map(send, requests))
+    return summarize(latencies, time.perf_counter() - started, errors[0])
+
+
+def git_commit():
+    """現在のコミットID（取得できない場合は None）"""
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', '--short', 'HEAD'], cwd=BENCH_DIR, stderr=subprocess.DEVNULL
+        ).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def incompatible_baseline(report, baseline):
+    """比較できないベースラインの理由（比較できる場合は None）
+
+    ANN の有無が異なると類似ユーザー検索の方式が異なるため比較しない。
+    """
+    current_ann = report['model']['ann']
+    baseline_ann = baseline.get('model', {}).get('ann')
+    if baseline_ann != current_ann:
+        return f"ANN インデックスの有無が異なります（ベースライン: {baseline_ann}, 今回: {current_ann}）"
+    return None
+
+
+def compare(results, baseline, tolerance):
+    """ベースラインと比較し、劣化したシナリオの一覧を返す"""
+    regressions = []
+    print(f"\n{'scenario':<18}{'p95 base':>12}{'p95 now':>12}{'ratio':>8}{'rps base':>12}{'rps now':>12}")
+    for name, current in results.items():
+        base = baseline.get('results', {}).get(name)
+        if base is None:
+            continue
+        p95_ratio = current['p95_ms'] / base['p95_ms'] if base['p95_ms'] else 1.0
+        rps_ratio = current['throughput_rps'] / base['throughput_rps'] if base['throughput_rps'] else 1.0
+        flag = ''
+        if p95_ratio > 1 + tolerance or rps_ratio < 1 - tolerance:
+            regressions.append(name)
+            flag = '  <-- regression'
+        print(f"{name:<18}{base['p95_ms']:>12.3f}{current['p95_ms']:>12.3f}{p95_ratio:>8.2f}"
+              f"{base['throughput_rps']:>12.1f}{current['throughput_rps']:>12.1f}{flag}")
+    return regressions
+
+
+def parse_args(argv=None):
+    """コマンドライン引数解析"""
+    parser = argparse.ArgumentParser(description="レコメンドAPIベンチマーク")
+    parser.add_argument('--users', type=int, default=20000, help="合成モデルのユーザー数")
+    parser.add_argument('--items', type=int, default=5000, help="合成モデルのアイテム数")
+    parser.add_argument('--factors', type=int, default=50, help="ユーザー特徴量の次元数")
+    parser.add_argument('--nnz-per-user', type=int, default=20, help="ユーザーあたりの購入アイテム数")
+    parser.add_argument('--no-ann', action='store_true', help="ANNインデックスなしで生成（厳密検索）")
+    parser.add_argument('--requests', type=int, default=2000, help="シナリオごとのリクエスト数")
+    parser.add_argument('--threads', type=int, default=8, help="負荷生成スレッド数")
+    parser.add_argument('--batch-size', type=int, default=500, help="バッチシナリオの1リクエストのユーザー数")
+    parser.add_argument('--bq-latency-ms', type=float, default=0.0, help="BigQuery代替の応答遅延（ミリ秒）")
+    parser.add_argument('--scenarios', default=','.join(SCENARIOS), help="実行するシナリオ（カンマ区切り）")
+    parser.add_argument('--save', help="結果を保存するJSONパス（ベースライン）")
+    parser.add_argument('--compare', help="比較するベースラインJSON")
+    parser.add_argument('--tolerance', type=float, default=0.2,
+                        help="劣化とみなす p95 増加率 / スループット低下率")
+    parser.add_argument('--seed', type=int, default=42)
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    logging.basicConfig(level=logging.WARNING)
+    scenarios = [s for s in args.scenarios.split(',') if s]
+    rng = np.random.default_rng(args.seed)
+    
+    workdir = tempfile.mkdtemp(prefix='recommend-bench-')
+    bucket_root = os.path.join(workdir, 'bucket')
+    os.makedirs(os.path.join(bucket_root, 'models/recommend_model'))
+    
+    started = time.perf_counter()
+    manifest, products, users = build_synthetic_model(
+        bucket_root, args.users, args.items, args.factors,
+        nnz_per_user=args.nnz_per_user, ann=not args.no_ann, seed=args.seed
+    )
+    build_seconds = time.perf_counter() - started
+    print(f"合成モデル生成: users={args.users}, items={args.items}, factors={args.factors} "
+          f"({build_seconds:.1f}秒)")
+    
+    # API読み込み前に設定（バックグラウンド更新なし・キャッシュは一時ディレクトリ）
+    os.environ['MODEL_CACHE_DIR'] = os.path.join(workdir, 'cache')
+    os.environ['MODEL_REFRESH_INTERVAL_SECONDS'] = '0'
+    sys.path.insert(0, APP_DIR)
+    import main as api
+    
+    api.recommend_api._storage_client = LocalStorageClient(bucket_root)
+    api.recommend_api._bq_client = FakeBigQueryClient(
+        products, users, latency_seconds=args.bq_latency_ms / 1000
+    )
+    
+    started = time.perf_counter()
+    state = api.warm_up()
+    print(f"ウォームアップ: {time.perf_counter() - started:.2f}秒 {state['timings']}")
+    
+    model = api.recommend_api.model
+    user_ids = [int(u) for u in model['user_ids']]
+    sample = [user_ids[i] for i in rng.integers(0, len(user_ids), args.requests)]
+    
+    results = {}
+    for name in scenarios:
+        api.recommendation_cache.clear()
+        if name == 'score':
+            # 1ユーザーのスコアリング（HTTP・商品情報なし）
+            results[name] = run_direct(api.recommend_api.get_recommendations, [(u, 10) for u in sample])
+        elif name == 'score_batch':
+            # 行列演算による一括スコアリング
+            n_batches = max(1, args.requests // args.batch_size)
+            batches = [(sample[i::n_batches], 10) for i in range(n_batches)]
+            results[name] = run_direct(api.recommend_api.get_batch_recommendations, batches)
+        elif name == 'recommend':
+            results[name] = run_load(api.app, [
+                ('GET', f'/recommend?user_id={u}&n_recommendations=10', None) for u in sample
+            ], args.threads)
+        elif name == 'recommend_cached':
+            # 少数ユーザーへの繰り返し（レスポンスキャッシュ込み）
+            hot = sample[:max(1, len(sample) // 20)]
+            results[name] = run_load(api.app, [
+                ('GET', f'/recommend?user_id={hot[i % len(hot)]}&n_recommendations=10', None)
+                for i in range(args.requests)
+            ], args.threads)
+        elif name == 'popular':
+            results[name] = run_load(api.app, [
+                ('GET', f'/popular?n_items={1 + i % 50}', None) for i in range(args.requests)
+            ], args.threads)
+        elif name == 'batch':
+            n_batches = max(1, args.requests // args.batch_size)
+            results[name] = run_load(api.app, [
+                ('POST', '/recommend/batch', {'user_ids': sample[i::n_batches], 'n_recommendations': 10})
+                for i in range(n_batches)
+            ], args.threads)
+        else:
+            raise ValueError(f"未知のシナリオです: {name}")
+    
+    print(f"\n{'scenario':<18}{'requests':>10}{'errors':>8}{'rps':>10}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}")
+    for name, r in results.items():
+        print(f"{name:<18}{r['requests']:>10}{r['errors']:>8}{r['throughput_rps']:>10.1f}"
+              f"{r['p50_ms']:>10.3f}{r['p95_ms']:>10.3f}{r['p99_ms']:>10.3f}")
+    
+    report = {
+        'commit': git_commit(),
+        'created_at': datetime.now(timezone.utc).isoformat(),
+        'platform': {'python': platform.python_version(), 'machine': platform.machine(),
+                     'cpu_count': os.cpu_count()},
+        'config': {key: value for key, value in vars(args).items() if key not in ('save', 'compare')},
+        'model': {'version': manifest['version'], 'ann': 'ann_centroids' in manifest['files'],
+                  'build_seconds': round(build_seconds, 2)},
+        'startup_timings': state['timings'],
+        'results': results
+    }
+    
+    if args.save:
+        os.makedirs(os.path.dirname(os.path.abspath(args.save)), exist_ok=True)
+        with open(args.save, 'w') as f:
+            json.dump(report, f, indent=2, ensure_ascii=False)
+        print(f"\n結果保存: {args.save}")
+    
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        reason = incompatible_baseline(report, baseline)
+        if reason:
+            print(f"\nベースラインと比較できません: {reason}")
+            return 2
+        regressions = compare(results, baseline, args.tolerance)
+        if regressions:
+            print(f"\n劣化を検出: {', '.join(regressions)}")
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,261 @@
+# benchmarks/fakes.py
+
+"""ベンチマーク用のローカル Cloud Storage / BigQuery 代替と合成モデル生成"""
+
+import os
+import sys
+import json
+import shutil
+import hashlib
+import uuid
+import logging
+from datetime import datetime, timezone
+
+import numpy as np
+import pandas as pd
+
+logger = logging.getLogger(__name__)
+
+TRAINER_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'vertex-ai', 'training')
+
+
+class LocalBlob:
+    """ローカルディレクトリ上のファイルを GCS Blob として扱う"""
+    
+    def __init__(self, root, name):
+        self.root = root
+        self.name = name
+        self.generation = None
+    
+    @property
+    def path(self):
+        return os.path.join(self.root, self.name)
+    
+    def exists(self):
+        return os.path.exists(self.path)
+    
+    def reload(self):
+        self.generation = os.stat(self.path).st_mtime_ns
+    
+    def download_as_bytes(self, **kwargs):
+        with open(self.path, 'rb') as f:
+            return f.read()
+    
+    def download_to_filename(self, filename, **kwargs):
+        shutil.copyfile(self.path, filename)
+    
+    def upload_from_filename(self, filename, **kwargs):
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        shutil.copyfile(filename, self.path)
+
+
+class LocalBucket:
+    """ローカルディレクトリを GCS Bucket として扱う"""
+    
+    def __init__(self, root):
+        self.root = root
+    
+    def blob(self, name):
+        return LocalBlob(self.root, name)
+    
+    def get_blob(self, name):
+        blob = LocalBlob(self.root, name)
+        if not blob.exists():
+            return None
+        blob.reload()
+        return blob
+
+
+class LocalStorageClient:
+    """storage.Client の代替（全バケットが同じローカルディレクトリ）"""
+    
+    def __init__(self, root):
+        self.root = root
+    
+    def bucket(self, name):
+        return LocalBucket(self.root)
+
+
+class FakeRowIterator:
+    """query_and_wait の戻り値の代替"""
+    
+    def __init__(self, df):
+        self._df = df
+    
+    def to_dataframe(self, **kwargs):
+        return self._df.copy()
+
+
+class FakeBigQueryClient:
+    """bigquery.Client の代替
+
+    products / users テーブルを DataFrame で保持し、API が発行するクエリを
+    テーブル名とパラメータから判別して応答する。latency_seconds で
+    BigQuery の往復時間を模擬できる。
+    """
+    
+    def __init__(self, products, users, latency_seconds=0.0):
+        self.products = products
+        self.users = users
+        self.latency_seconds = latency_seconds
+        self.query_count = 0
+    
+    def _parameters(self, job_config):
+        if job_config is None:
+            return {}
+        return {p.name: getattr(p, 'values', getattr(p, 'value', None)) for p in job_config.query_parameters}
+    
+    def query_and_wait(self, query, job_config=None, **kwargs):
+        import time
+        self.query_count += 1
+        if self.latency_seconds:
+            time.sleep(self.latency_seconds)
+        
+        params = self._parameters(job_config)
+        if '.transactions`' in query:
+            return FakeRowIterator(pd.DataFrame(columns=[
+                'product_id', 'product_name', 'category', 'total_quantity',
+                'avg_price', 'purchase_count', 'last_purchase'
+            ]))
+        if '.users`' in query:
+            df = self.users
+            if 'user_id' in params:
+                df = df[df['user_id'] == params['user_id']]
+            return FakeRowIterator(df)
+        if '.products`' in query:
+            df = self.products
+            if 'product_ids' in params:
+                df = df[df['product_id'].isin(params['product_ids'])]
+            return FakeRowIterator(df)
+        raise ValueError(f"未対応のクエリです: {query}")
+
+
+def _sha256(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _build_ann_index(normalized_features):
+    """トレーナーの IVF インデックス構築を利用
+
+    トレーナーを読み込めない場合は ANN なしのモデルを黙って作らず失敗する
+    （厳密検索の結果を ANN のベースラインと比較しないため）。
+    """
+    try:
+        if TRAINER_DIR not in sys.path:
+            sys.path.insert(0, TRAINER_DIR)
+        from trainer import build_ivf_index
+    except ImportError as e:
+        raise RuntimeError(
+            f"ANN インデックスの構築にトレーナーを読み込めません（--no-ann で厳密検索のみ計測できます）: {e}"
+        ) from e
+    return build_ivf_index(normalized_features)
+
+
+def build_synthetic_model(bucket_root, n_users, n_items, n_factors, nnz_per_user=20,
+                          n_categories=20, ann=True, seed=42):
+    """合成モデルアーティファクトをローカルバケットに書き出す
+
+    トレーナーと同じ形式（.npy 配列 + manifest.json + LATEST.json）で、
+    購入はアイテム人気の偏り（Zipf）に従ってサンプリングする。
+
+    Returns:
+        (manifest, products DataFrame, users DataFrame)
+    """
+    rng = np.random.default_rng(seed)
+    version = f"{datetime.now(timezone.utc).strftime('%Y%m%dT%H%M%SZ')}-{uuid.uuid4().hex[:8]}"
+    prefix = f"models/recommend_model/{version}"
+    model_dir = os.path.join(bucket_root, prefix)
+    os.makedirs(model_dir, exist_ok=True)
+    
+    user_ids = np.arange(1, n_users + 1, dtype=np.int64) + 100000
+    item_ids = np.arange(1, n_items + 1, dtype=np.int64) + 200000
+    
+    # 購入行列（CSR）
+    item_weights = 1.0 / np.arange(1, n_items + 1) ** 0.8
+    item_weights /= item_weights.sum()
+    nnz = min(nnz_per_user, n_items)
+    indptr = np.arange(0, n_users * nnz + 1, nnz, dtype=np.int64)
+    indices = np.empty(n_users * nnz, dtype=np.int32)
+    for u in range(n_users):
+        indices[u * nnz:(u + 1) * nnz] = np.sort(rng.choice(n_items, nnz, replace=False, p=item_weights))
+    data = (rng.integers(1, 4, len(indices)) * np.log1p(rng.uniform(500, 5000, len(indices)))).astype(np.float32)
+    if indptr[-1] < np.iinfo(np.int32).max:
+        indptr = indptr.astype(np.int32)
+    
+    user_features = rng.standard_normal((n_users, n_factors)).astype(np.float32)
+    norms = np.linalg.norm(user_features, axis=1, keepdims=True)
+    normalized = (user_features / np.where(norms == 0, 1.0, norms)).astype(np.float32)
+    
+    popularity = np.bincount(indices, weights=data, minlength=n_items).astype(np.float32)
+    decayed = (popularity * rng.uniform(0.2, 1.0, n_items)).astype(np.float32)
+    category_codes = rng.integers(0, n_categories, n_items).astype(np.int32)
+    categories = [f"category_{i:02d}" for i in range(n_categories)]
+    
+    arrays = {
+        'user_ids': user_ids,
+        'item_ids': item_ids,
+        'user_features': user_features,
+        'normalized_user_features': normalized,
+        'matrix_indptr': indptr,
+        'matrix_indices': indices,
+        'matrix_data': data,
+        'popularity_scores': popularity,
+        'popularity_order': np.argsort(-popularity, kind='stable').astype(np.int32),
+        'popularity_decayed_scores': decayed,
+        'popularity_decayed_order': np.argsort(-decayed, kind='stable').astype(np.int32),
+        'item_category_codes': category_codes
+    }
+    ann_index = _build_ann_index(normalized) if ann else None
+    if ann_index is not None:
+        arrays['ann_centroids'] = ann_index['centroids']
+        arrays['ann_list_offsets'] = ann_index['list_offsets']
+        arrays['ann_list_members'] = ann_index['list_members']
+    
+    files = {}
+    for name, array in arrays.items():
+        path = os.path.join(model_dir, f"{name}.npy")
+        np.save(path, np.ascontiguousarray(array))
+        files[name] = {
+            'file': f"{name}.npy",
+            'sha256': _sha256(path),
+            'size': os.path.getsize(path),
+            'dtype': str(array.dtype),
+            'shape': list(array.shape)
+        }
+    
+    manifest = {
+        'format_version': 1,
+        'version': version,
+        'trained_at': datetime.now().isoformat(),
+        'precomputed_at': None,
+        'n_users': n_users,
+        'n_items': n_items,
+        'n_components': n_factors,
+        'ann_n_probe': 8 if ann_index is not None else None,
+        'categories': categories,
+        'files': files
+    }
+    with open(os.path.join(model_dir, 'manifest.json'), 'w') as f:
+        json.dump(manifest, f)
+    with open(os.path.join(bucket_root, 'models/recommend_model/LATEST.json'), 'w') as f:
+        json.dump({'version': version, 'prefix': prefix}, f)
+    
+    products = pd.DataFrame({
+        'product_id': item_ids,
+        'product_name': [f"商品{pid}" for pid in item_ids],
+        'category': [categories[c] for c in category_codes],
+        'price': rng.uniform(500, 5000, n_items).round(0),
+        'brand': [f"ブランド{c % 7}" for c in category_codes]
+    })
+    users = pd.DataFrame({
+        'user_id': user_ids,
+        'age': rng.integers(18, 70, n_users),
+        'gender': rng.choice(['M', 'F'], n_users),
+        'city': rng.choice(['東京', '大阪', '名古屋', '福岡', '札幌'], n_users),
+        'registration_date': '2024-01-01'
+    })
+    return manifest, products, users
@@ -247,12 +247,3 @@ def trigger_dataflow_pipeline():
     except Exception as e:
         logger.error(f"Dataflow起動エラー: {str(e)}")
         return {"status": "error", "message": str(e)}
-
-# cloud-functions/data-ingestion/requirements.txt
-
-functions-framework==3.5.0
-google-cloud-bigquery==3.13.0
-google-cloud-storage==2.10.0
-google-cloud-dataflow-client==0.8.4
-pandas==2.1.4
-pyarrow==14.0.1
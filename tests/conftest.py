@@ -0,0 +1,76 @@
+# tests/conftest.py
+
+"""テスト共通設定
+
+各コンポーネント（API・トレーナー・ベンチマーク用の代替）を import パスに追加し、
+GCS をローカルディレクトリで、BigQuery を利用不可として置き換えるフィクスチャを提供する。
+"""
+
+import os
+import sys
+import tempfile
+
+import pytest
+
+ROOT_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+for component in ('app-engine', os.path.join('vertex-ai', 'training'), 'benchmarks'):
+    sys.path.insert(0, os.path.join(ROOT_DIR, component))
+
+# API は import 時に設定を読むため先に指定（バックグラウンド更新なし・キャッシュは一時ディレクトリ）
+os.environ.setdefault('MODEL_CACHE_DIR', tempfile.mkdtemp(prefix='recommend-test-cache-'))
+os.environ.setdefault('MODEL_REFRESH_INTERVAL_SECONDS', '0')
+
+
+def _no_bigquery(*args, **kwargs):
+    raise RuntimeError("テストでは BigQuery を使用しません")
+
+
+@pytest.fixture
+def bucket_root(tmp_path):
+    """ローカルバケットのルート"""
+    root = tmp_path / 'bucket'
+    (root / 'models' / 'recommend_model').mkdir(parents=True)
+    return root
+
+
+@pytest.fixture
+def trainer(bucket_root, monkeypatch):
+    """GCS をローカルバケットに置き換えたトレーナーモジュール（依存が無い場合はスキップ）"""
+    trainer = pytest.importorskip('trainer', exc_type=ImportError)
+    from fakes import LocalStorageClient
+    monkeypatch.setattr(trainer.storage, 'Client', lambda project=None: LocalStorageClient(str(bucket_root)))
+    monkeypatch.setattr(trainer.bigquery, 'Client', _no_bigquery)
+    return trainer
+
+
+@pytest.fixture
+def api(monkeypatch):
+    """プロセス状態（モデル・起動状態・キャッシュ）を初期化した API モジュール"""
+    import main
+    monkeypatch.setattr(main, 'recommend_api', main.RecommendationAPI())
+    monkeypatch.setattr(main, 'product_catalog', main.ProductCatalog())
+    monkeypatch.setattr(main, 'user_directory', main.UserDirectory())
+    monkeypatch.setattr(main, 'startup_state', dict(
+        main.startup_state, ready=False, status='starting', model=None, error=None, attempts=0, timings={}
+    ))
+    for cache in (main.recommendation_cache, main.ranking_cache, main.user_profile_cache):
+        cache.clear()
+    return main
+
+
+@pytest.fixture
+def synthetic_model(bucket_root):
+    """ローカルバケットに書き出した合成モデル (manifest, products, users)"""
+    from fakes import build_synthetic_model
+    return build_synthetic_model(str(bucket_root), n_users=300, n_items=120, n_factors=8, ann=False)
+
+
+@pytest.fixture
+def loaded_api(api, bucket_root, synthetic_model):
+    """合成モデルを GCS / BigQuery の代替から読み込んだ API モジュール"""
+    from fakes import FakeBigQueryClient, LocalStorageClient
+    _, products, users = synthetic_model
+    api.recommend_api._storage_client = LocalStorageClient(str(bucket_root))
+    api.recommend_api._bq_client = FakeBigQueryClient(products, users)
+    assert api.warm_up()['status'] == 'ready'
+    return api
@@ -0,0 +1,64 @@
+# tests/test_artifact_round_trip.py
+
+"""トレーナーが保存したモデルを API が読み込めること"""
+
+import json
+import os
+
+import pytest
+
+from fakes import LocalStorageClient
+
+
+@pytest.fixture
+def published(trainer, bucket_root, tmp_path):
+    """サンプルデータで学習し、ローカルバケットに公開したモデル (model, manifest)"""
+    model = trainer.RecommendationModel()
+    model.train(df=model.generate_sample_data())
+    local_dir = str(tmp_path / 'recommend_model')
+    manifest = model.save_model(local_dir)
+    trainer.upload_model_artifact(local_dir, manifest)
+    return model, manifest
+
+
+def test_api_loads_published_model_and_matches_trainer(api, bucket_root, published):
+    model, manifest = published
+    api.recommend_api._storage_client = LocalStorageClient(str(bucket_root))
+    
+    assert api.recommend_api.refresh_model()
+    loaded = api.recommend_api.model
+    assert loaded['version'] == manifest['version']
+    
+    model_dir = os.path.join(api.MODEL_CACHE_DIR, manifest['version'])
+    for entry in manifest['files'].values():
+        assert api.file_matches_entry(os.path.join(model_dir, entry['file']), entry)
+    
+    for user_id in list(model.user_mapping)[:20]:
+        expected = model.get_recommendations(user_id, 10)
+        actual = api.recommend_api.get_recommendations(user_id, 10, model=loaded)
+        assert [rec['product_id'] for rec in actual] == [rec['product_id'] for rec in expected]
+        assert [rec['score'] for rec in actual] == pytest.approx([rec['score'] for rec in expected])
+
+
+def test_upload_refuses_published_version(trainer, published, tmp_path):
+    _, manifest = published
+    
+    with pytest.raises(ValueError, match="既に公開"):
+        trainer.upload_model_artifact(str(tmp_path / 'recommend_model'), manifest)
+
+
+def test_api_redownloads_corrupted_cache_file(api, bucket_root, published):
+    _, manifest = published
+    api.recommend_api._storage_client = LocalStorageClient(str(bucket_root))
+    assert api.recommend_api.refresh_model()
+    entry = manifest['files']['user_features']
+    path = os.path.join(api.MODEL_CACHE_DIR, manifest['version'], entry['file'])
+    with open(path, 'r+b') as f:
+        f.seek(-1, os.SEEK_END)
+        f.write(b'\x00' if f.read(1) != b'\x00' else b'\x01')
+    
+    bucket = api.recommend_api.storage_client.bucket(api.BUCKET_NAME)
+    pointer = json.loads(bucket.blob(api.MODEL_POINTER_PATH).download_as_bytes())
+    api.recommend_api.download_model_artifact(bucket, pointer['prefix'], manifest['version'])
+    
+    assert api.file_matches_entry(path, entry)
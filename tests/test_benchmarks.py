@@ -0,0 +1,24 @@
+# tests/test_benchmarks.py
+
+"""ベンチマークの合成モデルとベースライン比較"""
+
+import sys
+
+import pytest
+
+
+def test_ann_model_fails_without_trainer(bucket_root, monkeypatch):
+    import fakes
+    monkeypatch.setitem(sys.modules, 'trainer', None)
+    
+    with pytest.raises(RuntimeError, match='--no-ann'):
+        fakes.build_synthetic_model(str(bucket_root), n_users=50, n_items=20, n_factors=4, ann=True)
+
+
+def test_baseline_with_different_ann_setting_is_not_compared():
+    import bench_api
+    report = {'model': {'ann': False}}
+    
+    assert bench_api.incompatible_baseline(report, {'model': {'ann': False}}) is None
+    assert 'ANN' in bench_api.incompatible_baseline(report, {'model': {'ann': True}})
+    assert 'ANN' in bench_api.incompatible_baseline(report, {})
@@ -0,0 +1,118 @@
+# tests/test_caches.py
+
+"""TTLCache と SingleFlight"""
+
+import threading
+import time
+
+import pytest
+
+
+@pytest.fixture
+def clock(api, monkeypatch):
+    """main が参照する time.monotonic を手動で進める時計"""
+    now = [1000.0]
+    monkeypatch.setattr(api.time, 'monotonic', lambda: now[0])
+    return now
+
+
+def test_ttl_cache_expires_entries(api, clock):
+    cache = api.TTLCache(maxsize=10, ttl_seconds=5)
+    cache.set('a', 1)
+    
+    clock[0] += 4.9
+    assert cache.get('a') == 1
+    clock[0] += 0.2
+    assert cache.get('a', default='missing') == 'missing'
+    assert cache.stats() == {'size': 0, 'hits': 1, 'misses': 1, 'hit_rate': 0.5}
+
+
+def test_ttl_cache_evicts_least_recently_used(api, clock):
+    cache = api.TTLCache(maxsize=2, ttl_seconds=60)
+    cache.set('a', 1)
+    cache.set('b', 2)
+    cache.get('a')
+    cache.set('c', 3)
+    
+    assert cache.get('b') is None
+    assert cache.get('a') == 1
+    assert cache.get('c') == 3
+
+
+def test_ttl_cache_accept_rejects_entry_as_miss(api, clock):
+    cache = api.TTLCache(maxsize=10, ttl_seconds=60)
+    cache.set('user', (5, list(range(5))))
+    
+    assert cache.get('user', accept=lambda entry: entry[0] >= 10) is None
+    assert cache.get('user', accept=lambda entry: entry[0] >= 3) == (5, list(range(5)))
+    assert cache.stats()['misses'] == 1
+
+
+class CountingLock:
+    """取得回数を数えるロック（フォロワーが実行中の呼び出しを見つけたことの確認用）"""
+    
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.acquired = 0
+    
+    def __enter__(self):
+        self._lock.acquire()
+        self.acquired += 1
+        return self
+    
+    def __exit__(self, *exc):
+        self._lock.release()
+
+
+def test_single_flight_shares_one_call(api):
+    flight = api.SingleFlight()
+    flight._lock = CountingLock()
+    release = threading.Event()
+    calls = []
+    
+    def slow():
+        calls.append(1)
+        release.wait(5)
+        return 'result'
+    
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(flight.do('key', slow))) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    # 4スレッドすべてが呼び出しの登録・参照を終えてから実行を完了させる
+    deadline = time.monotonic() + 5
+    while flight._lock.acquired < 4 and time.monotonic() < deadline:
+        time.sleep(0.001)
+    release.set()
+    for thread in threads:
+        thread.join(5)
+    
+    assert len(calls) == 1
+    assert sorted(results) == [('result', False)] + [('result', True)] * 3
+    assert flight._calls == {}
+
+
+def test_single_flight_propagates_errors_and_allows_retry(api):
+    flight = api.SingleFlight()
+    
+    def failing():
+        raise RuntimeError('boom')
+    
+    with pytest.raises(RuntimeError, match='boom'):
+        flight.do('key', failing)
+    assert flight.do('key', lambda: 42) == (42, False)
+
+
+def test_cache_hits_and_misses_are_exported_as_counters(loaded_api):
+    client = loaded_api.app.test_client()
+    for _ in range(2):
+        client.get('/recommend?user_id=100001&n_recommendations=3&include_product_info=false')
+    
+    lines = client.get('/metrics').get_data(as_text=True).splitlines()
+    
+    assert '# TYPE recommend_cache_hits_total counter' in lines
+    assert '# TYPE recommend_cache_misses_total counter' in lines
+    assert '# TYPE recommend_cache_size gauge' in lines
+    assert '# TYPE recommend_cache_hit_rate gauge' in lines
+    assert 'recommend_cache_hits_total{cache="recommend"} 1' in lines
+    assert not any(line.startswith('recommend_cache_hits{') for line in lines)
@@ -0,0 +1,47 @@
+# tests/test_incremental.py
+
+"""フル学習直後のインクリメンタル更新"""
+
+import json
+
+import pytest
+
+
+def run_full_then_incremental(trainer, tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    df = trainer.RecommendationModel().generate_sample_data()
+    base = trainer.run_training(
+        trainer.parse_args(['--snapshot', 'none', '--precompute-workers', '1']), df=df
+    )
+    
+    updated_users = df['user_id'].drop_duplicates().iloc[:5]
+    updated = df[df['user_id'].isin(updated_users)].assign(purchase_count=lambda d: d['purchase_count'] + 1)
+    monkeypatch.setattr(trainer.RecommendationModel, 'load_updated_interactions', lambda self, since: updated)
+    return base, trainer.run_incremental(trainer.parse_args(['--mode', 'incremental', '--precompute-workers', '1']))
+
+
+def test_incremental_right_after_full_train_publishes_new_version(trainer, bucket_root, tmp_path, monkeypatch):
+    base, manifest = run_full_then_incremental(trainer, tmp_path, monkeypatch)
+    
+    assert manifest['version'] != base['version']
+    assert manifest['base_version'] == base['version']
+    pointer = json.loads((bucket_root / 'models' / 'recommend_model' / 'LATEST.json').read_text())
+    assert pointer['version'] == manifest['version']
+    base_manifest = json.loads(
+        (bucket_root / 'models' / 'recommend_model' / base['version'] / 'manifest.json').read_text()
+    )
+    assert base_manifest['files'] == base['files']
+
+
+def test_incremental_refuses_version_equal_to_base(trainer, tmp_path, monkeypatch):
+    monkeypatch.setattr(trainer, 'new_model_version', lambda: '20260101T000000Z')
+    
+    with pytest.raises(ValueError, match="基準版と同じ"):
+        run_full_then_incremental(trainer, tmp_path, monkeypatch)
+
+
+def test_incremental_keeps_precomputed_at_of_rows_it_did_not_recompute(trainer, tmp_path, monkeypatch):
+    base, manifest = run_full_then_incremental(trainer, tmp_path, monkeypatch)
+    
+    assert base['precomputed_at'] is not None
+    assert manifest['precomputed_at'] == base['precomputed_at']
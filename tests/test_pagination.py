@@ -0,0 +1,74 @@
+# tests/test_pagination.py
+
+"""/recommend のカーソルページング"""
+
+import pytest
+
+USER_ID = 100001
+
+
+def fetch_all_pages(client, page_size, query=''):
+    response = client.get(f'/recommend?user_id={USER_ID}&n_recommendations={page_size}'
+                          f'&include_product_info=false&offset=0{query}')
+    pages = [response.get_json()]
+    while pages[-1]['next_cursor']:
+        response = client.get(f'/recommend?user_id={USER_ID}&n_recommendations={page_size}'
+                              f'&include_product_info=false&cursor={pages[-1]["next_cursor"]}{query}')
+        assert response.status_code == 200
+        pages.append(response.get_json())
+    return pages
+
+
+def test_pages_cover_ranking_without_gaps_or_duplicates(loaded_api):
+    client = loaded_api.app.test_client()
+    
+    pages = fetch_all_pages(client, 7)
+    
+    items = [rec['product_id'] for page in pages for rec in page['recommendations']]
+    assert len(items) == pages[0]['total'] > 7
+    assert len(set(items)) == len(items)
+    assert [page['offset'] for page in pages] == list(range(0, len(items), 7))
+    first = client.get(f'/recommend?user_id={USER_ID}&n_recommendations=7&include_product_info=false').get_json()
+    assert [rec['product_id'] for rec in first['recommendations']] == items[:7]
+
+
+def test_cursor_survives_model_swap_while_ranking_is_cached(loaded_api, bucket_root, synthetic_model):
+    from fakes import build_synthetic_model
+    client = loaded_api.app.test_client()
+    first = client.get(f'/recommend?user_id={USER_ID}&n_recommendations=5&include_product_info=false&offset=0')
+    cursor = first.get_json()['next_cursor']
+    
+    build_synthetic_model(str(bucket_root), n_users=300, n_items=120, n_factors=8, ann=False, seed=7)
+    assert loaded_api.recommend_api.refresh_model()
+    
+    response = client.get(f'/recommend?user_id={USER_ID}&n_recommendations=5&include_product_info=false'
+                          f'&cursor={cursor}')
+    assert response.status_code == 200
+    assert response.get_json()['model_version'] == first.get_json()['model_version']
+    
+    loaded_api.ranking_cache.clear()
+    expired = client.get(f'/recommend?user_id={USER_ID}&n_recommendations=5&include_product_info=false'
+                         f'&cursor={cursor}')
+    assert expired.status_code == 410
+
+
+@pytest.mark.parametrize('query', [
+    '&cursor=not-a-cursor',
+    '&offset=abc',
+    '&offset=-1',
+])
+def test_invalid_paging_parameters_are_rejected(loaded_api, query):
+    response = loaded_api.app.test_client().get(f'/recommend?user_id={USER_ID}&n_recommendations=5{query}')
+    assert response.status_code == 400
+
+
+def test_cursor_is_bound_to_user_and_filters(loaded_api):
+    client = loaded_api.app.test_client()
+    cursor = client.get(f'/recommend?user_id={USER_ID}&n_recommendations=5&offset=0'
+                        f'&include_product_info=false').get_json()['next_cursor']
+    
+    other_user = client.get(f'/recommend?user_id={USER_ID + 1}&n_recommendations=5&cursor={cursor}')
+    other_filter = client.get(f'/recommend?user_id={USER_ID}&n_recommendations=5&cursor={cursor}&exclude=200001')
+    
+    assert other_user.status_code == 400
+    assert other_filter.status_code == 400
@@ -0,0 +1,71 @@
+# tests/test_request_validation.py
+
+"""リクエストパラメータの検証"""
+
+import pytest
+
+
+@pytest.mark.parametrize('value, expected', [
+    (True, True), (False, False), ('true', True), ('FALSE', False),
+])
+def test_parse_bool_flag_accepts_booleans_and_strings(api, value, expected):
+    assert api.parse_bool_flag(value, 'flag') == (expected, None)
+
+
+@pytest.mark.parametrize('value', ['0', 'yes', '', 1, 0, None, []])
+def test_parse_bool_flag_rejects_other_values(api, value):
+    flag, error = api.parse_bool_flag(value, 'flag')
+    assert flag is None
+    assert 'flag' in error
+
+
+def test_batch_string_false_skips_product_info(loaded_api):
+    response = loaded_api.app.test_client().post('/recommend/batch', json={
+        'user_ids': [100001], 'n_recommendations': 3, 'include_product_info': 'false'
+    })
+    assert response.status_code == 200
+    recommendations = response.get_json()['results'][0]['recommendations']
+    assert recommendations and all('product_info' not in rec for rec in recommendations)
+
+
+@pytest.mark.parametrize('body', [
+    {'user_ids': [100001], 'include_product_info': 'no'},
+    {'user_ids': [100001], 'include_product_info': 0},
+    {'user_ids': [100001], 'n_recommendations': True},
+    {'user_ids': [True]},
+])
+def test_batch_rejects_invalid_types(loaded_api, body):
+    assert loaded_api.app.test_client().post('/recommend/batch', json=body).status_code == 400
+
+
+def test_recommend_rejects_invalid_flag(loaded_api):
+    client = loaded_api.app.test_client()
+    assert client.get('/recommend?user_id=100001&include_product_info=maybe').status_code == 400
+    response = client.get('/recommend?user_id=100001&n_recommendations=3&include_product_info=false')
+    assert response.status_code == 200
+    assert all('product_info' not in rec for rec in response.get_json()['recommendations'])
+
+
+def test_popular_rejects_invalid_flag(loaded_api):
+    client = loaded_api.app.test_client()
+    assert client.get('/popular?n_items=3&include_product_info=1').status_code == 400
+    response = client.get('/popular?n_items=3&include_product_info=FALSE')
+    assert response.status_code == 200
+    assert all('product_info' not in item for item in response.get_json()['popular_items'])
+
+
+def test_batch_scores_duplicate_users_once(loaded_api, monkeypatch):
+    scored = []
+    score_user_block = loaded_api.score_user_block
+    
+    def spy(normalized_features, user_item_matrix, user_idxs, *args, **kwargs):
+        scored.extend(user_idxs.tolist())
+        return score_user_block(normalized_features, user_item_matrix, user_idxs, *args, **kwargs)
+    
+    monkeypatch.setattr(loaded_api, 'score_user_block', spy)
+    monkeypatch.setattr(loaded_api.recommend_api, 'get_precomputed_recommendations', lambda *args, **kwargs: None)
+    
+    results = loaded_api.recommend_api.get_batch_recommendations([100001, 100002, 100001], 3)
+    
+    assert len(scored) == len(set(scored)) == 2
+    assert set(results) == {100001, 100002}
@@ -0,0 +1,104 @@
+# tests/test_scoring.py
+
+"""API のスコアリング関数"""
+
+import numpy as np
+import pytest
+from scipy import sparse
+
+
+def brute_force_neighbors(normalized, user_idxs, k):
+    similarities = normalized[user_idxs] @ normalized.T
+    similarities[np.arange(len(user_idxs)), user_idxs] = -np.inf
+    return np.sort(np.argsort(-similarities, axis=1, kind='stable')[:, :k], axis=1)
+
+
+@pytest.fixture
+def features():
+    rng = np.random.default_rng(0)
+    return rng.standard_normal((257, 12)).astype(np.float32)
+
+
+@pytest.mark.parametrize('chunk_size', [1, 5, 64, 256, 10000])
+def test_top_similar_users_block_matches_brute_force(api, features, chunk_size):
+    normalized = api.normalize_rows(features)
+    user_idxs = np.array([0, 3, 64, 255, 256])
+    
+    neighbors, similarities = api.top_similar_users_block(normalized, user_idxs, 9, chunk_size=chunk_size)
+    
+    assert neighbors.shape == (5, 9)
+    np.testing.assert_array_equal(np.sort(neighbors, axis=1), brute_force_neighbors(normalized, user_idxs, 9))
+    np.testing.assert_allclose(
+        similarities, np.einsum('ij,ikj->ik', normalized[user_idxs], normalized[neighbors]), rtol=1e-5
+    )
+
+
+def test_score_user_block_does_not_depend_on_chunk_size(api, features, monkeypatch):
+    rng = np.random.default_rng(1)
+    normalized = api.normalize_rows(features)
+    matrix = sparse.random(257, 40, density=0.1, random_state=2, format='csr', dtype=np.float32)
+    matrix.data = rng.uniform(1, 5, matrix.nnz).astype(np.float32)
+    user_idxs = np.arange(0, 257, 16)
+    
+    expected = api.score_user_block(normalized, matrix, user_idxs, 10, n_neighbors=6)
+    monkeypatch.setattr(api.top_similar_users_block, '__defaults__', (7,))
+    items, scores = api.score_user_block(normalized, matrix, user_idxs, 10, n_neighbors=6)
+    
+    np.testing.assert_array_equal(items, expected[0])
+    np.testing.assert_allclose(scores, expected[1], rtol=1e-5)
+
+
+def brute_force_top(item_scores, candidates, n):
+    items, scores = [], []
+    for row_scores, row_candidates in zip(item_scores, candidates):
+        allowed = np.flatnonzero(row_candidates)
+        order = allowed[np.argsort(-row_scores[allowed], kind='stable')][:n]
+        items.append(np.pad(order, (0, n - len(order)), constant_values=-1))
+        scores.append(np.pad(row_scores[order].astype(np.float32), (0, n - len(order)), constant_values=np.nan))
+    return np.array(items), np.array(scores)
+
+
+@pytest.fixture
+def purchases():
+    rng = np.random.default_rng(3)
+    matrix = sparse.random(30, 25, density=0.2, random_state=4, format='csr', dtype=np.float32)
+    matrix.data = rng.uniform(1, 5, matrix.nnz).astype(np.float32)
+    return matrix
+
+
+def test_top_n_items_pads_missing_candidates(api):
+    item_scores = np.array([[0.1, 0.9, 0.5, 0.3], [1.0, 2.0, 3.0, 4.0]])
+    candidates = np.array([[True, False, True, True], [False, False, True, False]])
+    
+    items, scores = api.top_n_items(item_scores, candidates, 3)
+    
+    np.testing.assert_array_equal(items, [[2, 3, 0], [2, -1, -1]])
+    np.testing.assert_allclose(scores, [[0.5, 0.3, 0.1], [3.0, np.nan, np.nan]])
+
+
+def test_score_user_factors_matches_brute_force(api, purchases):
+    rng = np.random.default_rng(5)
+    user_factors = rng.standard_normal((30, 4)).astype(np.float32)
+    item_factors = rng.standard_normal((25, 4)).astype(np.float32)
+    item_filter = rng.random(25) < 0.7
+    user_idxs = np.array([0, 7, 29])
+    
+    items, scores = api.score_user_factors(user_factors, item_factors, purchases, user_idxs, 5, item_filter)
+    
+    candidates = (purchases[user_idxs].toarray() == 0) & item_filter
+    expected = brute_force_top(user_factors[user_idxs] @ item_factors.T, candidates, 5)
+    np.testing.assert_array_equal(items, expected[0])
+    np.testing.assert_allclose(scores, expected[1], rtol=1e-5)
+
+
+def test_score_items_by_similarity_matches_brute_force(api, purchases):
+    similarity = sparse.random(25, 25, density=0.3, random_state=6, format='csr', dtype=np.float32)
+    user_idxs = np.array([1, 2, 15])
+    
+    items, scores = api.score_items_by_similarity(purchases, similarity, user_idxs, 6)
+    
+    item_scores = (purchases[user_idxs] @ similarity).toarray()
+    candidates = (item_scores != 0) & (purchases[user_idxs].toarray() == 0)
+    expected = brute_force_top(item_scores, candidates, 6)
+    np.testing.assert_array_equal(items, expected[0])
+    np.testing.assert_allclose(scores, expected[1], rtol=1e-5)
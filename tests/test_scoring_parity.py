@@ -0,0 +1,86 @@
+# tests/test_scoring_parity.py
+
+"""API とトレーナーのスコアリング関数の一致
+
+App Engine とトレーニングジョブはそれぞれのディレクトリのみをデプロイするため、
+スコアリング関数は両方に同じ実装を持つ。事前計算（トレーナー）とリクエスト時の
+計算（API）で推薦が食い違わないよう、同じ入力に同じ結果を返すことを確認する。
+"""
+
+import numpy as np
+import pytest
+from scipy import sparse
+
+import main as api
+
+N_USERS, N_ITEMS, N_FACTORS = 200, 80, 8
+
+
+@pytest.fixture
+def inputs():
+    rng = np.random.default_rng(3)
+    purchases = sparse.random(N_USERS, N_ITEMS, density=0.08, format='csr', random_state=3, dtype=np.float32)
+    purchases.data += 0.5
+    similarity = sparse.random(N_ITEMS, N_ITEMS, density=0.1, format='csr', random_state=4, dtype=np.float32)
+    return {
+        'features': rng.standard_normal((N_USERS, N_FACTORS)).astype(np.float32),
+        'item_factors': rng.standard_normal((N_ITEMS, N_FACTORS)).astype(np.float32),
+        'purchases': purchases,
+        'similarity': similarity,
+        'user_idxs': np.array([0, 5, 17, 100, 199]),
+    }
+
+
+def assert_same_result(actual, expected):
+    for a, e in zip(actual, expected):
+        np.testing.assert_array_equal(a, e)
+
+
+def test_top_n_items(trainer, inputs):
+    rng = np.random.default_rng(0)
+    item_scores = rng.standard_normal((6, N_ITEMS))
+    candidates = rng.random((6, N_ITEMS)) < 0.1
+    
+    for n in (0, 5, N_ITEMS + 10):
+        assert_same_result(api.top_n_items(item_scores, candidates, n),
+                           trainer.top_n_items(item_scores, candidates, n))
+
+
+def test_normalize_rows(trainer, inputs):
+    features = inputs['features'].copy()
+    features[3] = 0
+    
+    np.testing.assert_array_equal(api.normalize_rows(features), trainer.normalize_rows(features))
+
+
+def test_similar_user_search(trainer, inputs):
+    normalized = api.normalize_rows(inputs['features'])
+    ann_index = trainer.build_ivf_index(normalized, n_lists=8)
+    
+    for user_idx in inputs['user_idxs']:
+        query = normalized[user_idx]
+        assert_same_result(
+            api.search_similar_users_exact(query, normalized, 10, exclude=user_idx),
+            trainer.search_similar_users_exact(query, normalized, 10, exclude=user_idx)
+        )
+        assert_same_result(
+            api.search_similar_users_ivf(query, normalized, ann_index, 10, 3, exclude=user_idx),
+            trainer.search_similar_users_ivf(query, normalized, ann_index, 10, 3, exclude=user_idx)
+        )
+    assert_same_result(
+        api.top_similar_users_block(normalized, inputs['user_idxs'], 10, chunk_size=64),
+        trainer.top_similar_users_block(normalized, inputs['user_idxs'], 10, chunk_size=64)
+    )
+
+
+def test_item_and_factor_scoring(trainer, inputs):
+    purchases, user_idxs = inputs['purchases'], inputs['user_idxs']
+    
+    assert_same_result(
+        api.score_items_by_similarity(purchases, inputs['similarity'], user_idxs, 10),
+        trainer.score_items_by_similarity(purchases, inputs['similarity'], user_idxs, 10)
+    )
+    assert_same_result(
+        api.score_user_factors(inputs['features'], inputs['item_factors'], purchases, user_idxs, 10),
+        trainer.score_user_factors(inputs['features'], inputs['item_factors'], purchases, user_idxs, 10)
+    )
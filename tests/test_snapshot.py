@@ -0,0 +1,54 @@
+# tests/test_snapshot.py
+
+"""取引スナップショットの差分取得"""
+
+from datetime import datetime, timedelta, timezone
+
+import pytest
+
+NOW = datetime(2026, 10, 10, 12, tzinfo=timezone.utc)
+
+
+@pytest.fixture
+def daily_batches(trainer):
+    """day ごとに1行ずつの日別集計を返す fetch 関数"""
+    pa = pytest.importorskip('pyarrow')
+    
+    def fetch(start):
+        days = [start.date() + timedelta(days=i) for i in range((NOW.date() - start.date()).days + 1)]
+        yield pa.RecordBatch.from_pydict({
+            'day': pa.array(days, pa.date32()),
+            'user_id': [1001] * len(days),
+            'product_id': [2001 + i % 3 for i in range(len(days))],
+            'sum_quantity': [1.0] * len(days),
+            'sum_price': [100.0] * len(days),
+            'price_count': [1] * len(days),
+            'purchase_count': [1] * len(days),
+            'last_purchase': pa.array(
+                [datetime(d.year, d.month, d.day, tzinfo=timezone.utc) for d in days],
+                pa.timestamp('us', tz='UTC')
+            )
+        })
+    return fetch
+
+
+def test_refresh_drops_expired_partition_with_leftover_files(trainer, daily_batches, tmp_path):
+    snapshot = trainer.TransactionSnapshot(str(tmp_path))
+    snapshot.load()
+    snapshot.refresh(daily_batches, NOW)
+    oldest = min(snapshot.partitions)
+    # 中断した書き込みの一時ファイル
+    (tmp_path / f"day={oldest}" / 'data.parquet.tmp').write_bytes(b'partial')
+    
+    snapshot = trainer.TransactionSnapshot(str(tmp_path))
+    snapshot.load()
+    summary = snapshot.refresh(daily_batches, NOW + timedelta(days=1))
+    
+    assert summary['dropped_days'] == 1
+    assert oldest not in snapshot.partitions
+    assert not (tmp_path / f"day={oldest}").exists()
+    assert summary['fetched_from'] == '2026-10-09'
+
+
+def test_snapshot_is_disabled_by_default(trainer):
+    assert trainer.parse_args([]).snapshot == 'none'
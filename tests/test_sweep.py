@@ -0,0 +1,49 @@
+# tests/test_sweep.py
+
+"""ハイパーパラメータ探索で公開したモデル"""
+
+import json
+from datetime import datetime
+from unittest import mock
+
+import pandas as pd
+
+
+def run_sweep(trainer, tmp_path, monkeypatch, *extra_args):
+    monkeypatch.chdir(tmp_path)
+    client = mock.MagicMock()
+    client.query.return_value.to_dataframe.return_value = pd.DataFrame()
+    monkeypatch.setattr(trainer.bigquery, 'Client', lambda *args, **kwargs: client)
+    return trainer.run_sweep(trainer.parse_args([
+        '--mode', 'sweep', '--snapshot', 'none', '--sweep-components', '4,8', '--sweep-neighbors', '5',
+        '--sweep-price-weights', '1.0', '--sweep-workers', '1', '--sweep-latency-sample', '10',
+        '--precompute-workers', '1', '--no-ann', *extra_args
+    ]))
+
+
+def test_sweep_winner_records_data_through(trainer, bucket_root, tmp_path, monkeypatch):
+    started = datetime.now().astimezone()
+    run_sweep(trainer, tmp_path, monkeypatch)
+    
+    pointer = json.loads((bucket_root / 'models' / 'recommend_model' / 'LATEST.json').read_text())
+    manifest = json.loads((bucket_root / pointer['prefix'] / 'manifest.json').read_text())
+    assert manifest['data_through'] is not None
+    assert datetime.fromisoformat(manifest['data_through']) >= started
+
+
+def test_item_item_sweep_does_not_fit_factors_per_config(trainer, tmp_path, monkeypatch):
+    fit_svd = trainer.RecommendationModel.fit_svd
+    fitted = []
+    
+    def spy(self, n_components, *args, **kwargs):
+        fitted.append(n_components)
+        return fit_svd(self, n_components, *args, **kwargs)
+    
+    monkeypatch.setattr(trainer.RecommendationModel, 'fit_svd', spy)
+    run_sweep(trainer, tmp_path, monkeypatch, '--algorithm', 'item_item', '--sweep-neighbors', '5,10',
+              '--n-components', '6')
+    
+    sweep = json.loads((tmp_path / 'sweep.json').read_text())
+    assert [(r['n_components'], r['n_neighbors']) for r in sorted(sweep['results'], key=lambda r: r['n_neighbors'])] \
+        == [(6, 5), (6, 10)]
+    assert fitted == [6]
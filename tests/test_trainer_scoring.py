@@ -0,0 +1,51 @@
+# tests/test_trainer_scoring.py
+
+"""トレーナーの事前計算スコアリング"""
+
+import numpy as np
+
+
+def fit_sample_model(trainer):
+    model = trainer.RecommendationModel()
+    model.train(df=model.generate_sample_data(), n_components=8)
+    return model
+
+
+def test_precompute_does_not_depend_on_similarity_chunk_size(trainer, monkeypatch):
+    model = fit_sample_model(trainer)
+    model.precompute_recommendations(top_n=10, block_size=16, n_workers=1)
+    expected_items, expected_scores = model.precomputed_items, model.precomputed_scores
+    
+    monkeypatch.setattr(trainer.top_similar_users_block, '__defaults__', (7,))
+    model.precompute_recommendations(top_n=10, block_size=16, n_workers=1)
+    
+    np.testing.assert_array_equal(model.precomputed_items, expected_items)
+    np.testing.assert_allclose(model.precomputed_scores, expected_scores, rtol=1e-5)
+
+
+def test_top_similar_users_block_matches_brute_force(trainer):
+    normalized = trainer.normalize_rows(np.random.default_rng(0).standard_normal((100, 6)))
+    user_idxs = np.array([0, 1, 50, 99])
+    
+    neighbors, _ = trainer.top_similar_users_block(normalized, user_idxs, 5, chunk_size=3)
+    
+    similarities = normalized[user_idxs] @ normalized.T
+    similarities[np.arange(4), user_idxs] = -np.inf
+    np.testing.assert_array_equal(np.sort(neighbors, axis=1), np.sort(np.argsort(-similarities, axis=1)[:, :5], axis=1))
+
+
+def test_ann_recall_is_measured_at_10_regardless_of_n_neighbors(trainer, monkeypatch):
+    model = fit_sample_model(trainer)
+    model.n_neighbors = 20
+    searched_k = set()
+    search = trainer.search_similar_users_exact
+    
+    def spy(query, normalized_features, k, exclude=None):
+        searched_k.add(k)
+        return search(query, normalized_features, k, exclude=exclude)
+    
+    monkeypatch.setattr(trainer, 'search_similar_users_exact', spy)
+    model.build_ann_index(n_lists=4, recall_sample_size=20)
+    
+    assert searched_k == {trainer.ANN_RECALL_K} == {10}
+    assert all(0.0 <= recall <= 1.0 for recall in model.ann_recall.values())
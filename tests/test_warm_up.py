@@ -0,0 +1,49 @@
+# tests/test_warm_up.py
+
+"""起動時のウォームアップと /health"""
+
+from google.cloud import storage
+
+
+def test_client_failure_is_recorded_and_retried(api, bucket_root, synthetic_model, monkeypatch):
+    from fakes import FakeBigQueryClient, LocalStorageClient
+    
+    def broken_client(*args, **kwargs):
+        raise RuntimeError("認証情報がありません")
+    monkeypatch.setattr(storage, 'Client', broken_client)
+    
+    state = api.warm_up()
+    assert state['ready'] is False
+    assert state['status'] == 'failed'
+    assert "認証情報" in state['error']
+    response = api.app.test_client().get('/health')
+    assert response.status_code == 503
+    assert response.get_json()['status'] == 'failed'
+    assert api.app.test_client().get('/_ah/warmup').status_code == 500
+    
+    _, products, users = synthetic_model
+    monkeypatch.setattr(storage, 'Client', lambda project=None: LocalStorageClient(str(bucket_root)))
+    api.recommend_api._bq_client = FakeBigQueryClient(products, users)
+    state = api.warm_up()
+    assert state['ready'] is True
+    assert state['status'] == 'ready'
+    assert state['attempts'] == 3
+    response = api.app.test_client().get('/health')
+    assert response.status_code == 200
+    assert response.get_json()['status'] == 'healthy'
+
+
+def test_dummy_model_reports_degraded(api, bucket_root, synthetic_model):
+    from fakes import FakeBigQueryClient, LocalStorageClient
+    _, products, users = synthetic_model
+    (bucket_root / 'models' / 'recommend_model' / 'LATEST.json').unlink()
+    api.recommend_api._storage_client = LocalStorageClient(str(bucket_root))
+    api.recommend_api._bq_client = FakeBigQueryClient(products, users)
+    
+    state = api.warm_up()
+    assert state['status'] == 'degraded'
+    assert state['model'] == 'dummy'
+    body = api.app.test_client().get('/health').get_json()
+    assert body['status'] == 'degraded'
+    assert body['model_status'] == 'dummy'
+    assert 'recommend_degraded 1' in api.app.test_client().get('/metrics').get_data(as_text=True)
@@ -1,18 +1,31 @@
 # vertex-ai/training/trainer.py
 
 import os
+import time
+import resource
 import logging
+import argparse
+import tempfile
+import shutil
+import tracemalloc
+from contextlib import contextmanager
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+import glob
 import pandas as pd
 import numpy as np
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
+from scipy import sparse
 from sklearn.decomposition import TruncatedSVD
-from sklearn.metrics.pairwise import cosine_similarity
 from sklearn.preprocessing import StandardScaler
+from threadpoolctl import threadpool_limits
 from google.cloud import bigquery
 from google.cloud import storage
-from google.cloud import aiplatform
-import joblib
+import hashlib
 import json
-from datetime import datetime
+import uuid
+from datetime import datetime, timedelta, timezone
 
 # ログ設定
 logging.basicConfig(level=logging.INFO)
@@ -24,76 +37,1430 @@ DATASET_ID = "recommend_data"
 BUCKET_NAME = f"{PROJECT_ID}-data-lake"
 MODEL_DIR = "models"
 
+# モデルアーティファクト（バージョンごとのディレクトリ + LATEST.json ポインタ）
+MODEL_ARTIFACT_PREFIX = f"{MODEL_DIR}/recommend_model"
+MODEL_FORMAT_VERSION = 1
+
+# モデル設定（SVD次元数・類似ユーザー数・購入スコアの価格の重み）
+N_COMPONENTS = 50
+N_NEIGHBORS = 10
+PRICE_WEIGHT = 1.0
+
+# 事前計算（バッチスコアリング）設定
+PRECOMPUTE_TOP_N = 50
+PRECOMPUTE_BLOCK_SIZE = 512
+# 類似ユーザー検索で一度に類似度を計算するユーザー数（一時メモリは ブロック × この値）
+SIMILARITY_CHUNK_SIZE = 16384
+
+# 近似最近傍（IVF）インデックス設定
+ANN_N_PROBE = 8
+ANN_KMEANS_ITERATIONS = 20
+ANN_RECALL_SAMPLE_SIZE = 1000
+ANN_RECALL_K = 10
+
+# アイテムベース協調フィルタリング設定（アイテムごとの近傍数と類似度計算のブロックサイズ）
+ITEM_NEIGHBORS = 50
+ITEM_SIMILARITY_BLOCK_SIZE = 1024
+
+# 新規ユーザー向けデモグラフィックセグメント設定
+# （年代 × 性別 × 都市。ユーザー数が SEGMENT_MIN_USERS 未満のセグメントは上位階層で代替）
+SEGMENT_TOP_N = 50
+SEGMENT_MIN_USERS = 20
+SEGMENT_AGE_EDGES = [20, 30, 40, 50, 60]
+
+# 暗黙的フィードバックALS設定
+# 信頼度 c_ui = 1 + ALS_ALPHA * log1p(購入回数 または 購入数量)
+ALS_FACTORS = 64
+ALS_REGULARIZATION = 0.1
+ALS_ALPHA = 10.0
+ALS_ITERATIONS = 15
+ALS_CG_STEPS = 3
+ALS_BLOCK_SIZE = 4096
+
+# オフライン評価設定（直近 EVALUATION_HOLDOUT_DAYS 日をホールドアウトして @K 指標を計算）
+EVALUATION_K = 10
+EVALUATION_HOLDOUT_DAYS = 7
+
+# ハイパーパラメータ探索設定（候補の直積を評価し、レイテンシ予算内で NDCG 最大の設定を採用）
+SWEEP_COMPONENTS = [16, 32, 50]
+SWEEP_NEIGHBORS = [5, 10, 20]
+SWEEP_PRICE_WEIGHTS = [0.0, 1.0]
+SWEEP_LATENCY_SAMPLE = 200
+
+# ストリーミング取得設定（BigQuery のページ / Parquet のバッチ単位で購入行列に追加）
+STREAM_PAGE_SIZE = 100000
+STREAM_INITIAL_CAPACITY = 1 << 20
+TRANSACTION_COLUMNS = ['user_id', 'product_id', 'total_quantity', 'avg_price', 'purchase_count',
+                       'days_since_last_purchase']
+
+# 取引スナップショット（日別 (ユーザー, アイテム) 集計の Parquet キャッシュ）
+SNAPSHOT_PREFIX = "snapshots/transactions_daily"
+SNAPSHOT_FORMAT_VERSION = 1
+SNAPSHOT_WINDOW_DAYS = 90
+SNAPSHOT_OVERLAP_DAYS = 1
+SNAPSHOT_SCHEMA = pa.schema([
+    ('user_id', pa.int64()),
+    ('product_id', pa.int64()),
+    ('sum_quantity', pa.float64()),
+    ('sum_price', pa.float64()),
+    ('price_count', pa.int64()),
+    ('purchase_count', pa.int64()),
+    ('last_purchase', pa.timestamp('us', tz='UTC'))
+])
+
+# 時間減衰人気度の半減期（日）
+POPULARITY_HALF_LIFE_DAYS = 14.0
+
+def peak_memory_mb():
+    """プロセスのピークメモリ使用量（MB）"""
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+@contextmanager
+def log_stage(name, timings=None):
+    """処理段階の所要時間とピークメモリをログ出力（timings 指定時は秒数を記録）"""
+    started = time.perf_counter()
+    yield
+    elapsed = time.perf_counter() - started
+    if timings is not None:
+        timings[name] = round(elapsed, 3)
+    logger.info(f"[{name}] {elapsed:.2f}秒, ピークメモリ {peak_memory_mb():.0f}MB")
+
+
+def _als_cg_block(confidence, factors, fixed, gram, regularization, cg_steps):
+    """ブロック内の行の因子を共役勾配法で更新
+
+    (Y^T C_u Y + λI) x_u = Y^T C_u p_u を、Y^T Y を共有しつつ C_u - I の非ゼロ部分だけを
+    疎行列で掛ける行列ベクトル積で解く。ブロック内の全行を同時に反復する。
+
+    Args:
+        confidence: ブロック行 × 相手側の CSR（値は信頼度 c_ui ≥ 1、観測あり = 選好1）
+        factors: ブロック行の現在の因子（初期値として使用）
+        fixed: 相手側の因子 Y
+        gram: Y^T Y
+
+    Returns:
+        更新後の因子
+    """
+    n_rows = confidence.shape[0]
+    rows = np.repeat(np.arange(n_rows), np.diff(confidence.indptr))
+    cols = confidence.indices
+    extra = confidence.data - 1.0
+    
+    def matvec(vectors):
+        dots = np.einsum('ij,ij->i', vectors[rows], fixed[cols])
+        weighted = sparse.csr_matrix((extra * dots, cols, confidence.indptr), shape=confidence.shape)
+        return vectors @ gram + weighted @ fixed + regularization * vectors
+    
+    x = factors.copy()
+    residual = confidence @ fixed - matvec(x)
+    direction = residual.copy()
+    residual_norm = np.sum(residual ** 2, axis=1)
+    for _ in range(cg_steps):
+        product = matvec(direction)
+        step = residual_norm / np.maximum(np.sum(direction * product, axis=1), 1e-12)
+        x += step[:, np.newaxis] * direction
+        residual -= step[:, np.newaxis] * product
+        new_norm = np.sum(residual ** 2, axis=1)
+        direction = residual + (new_norm / np.maximum(residual_norm, 1e-12))[:, np.newaxis] * direction
+        residual_norm = new_norm
+    return x
+
+
+def train_als(confidence, n_factors=ALS_FACTORS, regularization=ALS_REGULARIZATION,
+              iterations=ALS_ITERATIONS, cg_steps=ALS_CG_STEPS, n_threads=None,
+              block_size=ALS_BLOCK_SIZE, random_state=42):
+    """暗黙的フィードバックALS（Hu, Koren, Volinsky）を共役勾配法で学習
+
+    ユーザー側・アイテム側を交互に更新し、各側は行ブロック単位でスレッドプールに分配する
+    （行列演算は BLAS / NumPy が GIL を解放するため並列に進む）。
+
+    Args:
+        confidence: ユーザー × アイテムの CSR（値は信頼度 c_ui）
+
+    Returns:
+        (user_factors, item_factors): float32 配列
+    """
+    n_users, n_items = confidence.shape
+    n_threads = n_threads or os.cpu_count() or 1
+    rng = np.random.default_rng(random_state)
+    user_factors = rng.normal(0, 0.01, (n_users, n_factors)).astype(np.float32)
+    item_factors = rng.normal(0, 0.01, (n_items, n_factors)).astype(np.float32)
+    confidence = confidence.astype(np.float32)
+    confidence_t = confidence.T.tocsr()
+    
+    def solve(matrix, factors, fixed, executor):
+        gram = fixed.T @ fixed
+        
+        def update(start):
+            stop = min(start + block_size, matrix.shape[0])
+            factors[start:stop] = _als_cg_block(
+                matrix[start:stop], factors[start:stop], fixed, gram, regularization, cg_steps
+            )
+        
+        list(executor.map(update, range(0, matrix.shape[0], block_size)))
+    
+    with ThreadPoolExecutor(max_workers=n_threads) as executor:
+        for iteration in range(iterations):
+            started = time.perf_counter()
+            solve(confidence, user_factors, item_factors, executor)
+            solve(confidence_t, item_factors, user_factors, executor)
+            logger.info(f"ALS反復 {iteration + 1}/{iterations}: {time.perf_counter() - started:.2f}秒")
+    
+    return user_factors, item_factors
+
+
+# バッチスコアリング用ワーカー状態（プロセスごとに初期化）
+_scoring_state = {}
+
+
+# 以下のスコアリング関数は app-engine/main.py と同じ実装（tests/test_scoring_parity.py で一致を検証）
+def top_n_items(item_scores, candidates, n):
+    """行ごとに候補アイテムの上位n件を取得
+
+    Args:
+        item_scores: (行数 × アイテム数) のスコア配列
+        candidates: item_scores と同形状の候補マスク
+        n: 取得件数
+
+    Returns:
+        (items, scores): items はアイテムインデックス（候補不足分は -1）、
+        scores は対応するスコア（候補不足分は NaN）
+    """
+    n_rows, n_items = item_scores.shape
+    n = min(n, n_items)
+    if n <= 0:
+        return (np.empty((n_rows, 0), dtype=np.int32),
+                np.empty((n_rows, 0), dtype=np.float32))
+    
+    masked = np.where(candidates, item_scores, -np.inf)
+    top = np.argpartition(-masked, n - 1, axis=1)[:, :n]
+    top_scores = np.take_along_axis(masked, top, axis=1)
+    order = np.argsort(-top_scores, axis=1, kind='stable')
+    top = np.take_along_axis(top, order, axis=1).astype(np.int32)
+    top_scores = np.take_along_axis(top_scores, order, axis=1).astype(np.float32)
+    
+    valid = np.isfinite(top_scores)
+    top[~valid] = -1
+    top_scores[~valid] = np.nan
+    return top, top_scores
+
+
+def normalize_rows(features):
+    """行ベクトルをL2正規化（ゼロベクトルはそのまま）"""
+    norms = np.linalg.norm(features, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return (features / norms).astype(np.float32)
+
+
+def search_similar_users_exact(query, normalized_features, k, exclude=None):
+    """全ユーザーとの内積による類似ユーザー検索（厳密）
+
+    Returns:
+        (neighbors, similarities): 類似度の降順
+    """
+    similarities = normalized_features @ query
+    if exclude is not None:
+        similarities[exclude] = -np.inf
+    k = min(k, len(similarities) - (exclude is not None))
+    if k <= 0:
+        return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float32)
+    
+    top = np.argpartition(-similarities, k - 1)[:k]
+    top = top[np.argsort(-similarities[top], kind='stable')]
+    return top, similarities[top]
+
+
+def search_similar_users_ivf(query, normalized_features, ann_index, k, n_probe, exclude=None):
+    """IVFインデックスによる類似ユーザー検索（近似）
+
+    クエリに近い n_probe 個のクラスタに属するユーザーのみを走査する。
+    n_probe を大きくするほど再現率が上がり、レイテンシも増える。
+    """
+    centroids = ann_index['centroids']
+    offsets = ann_index['list_offsets']
+    members = ann_index['list_members']
+    
+    n_probe = min(n_probe, len(centroids))
+    centroid_scores = centroids @ query
+    probe = np.argpartition(-centroid_scores, n_probe - 1)[:n_probe]
+    candidates = np.concatenate([members[offsets[c]:offsets[c + 1]] for c in probe])
+    if exclude is not None:
+        candidates = candidates[candidates != exclude]
+    
+    k = min(k, len(candidates))
+    if k <= 0:
+        return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float32)
+    
+    similarities = normalized_features[candidates] @ query
+    top = np.argpartition(-similarities, k - 1)[:k]
+    top = top[np.argsort(-similarities[top], kind='stable')]
+    return candidates[top].astype(np.int64), similarities[top]
+
+
+def top_similar_users_block(normalized_features, user_idxs, k, chunk_size=SIMILARITY_CHUNK_SIZE):
+    """ブロック内の各ユーザーについて類似ユーザー上位k人を厳密に検索（自分自身は除外）
+
+    全ユーザーを chunk_size 人ずつに分けて類似度を計算し、上位k人を逐次更新するため、
+    一時メモリは (ブロック × chunk_size) に収まる。k は ユーザー数 - 1 以下であること。
+
+    Returns:
+        (neighbors, similarities): いずれも (ブロック × k)、行内の順序は不定
+    """
+    user_idxs = np.asarray(user_idxs)
+    queries = normalized_features[user_idxs]
+    n_block = len(user_idxs)
+    best_idx = np.empty((n_block, 0), dtype=np.int64)
+    best_sim = np.empty((n_block, 0), dtype=np.float32)
+    for start in range(0, len(normalized_features), chunk_size):
+        similarities = queries @ normalized_features[start:start + chunk_size].T
+        own = np.flatnonzero((user_idxs >= start) & (user_idxs < start + similarities.shape[1]))
+        similarities[own, user_idxs[own] - start] = -np.inf
+        
+        chunk_idx = np.broadcast_to(np.arange(similarities.shape[1]), similarities.shape)
+        if similarities.shape[1] > k:
+            chunk_idx = np.argpartition(-similarities, k - 1, axis=1)[:, :k]
+            similarities = np.take_along_axis(similarities, chunk_idx, axis=1)
+        
+        merged_sim = np.concatenate([best_sim, similarities], axis=1)
+        merged_idx = np.concatenate([best_idx, chunk_idx + start], axis=1)
+        if merged_sim.shape[1] > k:
+            top = np.argpartition(-merged_sim, k - 1, axis=1)[:, :k]
+            merged_sim = np.take_along_axis(merged_sim, top, axis=1)
+            merged_idx = np.take_along_axis(merged_idx, top, axis=1)
+        best_sim, best_idx = merged_sim, merged_idx
+    return best_idx, best_sim
+
+def build_ivf_index(normalized_features, n_lists=None, n_iter=ANN_KMEANS_ITERATIONS,
+                    block_size=65536, random_state=42):
+    """球面k-meansによるIVFインデックス構築
+
+    Returns:
+        centroids（正規化済み重心）、list_offsets / list_members
+        （クラスタごとのユーザーインデックスをCSR形式で格納）を持つ dict
+    """
+    n_users = normalized_features.shape[0]
+    n_lists = n_lists or max(1, int(np.sqrt(n_users)))
+    n_lists = min(n_lists, n_users)
+    rng = np.random.default_rng(random_state)
+    centroids = normalized_features[rng.choice(n_users, n_lists, replace=False)].copy()
+    
+    def assign(centroids):
+        labels = np.empty(n_users, dtype=np.int64)
+        for start in range(0, n_users, block_size):
+            block = normalized_features[start:start + block_size]
+            labels[start:start + block_size] = np.argmax(block @ centroids.T, axis=1)
+        return labels
+    
+    for _ in range(n_iter):
+        labels = assign(centroids)
+        membership = sparse.csr_matrix(
+            (np.ones(n_users, dtype=np.float32), (labels, np.arange(n_users))),
+            shape=(n_lists, n_users)
+        )
+        sums = membership @ normalized_features
+        counts = np.bincount(labels, minlength=n_lists)
+        # 空クラスタは前回の重心を維持
+        sums[counts == 0] = centroids[counts == 0]
+        centroids = normalize_rows(sums)
+    
+    index = ivf_lists(assign(centroids), n_lists)
+    index['centroids'] = centroids.astype(np.float32)
+    return index
+
+
+def ivf_lists(labels, n_lists):
+    """ユーザーごとのクラスタ番号から IVF のリスト（CSR形式）を作成"""
+    members = np.argsort(labels, kind='stable').astype(np.int32)
+    offsets = np.zeros(n_lists + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum(np.bincount(labels, minlength=n_lists))
+    return {'list_offsets': offsets, 'list_members': members}
+
+
+def build_item_similarity(user_item_csr, k=ITEM_NEIGHBORS, block_size=ITEM_SIMILARITY_BLOCK_SIZE):
+    """アイテム間コサイン類似度の上位k件を疎行列として構築
+
+    購入ユーザーベクトル（購入行列の列）同士の類似度をアイテムのブロック単位で
+    疎行列積により求め、各行で正の類似度の上位k件のみを残す（自分自身は除外）。
+
+    Returns:
+        (アイテム数 × アイテム数) の CSR 行列（float32）
+    """
+    n_items = user_item_csr.shape[1]
+    k = min(k, n_items - 1)
+    
+    item_user = user_item_csr.T.tocsr().astype(np.float32)
+    norms = np.sqrt(np.asarray(item_user.multiply(item_user).sum(axis=1)).ravel())
+    norms[norms == 0] = 1.0
+    item_user = sparse.csr_matrix(sparse.diags((1.0 / norms).astype(np.float32)) @ item_user)
+    user_item = item_user.T.tocsr()
+    
+    counts = np.zeros(n_items, dtype=np.int64)
+    indices = []
+    data = []
+    for start in range(0, n_items, block_size):
+        stop = min(start + block_size, n_items)
+        similarities = (item_user[start:stop] @ user_item).tocsr()
+        for row in range(stop - start):
+            row_start, row_stop = similarities.indptr[row], similarities.indptr[row + 1]
+            cols = similarities.indices[row_start:row_stop]
+            values = similarities.data[row_start:row_stop]
+            keep = (cols != start + row) & (values > 0)
+            cols, values = cols[keep], values[keep]
+            if k <= 0:
+                cols, values = cols[:0], values[:0]
+            elif len(values) > k:
+                top = np.argpartition(-values, k - 1)[:k]
+                cols, values = cols[top], values[top]
+            order = np.argsort(cols)
+            indices.append(cols[order].astype(np.int32))
+            data.append(values[order].astype(np.float32))
+            counts[start + row] = len(cols)
+    
+    indptr = np.zeros(n_items + 1, dtype=np.int64)
+    indptr[1:] = np.cumsum(counts)
+    return sparse.csr_matrix(
+        (np.concatenate(data) if data else np.empty(0, dtype=np.float32),
+         np.concatenate(indices) if indices else np.empty(0, dtype=np.int32),
+         indptr),
+        shape=(n_items, n_items)
+    )
+
+
+def score_items_by_similarity(user_item_csr, item_similarity, user_idxs, n):
+    """購入アイテムの類似アイテム行を合計してスコアリング（アイテムベース）
+
+    Returns:
+        (items, scores): top_n_items と同形式（候補不足分は -1 / NaN）
+    """
+    n_block = len(user_idxs)
+    n = min(n, item_similarity.shape[1])
+    items = np.full((n_block, n), -1, dtype=np.int32)
+    scores = np.full((n_block, n), np.nan, dtype=np.float32)
+    
+    purchased = user_item_csr[user_idxs]
+    item_scores = (purchased @ item_similarity).tocsr()
+    
+    for row in range(n_block):
+        start, stop = item_scores.indptr[row], item_scores.indptr[row + 1]
+        candidates = item_scores.indices[start:stop]
+        row_scores = item_scores.data[start:stop]
+        bought = purchased.indices[purchased.indptr[row]:purchased.indptr[row + 1]]
+        keep = ~np.isin(candidates, bought)
+        candidates, row_scores = candidates[keep], row_scores[keep]
+        
+        k = min(n, len(candidates))
+        if k == 0:
+            continue
+        top = np.argpartition(-row_scores, k - 1)[:k]
+        top = top[np.argsort(-row_scores[top], kind='stable')]
+        items[row, :k] = candidates[top]
+        scores[row, :k] = row_scores[top]
+    
+    return items, scores
+
+
+def build_interaction_matrix(df, user_idx, item_idx, shape, price_weight=PRICE_WEIGHT):
+    """取引集計からユーザー × アイテムの購入スコア行列（CSR）を作成
+
+    スコアは 購入回数 × log1p(平均価格)^price_weight（0 で購入回数のみ）。
+    COO → CSR で直接作成し、重複するペアは平均する。
+
+    Returns:
+        (user_item_csr, interaction_counts): interaction_counts は ALS の信頼度用の
+        購入回数・数量（重複ペアは合計）で、user_item_csr の data と同じ並び
+    """
+    scores = (df['purchase_count'].to_numpy(dtype=np.float64)
+              * np.log1p(df['avg_price'].to_numpy(dtype=np.float64)) ** price_weight)
+    return coo_to_interaction_matrix(
+        user_idx, item_idx, scores,
+        {column: df[column].to_numpy(dtype=np.float64) for column in ('purchase_count', 'total_quantity')},
+        shape
+    )
+
+
+def coo_to_interaction_matrix(user_idx, item_idx, scores, counts, shape):
+    """COO 形式の購入スコア・購入回数から購入行列（CSR）を作成（重複ペアはスコア平均・回数合計）
+
+    Returns:
+        build_interaction_matrix と同じ (user_item_csr, interaction_counts)
+    """
+    score_sums = sparse.csr_matrix((scores, (user_idx, item_idx)), shape=shape)
+    pair_counts = sparse.csr_matrix((np.ones(len(scores)), (user_idx, item_idx)), shape=shape)
+    score_sums.data /= pair_counts.data
+    
+    interaction_counts = {}
+    for column, values in counts.items():
+        summed = sparse.csr_matrix((values, (user_idx, item_idx)), shape=shape)
+        interaction_counts[column] = summed.data.astype(np.float32)
+    return score_sums.astype(np.float32), interaction_counts
+
+
+class IdFactorizer:
+    """IDの逐次番号付け
+
+    バッチごとに未知のIDへ出現順のコードを割り当てる。既知IDはソート済みのID配列を
+    二分探索して解決するため、辞書を持たずにID数に比例したメモリで済む。
+    """
+    
+    def __init__(self):
+        self.sorted_ids = np.empty(0, dtype=np.int64)
+        self.sorted_codes = np.empty(0, dtype=np.int64)
+        self.n_ids = 0
+    
+    def encode(self, ids):
+        """IDの配列をコードの配列に変換（未知のIDは登録）"""
+        unique_ids, inverse = np.unique(ids, return_inverse=True)
+        positions = np.searchsorted(self.sorted_ids, unique_ids)
+        found = positions < len(self.sorted_ids)
+        found[found] = self.sorted_ids[positions[found]] == unique_ids[found]
+        
+        codes = np.empty(len(unique_ids), dtype=np.int64)
+        codes[found] = self.sorted_codes[positions[found]]
+        new = ~found
+        n_new = int(new.sum())
+        codes[new] = np.arange(self.n_ids, self.n_ids + n_new)
+        self.n_ids += n_new
+        
+        self.sorted_ids = np.insert(self.sorted_ids, positions[new], unique_ids[new])
+        self.sorted_codes = np.insert(self.sorted_codes, positions[new], codes[new])
+        return codes[inverse]
+    
+    def finalize(self):
+        """(ID昇順の配列, コード → ID昇順インデックスの変換表)"""
+        remap = np.empty(self.n_ids, dtype=np.int64)
+        remap[self.sorted_codes] = np.arange(self.n_ids)
+        return self.sorted_ids, remap
+
+
+class InteractionAccumulator:
+    """取引集計の Arrow レコードバッチを逐次 COO バッファに追加して購入行列を作成
+
+    バッファは容量を倍々に伸ばし、IDは IdFactorizer で逐次番号付けするため、
+    ピークメモリはバッチ1つ分と最終的な疎行列の規模に収まる。
+    """
+    
+    BUFFERS = {
+        'user_code': np.int64,
+        'item_code': np.int64,
+        'score': np.float64,
+        'purchase_count': np.float32,
+        'total_quantity': np.float32,
+        'decayed_score': np.float32
+    }
+    
+    def __init__(self, price_weight=PRICE_WEIGHT, half_life_days=POPULARITY_HALF_LIFE_DAYS,
+                 initial_capacity=STREAM_INITIAL_CAPACITY):
+        self.price_weight = price_weight
+        self.half_life_days = half_life_days
+        self.users = IdFactorizer()
+        self.items = IdFactorizer()
+        self.size = 0
+        self.buffers = {name: np.empty(initial_capacity, dtype=dtype) for name, dtype in self.BUFFERS.items()}
+    
+    def add(self, batch):
+        """レコードバッチ（TRANSACTION_COLUMNS の列）を追加"""
+        n = batch.num_rows
+        if n == 0:
+            return
+        
+        def column(name, dtype=np.float64):
+            return batch.column(name).to_numpy(zero_copy_only=False).astype(dtype, copy=False)
+        
+        purchase_count = column('purchase_count')
+        log_price = np.log1p(column('avg_price'))
+        days = np.nan_to_num(column('days_since_last_purchase'), nan=0.0)
+        values = {
+            'user_code': self.users.encode(column('user_id', np.int64)),
+            'item_code': self.items.encode(column('product_id', np.int64)),
+            'score': purchase_count * log_price ** self.price_weight,
+            'purchase_count': purchase_count,
+            'total_quantity': column('total_quantity'),
+            # 時間減衰人気度は compute_popularity と同じく価格の重み 1 のスコアで集計
+            'decayed_score': purchase_count * log_price * np.power(0.5, days / self.half_life_days)
+        }
+        
+        capacity = len(self.buffers['score'])
+        if self.size + n > capacity:
+            capacity = max(capacity * 2, self.size + n)
+            for name, buffer in self.buffers.items():
+                grown = np.empty(capacity, dtype=buffer.dtype)
+                grown[:self.size] = buffer[:self.size]
+                self.buffers[name] = grown
+        for name, value in values.items():
+            self.buffers[name][self.size:self.size + n] = value
+        self.size += n
+    
+    def finalize(self):
+        """ID昇順のインデックスで購入行列を作成
+
+        Returns:
+            (user_ids, item_ids, user_item_csr, interaction_counts, decayed_popularity)
+        """
+        user_ids, user_remap = self.users.finalize()
+        item_ids, item_remap = self.items.finalize()
+        buffers = {name: buffer[:self.size] for name, buffer in self.buffers.items()}
+        self.buffers = {}
+        
+        user_idx = user_remap[buffers['user_code']]
+        item_idx = item_remap[buffers['item_code']]
+        shape = (len(user_ids), len(item_ids))
+        user_item_csr, interaction_counts = coo_to_interaction_matrix(
+            user_idx, item_idx, buffers['score'],
+            {'purchase_count': buffers['purchase_count'], 'total_quantity': buffers['total_quantity']},
+            shape
+        )
+        decayed_popularity = np.bincount(
+            item_idx, weights=buffers['decayed_score'], minlength=len(item_ids)
+        ).astype(np.float32)
+        return user_ids, item_ids, user_item_csr, interaction_counts, decayed_popularity
+
+
+def iter_parquet_batches(path, batch_size=STREAM_PAGE_SIZE):
+    """ローカル Parquet（ファイルまたはディレクトリ）から取引集計を Arrow レコードバッチで読み込む
+
+    BigQuery のストリーミング取得の代替（ローカル検証用）
+    """
+    files = sorted(glob.glob(os.path.join(path, '*.parquet'))) if os.path.isdir(path) else [path]
+    for file in files:
+        yield from pq.ParquetFile(file).iter_batches(batch_size=batch_size, columns=TRANSACTION_COLUMNS)
+
+
+class TransactionSnapshot:
+    """日別 (ユーザー, アイテム) 集計の Parquet スナップショット
+
+    day=YYYY-MM-DD/data.parquet のパーティションと manifest.json（ウォーターマークと
+    各パーティションのチェックサム）をローカルに持ち、gcs_prefix 指定時は GCS と同期する。
+    ウォーターマークは前回の取得時刻で、その日（と overlap_days 日前）以降のパーティションは
+    次回の差分取得で取り直す。
+    """
+    
+    def __init__(self, local_dir, gcs_prefix=None, window_days=SNAPSHOT_WINDOW_DAYS,
+                 overlap_days=SNAPSHOT_OVERLAP_DAYS):
+        self.local_dir = local_dir
+        self.gcs_prefix = gcs_prefix
+        self.window_days = window_days
+        self.overlap_days = overlap_days
+        self.watermark = None
+        self.partitions = {}
+        self._bucket = None
+    
+    @property
+    def bucket(self):
+        if self._bucket is None:
+            self._bucket = storage.Client(project=PROJECT_ID).bucket(BUCKET_NAME)
+        return self._bucket
+    
+    @property
+    def manifest_path(self):
+        return os.path.join(self.local_dir, 'manifest.json')
+    
+    def partition_path(self, day):
+        return os.path.join(self.local_dir, f"day={day}", 'data.parquet')
+    
+    def load(self):
+        """manifest を読み込み、手元にない・チェックサムが合わないパーティションを GCS から取得
+
+        取得できないパーティションは破棄し、ウォーターマークをその日まで戻して再取得させる。
+        """
+        self.watermark = None
+        self.partitions = {}
+        os.makedirs(self.local_dir, exist_ok=True)
+        if self.gcs_prefix:
+            blob = self.bucket.blob(f"{self.gcs_prefix}/manifest.json")
+            if blob.exists():
+                blob.download_to_filename(self.manifest_path)
+            elif os.path.exists(self.manifest_path):
+                os.remove(self.manifest_path)
+        if not os.path.exists(self.manifest_path):
+            logger.info("取引スナップショットなし（ウィンドウ全期間を取得）")
+            return
+        
+        with open(self.manifest_path) as f:
+            manifest = json.load(f)
+        if manifest.get('format_version') != SNAPSHOT_FORMAT_VERSION:
+            logger.warning(f"取引スナップショットの形式が異なるため破棄します: {manifest.get('format_version')}")
+            return
+        
+        self.watermark = datetime.fromisoformat(manifest['watermark'])
+        for day, entry in manifest['partitions'].items():
+            path = self.partition_path(day)
+            valid = os.path.exists(path) and file_sha256(path) == entry['sha256']
+            if not valid and self.gcs_prefix:
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                self.bucket.blob(f"{self.gcs_prefix}/day={day}/data.parquet").download_to_filename(path)
+                valid = file_sha256(path) == entry['sha256']
+            if not valid:
+                logger.warning(f"取引スナップショットのパーティションを再取得します: {day}")
+                day_start = datetime.fromisoformat(day).replace(tzinfo=timezone.utc)
+                self.watermark = min(self.watermark, day_start)
+                continue
+            self.partitions[day] = entry
+        logger.info(
+            f"取引スナップショット読み込み: {len(self.partitions)}日分 (watermark={self.watermark.isoformat()})"
+        )
+    
+    def refresh(self, fetch, now):
+        """ウォーターマーク以降の日を取得し直し、ウィンドウ外の日を削除
+
+        Args:
+            fetch: 取得開始時刻を受け取り、day 列と SNAPSHOT_SCHEMA の列を持つ
+                Arrow レコードバッチを返す関数
+            now: 取得時刻（新しいウォーターマーク）
+
+        Returns:
+            差分取得の集計 dict
+        """
+        window_start = (now - timedelta(days=self.window_days)).date()
+        start = window_start
+        if self.watermark is not None:
+            start = max(start, self.watermark.date() - timedelta(days=self.overlap_days))
+        start_time = datetime(start.year, start.month, start.day, tzinfo=timezone.utc)
+        
+        # 取得した行を日ごとの一時ファイルに書き出し、取得が完了してから置き換える
+        writers = {}
+        fetched_rows = {}
+        try:
+            for batch in fetch(start_time):
+                if batch.num_rows == 0:
+                    continue
+                batch = batch.take(pc.sort_indices(batch, sort_keys=[('day', 'ascending')]))
+                days = batch.column('day').cast(pa.int32()).to_numpy()
+                bounds = np.flatnonzero(np.diff(days)) + 1
+                for lo, hi in zip(np.r_[0, bounds], np.r_[bounds, len(days)]):
+                    day = batch.column('day')[int(lo)].as_py().isoformat()
+                    part = pa.Table.from_batches([batch.slice(int(lo), int(hi - lo))]).select(SNAPSHOT_SCHEMA.names)
+                    if day not in writers:
+                        path = self.partition_path(day)
+                        os.makedirs(os.path.dirname(path), exist_ok=True)
+                        writers[day] = pq.ParquetWriter(f"{path}.tmp", SNAPSHOT_SCHEMA)
+                        fetched_rows[day] = 0
+                    writers[day].write_table(part.cast(SNAPSHOT_SCHEMA))
+                    fetched_rows[day] += part.num_rows
+        finally:
+            for writer in writers.values():
+                writer.close()
+        
+        for day in fetched_rows:
+            path = self.partition_path(day)
+            os.replace(f"{path}.tmp", path)
+            self.partitions[day] = {'rows': fetched_rows[day], 'sha256': file_sha256(path)}
+        # ウィンドウ外の日と、取得し直した範囲で行がなくなった日を削除
+        dropped = [
+            day for day in self.partitions
+            if day < window_start.isoformat() or (day >= start.isoformat() and day not in fetched_rows)
+        ]
+        for day in dropped:
+            del self.partitions[day]
+            # 中断した書き込みの一時ファイルが残っていてもディレクトリごと削除
+            shutil.rmtree(os.path.dirname(self.partition_path(day)), ignore_errors=True)
+        
+        self.watermark = now
+        manifest = {
+            'format_version': SNAPSHOT_FORMAT_VERSION,
+            'watermark': now.isoformat(),
+            'window_days': self.window_days,
+            'partitions': dict(sorted(self.partitions.items()))
+        }
+        with open(self.manifest_path, 'w') as f:
+            json.dump(manifest, f, indent=2)
+        
+        # manifest は新しいパーティションのアップロード後に書き換え、不要なパーティションはその後に削除
+        if self.gcs_prefix:
+            for day in fetched_rows:
+                self.bucket.blob(f"{self.gcs_prefix}/day={day}/data.parquet").upload_from_filename(
+                    self.partition_path(day)
+                )
+            self.bucket.blob(f"{self.gcs_prefix}/manifest.json").upload_from_filename(self.manifest_path)
+            for day in dropped:
+                blob = self.bucket.blob(f"{self.gcs_prefix}/day={day}/data.parquet")
+                if blob.exists():
+                    blob.delete()
+        
+        summary = {
+            'fetched_from': start.isoformat(),
+            'fetched_days': len(fetched_rows),
+            'fetched_rows': int(sum(fetched_rows.values())),
+            'dropped_days': len(dropped),
+            'cached_days': len(self.partitions),
+            'watermark': now.isoformat()
+        }
+        logger.info(
+            f"取引スナップショット更新: {start.isoformat()} 以降 {summary['fetched_days']}日分 "
+            f"{summary['fetched_rows']}件を取得, {len(dropped)}日分を削除, 保持 {len(self.partitions)}日分"
+        )
+        return summary
+    
+    def batches(self, now, batch_size=STREAM_PAGE_SIZE):
+        """キャッシュ済みの日別集計を (ユーザー, アイテム) 単位に集計し直し、
+        TRANSACTION_COLUMNS のレコードバッチで返す（transactions_query と同じ集計）
+
+        パーティションはメモリマップで読んで列ごとの配列に詰め、(ユーザー, アイテム) 順に
+        並べ替えて区間ごとに合計・最大を取る（Arrow のハッシュ集約より少ないメモリで済む）。
+        """
+        days = sorted(self.partitions)
+        n_rows = sum(self.partitions[day]['rows'] for day in days)
+        if n_rows == 0:
+            return
+        
+        columns = {
+            field.name: np.empty(n_rows, dtype=np.float64 if pa.types.is_floating(field.type) else np.int64)
+            for field in SNAPSHOT_SCHEMA
+        }
+        offset = 0
+        for day in days:
+            table = pq.read_table(self.partition_path(day), memory_map=True)
+            for name, values in columns.items():
+                column = table.column(name)
+                if name == 'last_purchase':
+                    column = column.cast(pa.int64())
+                elif name not in ('user_id', 'product_id'):
+                    # 価格がすべて欠損した日の SUM(price) は NULL
+                    column = pc.fill_null(column, 0)
+                values[offset:offset + table.num_rows] = column.to_numpy()
+            offset += table.num_rows
+        
+        order = np.lexsort((columns['product_id'], columns['user_id']))
+        for name in columns:
+            columns[name] = columns[name][order]
+        del order
+        user_id, product_id = columns['user_id'], columns['product_id']
+        starts = np.flatnonzero(np.r_[True, (np.diff(user_id) != 0) | (np.diff(product_id) != 0)])
+        sums = {
+            name: np.add.reduceat(columns[name], starts)
+            for name in ('sum_quantity', 'sum_price', 'price_count', 'purchase_count')
+        }
+        last_purchase = np.maximum.reduceat(columns['last_purchase'], starts)
+        
+        # TIMESTAMP_DIFF(..., DAY) と同じく経過日数は切り捨て、平均価格は価格のある取引の平均
+        now_us = int(now.timestamp()) * 1000000 + now.microsecond
+        with np.errstate(invalid='ignore'):
+            avg_price = sums['sum_price'] / sums['price_count']
+        transactions = pa.table({
+            'user_id': user_id[starts],
+            'product_id': product_id[starts],
+            'total_quantity': sums['sum_quantity'],
+            'avg_price': avg_price,
+            'purchase_count': sums['purchase_count'],
+            'days_since_last_purchase': (now_us - last_purchase) // (86400 * 1000000)
+        })
+        del columns, sums
+        yield from transactions.filter(pc.greater(transactions.column('total_quantity'), 0)).to_batches(
+            max_chunksize=batch_size
+        )
+
+
+def segment_value(value):
+    """セグメントキー用の属性値（欠損は 'unknown'）"""
+    if value is None or (isinstance(value, float) and np.isnan(value)):
+        return 'unknown'
+    return str(value).strip().lower()
+
+
+def segment_keys(age, gender, city, age_edges):
+    """ユーザー属性のセグメントキー（細かい順: 年代×性別×都市 → 年代×性別 → 年代）"""
+    if age is None or np.isnan(float(age)):
+        bucket = 'unknown'
+    else:
+        bucket = str(int(np.searchsorted(age_edges, float(age), side='right')))
+    gender = segment_value(gender)
+    city = segment_value(city)
+    return [f"{bucket}|{gender}|{city}", f"{bucket}|{gender}", bucket]
+
+
+def score_user_factors(user_factors, item_factors, user_item_csr, user_idxs, n):
+    """因子の内積によるスコアリング（ALS）
+
+    アイテムごとに1回の内積で済み、購入済み以外の全アイテムが候補になる。
+
+    Returns:
+        (items, scores): top_n_items と同形式
+    """
+    item_scores = user_factors[user_idxs] @ item_factors.T
+    purchased = user_item_csr[user_idxs]
+    candidates = np.ones(item_scores.shape, dtype=bool)
+    candidates[np.repeat(np.arange(len(user_idxs)), np.diff(purchased.indptr)), purchased.indices] = False
+    return top_n_items(item_scores, candidates, n)
+
+
+def _init_scoring_worker(user_features, user_item_csr, item_similarity=None, item_factors=None,
+                         n_neighbors=N_NEIGHBORS):
+    """バッチスコアリングワーカー初期化"""
+    if item_similarity is None and item_factors is None:
+        _scoring_state['normalized_features'] = normalize_rows(user_features)
+    _scoring_state['user_features'] = user_features
+    _scoring_state['user_item_csr'] = user_item_csr
+    _scoring_state['item_similarity'] = item_similarity
+    _scoring_state['item_factors'] = item_factors
+    _scoring_state['n_neighbors'] = n_neighbors
+
+
+def _score_user_block(block):
+    """ユーザーブロックの上位N件を計算
+
+    Args:
+        block: (user_idxs, top_n)。user_idxs はブロック内のユーザーインデックス配列
+
+    Returns:
+        (user_idxs, items, scores): items はアイテムインデックス（不足分は -1）、
+        scores は対応するスコア（不足分は NaN）
+    """
+    user_idxs, top_n = block
+    user_item_csr = _scoring_state['user_item_csr']
+    
+    if _scoring_state.get('item_factors') is not None:
+        items, scores = score_user_factors(
+            _scoring_state['user_features'], _scoring_state['item_factors'],
+            user_item_csr, user_idxs, top_n
+        )
+    elif _scoring_state.get('item_similarity') is not None:
+        items, scores = score_items_by_similarity(
+            user_item_csr, _scoring_state['item_similarity'], user_idxs, top_n
+        )
+    else:
+        items, scores = _score_user_neighbors(user_idxs, top_n)
+    
+    if items.shape[1] < top_n:
+        pad = top_n - items.shape[1]
+        items = np.pad(items, ((0, 0), (0, pad)), constant_values=-1)
+        scores = np.pad(scores, ((0, 0), (0, pad)), constant_values=np.nan)
+    return user_idxs, items, scores
+
+
+def _score_user_neighbors(user_idxs, top_n):
+    """類似ユーザーの購入履歴によるブロックのスコアリング"""
+    features = _scoring_state['normalized_features']
+    user_item_csr = _scoring_state['user_item_csr']
+    n_users, n_items = user_item_csr.shape
+    n_block = len(user_idxs)
+    n_neighbors = min(_scoring_state.get('n_neighbors', N_NEIGHBORS), n_users - 1)
+    
+    if n_neighbors <= 0:
+        return (np.full((n_block, top_n), -1, dtype=np.int32),
+                np.full((n_block, top_n), np.nan, dtype=np.float32))
+    
+    # 類似ユーザー（上位 n_neighbors 人、全ユーザーをチャンクに分けた厳密検索）を重みとする疎行列
+    rows = np.arange(n_block)
+    neighbors, weights = top_similar_users_block(features, user_idxs, n_neighbors)
+    neighbor_matrix = sparse.csr_matrix(
+        (weights.ravel(), neighbors.ravel(), np.arange(0, n_block * n_neighbors + 1, n_neighbors)),
+        shape=(n_block, n_users)
+    )
+    
+    # 類似度 × 購入行列（疎行列積）
+    item_scores = (neighbor_matrix @ user_item_csr).toarray()
+    
+    # 類似ユーザーが購入済み かつ 本人が未購入のアイテムのみ候補
+    # （購入スコアは正値のため、|重み| との積の非ゼロ構造が到達アイテムになる）
+    reached = abs(neighbor_matrix) @ user_item_csr
+    candidates = np.zeros((n_block, n_items), dtype=bool)
+    candidates[np.repeat(rows, np.diff(reached.indptr)), reached.indices] = True
+    purchased = user_item_csr[user_idxs]
+    candidates[np.repeat(rows, np.diff(purchased.indptr)), purchased.indices] = False
+    
+    return top_n_items(item_scores, candidates, top_n)
+
+# ハイパーパラメータ探索ワーカー状態（共有する学習行列はメモリマップで参照）
+_sweep_state = {}
+
+
+def write_sweep_arrays(shared_dir, train_df, holdout_df, price_weights):
+    """探索用の学習行列を一度だけ作成し、ワーカーが共有する .npy ファイルに書き出す
+
+    行列の構造（indptr / indices）は共通で、価格の重みごとに data だけを持つ。
+    """
+    unique_users, user_idx = np.unique(train_df['user_id'].to_numpy(), return_inverse=True)
+    unique_items, item_idx = np.unique(train_df['product_id'].to_numpy(), return_inverse=True)
+    shape = (len(unique_users), len(unique_items))
+    
+    arrays = {
+        'user_ids': unique_users.astype(np.int64),
+        'item_ids': unique_items.astype(np.int64),
+        'holdout_user_ids': holdout_df['user_id'].to_numpy(dtype=np.int64),
+        'holdout_product_ids': holdout_df['product_id'].to_numpy(dtype=np.int64)
+    }
+    for i, price_weight in enumerate(price_weights):
+        matrix, interaction_counts = build_interaction_matrix(train_df, user_idx, item_idx, shape, price_weight)
+        arrays[f'matrix_data_{i}'] = matrix.data
+    arrays['matrix_indptr'] = matrix.indptr
+    arrays['matrix_indices'] = matrix.indices
+    arrays['purchase_count'] = interaction_counts['purchase_count']
+    arrays['total_quantity'] = interaction_counts['total_quantity']
+    
+    for name, array in arrays.items():
+        np.save(os.path.join(shared_dir, f"{name}.npy"), array)
+    logger.info(f"探索用学習行列: {shape}, 非ゼロ要素 {matrix.nnz}, 価格の重み {len(price_weights)}種類")
+
+
+def _init_sweep_worker(shared_dir, price_weights, settings):
+    """ハイパーパラメータ探索ワーカー初期化（共有配列をメモリマップで開く）"""
+    def load(name):
+        return np.load(os.path.join(shared_dir, f"{name}.npy"), mmap_mode='r')
+    
+    _sweep_state['user_ids'] = load('user_ids')
+    _sweep_state['item_ids'] = load('item_ids')
+    _sweep_state['matrix_data'] = [load(f'matrix_data_{i}') for i in range(len(price_weights))]
+    _sweep_state['matrix_indptr'] = load('matrix_indptr')
+    _sweep_state['matrix_indices'] = load('matrix_indices')
+    _sweep_state['interaction_counts'] = {
+        'purchase_count': load('purchase_count'),
+        'total_quantity': load('total_quantity')
+    }
+    _sweep_state['holdout_df'] = pd.DataFrame({
+        'user_id': load('holdout_user_ids'),
+        'product_id': load('holdout_product_ids')
+    })
+    _sweep_state['price_weights'] = list(price_weights)
+    _sweep_state['settings'] = settings
+    
+    # 並列ワーカー間で BLAS スレッドが競合するとレイテンシ計測が歪むため CPU を按分
+    threadpool_limits(limits=settings['blas_threads'])
+
+
+def _fit_sweep_config(config):
+    """1つの候補設定で学習し、オフライン指標と1ユーザーあたりのスコアリング時間を計測"""
+    settings = _sweep_state['settings']
+    user_ids = _sweep_state['user_ids']
+    item_ids = _sweep_state['item_ids']
+    
+    model = RecommendationModel()
+    model.user_mapping = {int(user): idx for idx, user in enumerate(user_ids)}
+    model.item_mapping = {int(item): idx for idx, item in enumerate(item_ids)}
+    model.reverse_user_mapping = {idx: user for user, idx in model.user_mapping.items()}
+    model.reverse_item_mapping = {idx: item for item, idx in model.item_mapping.items()}
+    model.user_item_csr = sparse.csr_matrix(
+        (_sweep_state['matrix_data'][_sweep_state['price_weights'].index(config['price_weight'])],
+         _sweep_state['matrix_indices'], _sweep_state['matrix_indptr']),
+        shape=(len(user_ids), len(item_ids)),
+        copy=False
+    )
+    model.user_item_matrix = model.user_item_csr
+    model.interaction_counts = _sweep_state['interaction_counts']
+    model.price_weight = config['price_weight']
+    
+    started = time.perf_counter()
+    if settings['algorithm'] == 'item_item':
+        # アイテムベースのスコアリングはユーザー因子を使わないため因子の学習は省略
+        model.build_item_similarity(k=config['n_neighbors'])
+    else:
+        if settings['engine'] == 'als':
+            # プロセス間で並列化しているため ALS のスレッドは1本
+            model.fit_als(**{**settings['als_params'], 'n_factors': config['n_components'], 'n_threads': 1})
+        else:
+            model.fit_svd(config['n_components'])
+        model.n_neighbors = config['n_neighbors']
+    fit_seconds = time.perf_counter() - started
+    
+    report = model.evaluate(
+        _sweep_state['holdout_df'], k=settings['k'], block_size=settings['block_size'], n_workers=1
+    )
+    # 他のワーカーと CPU を共有しているため、壁時計ではなくプロセスの CPU 時間で比較
+    latency = model.measure_latency(settings['latency_sample'], settings['k'], clock=time.process_time)
+    return {**config, 'fit_seconds': round(fit_seconds, 3), **report, **latency}
+
+
+def rank_sweep_results(results, k, max_latency_ms=None):
+    """探索結果の順位付け
+
+    p95 レイテンシが max_latency_ms 以内の設定を優先し、その中で NDCG@K の高い順、
+    同点はレイテンシの短い順。
+    """
+    def sort_key(result):
+        over_budget = max_latency_ms is not None and result['latency_p95_ms'] > max_latency_ms
+        return (over_budget, -result.get(f'ndcg_at_{k}', 0.0), result['latency_p95_ms'])
+    
+    ranked = sorted(results, key=sort_key)
+    for rank, result in enumerate(ranked, start=1):
+        result['rank'] = rank
+        result['within_latency_budget'] = max_latency_ms is None or result['latency_p95_ms'] <= max_latency_ms
+    return ranked
+
+
+def merge_evaluation_split(train_df, holdout_df):
+    """評価用に分割した取引集計を (ユーザー, アイテム) 単位の集計に戻す"""
+    df = pd.concat([train_df, holdout_df], ignore_index=True)
+    df['price_sum'] = df['avg_price'] * df['purchase_count']
+    merged = df.groupby(['user_id', 'product_id'], as_index=False).agg(
+        total_quantity=('total_quantity', 'sum'),
+        price_sum=('price_sum', 'sum'),
+        purchase_count=('purchase_count', 'sum'),
+        days_since_last_purchase=('days_since_last_purchase', 'min')
+    )
+    merged['avg_price'] = merged['price_sum'] / merged['purchase_count']
+    return merged.drop(columns='price_sum')
+
 class RecommendationModel:
     """シンプルな協調フィルタリングレコメンドモデル"""
     
     def __init__(self):
         self.user_item_matrix = None
+        self.user_item_csr = None
         self.svd_model = None
         self.scaler = None
+        self.user_features = None
         self.user_mapping = {}
         self.item_mapping = {}
         self.reverse_user_mapping = {}
         self.reverse_item_mapping = {}
+        self.precomputed_items = None
+        self.precomputed_scores = None
+        self.precomputed_at = None
+        self.ann_index = None
+        self.ann_recall = None
+        self.item_popularity = None
+        self.item_popularity_decayed = None
+        self.popularity_half_life_days = POPULARITY_HALF_LIFE_DAYS
+        self.item_category_codes = None
+        self.item_prices = None
+        self.categories = []
+        self.algorithm = 'user_user'
+        self.item_similarity = None
+        self.item_neighbors = None
+        self.segment_keys = []
+        self.segment_items = None
+        self.segment_scores = None
+        self.segment_min_users = SEGMENT_MIN_USERS
+        self.segment_age_edges = SEGMENT_AGE_EDGES
+        self.stage_timings = {}
+        self.engine = 'svd'
+        self.interaction_counts = {}
+        self.item_factors = None
+        self.als_params = None
+        self.data_through = None
+        self.base_version = None
+        self.n_neighbors = N_NEIGHBORS
+        self.price_weight = PRICE_WEIGHT
+        self.extract = 'stream'
+        self.parquet_source = None
+        self.stream_page_size = STREAM_PAGE_SIZE
+        self.snapshot = None
+        self.snapshot_summary = None
         
-    def prepare_data(self):
-        """BigQueryからデータを取得して前処理"""
+    def prepare_data(self, df=None):
+        """BigQueryからデータを取得して前処理
+
+        Args:
+            df: 取引集計（指定時はクエリせずに使用。評価用の学習期間データなど）
+        """
         logger.info("データ準備開始")
+        if df is None and self.extract == 'stream':
+            if self.prepare_data_streaming(self.transaction_batches()):
+                logger.info(
+                    f"ユーザー-アイテム行列: {self.user_item_csr.shape}, 非ゼロ要素 {self.user_item_csr.nnz}"
+                )
+                return self.user_item_csr
+            # サンプルデータ生成
+            df = self.generate_sample_data()
+        if df is None:
+            df = self.load_transactions()
         
-        # BigQueryクライアント
-        client = bigquery.Client(project=PROJECT_ID)
+        with log_stage('build_matrix', self.stage_timings):
+            # ユーザー・アイテムID の番号付け（ID昇順 = インデックス順）
+            unique_users, user_idx = np.unique(df['user_id'].to_numpy(), return_inverse=True)
+            unique_items, item_idx = np.unique(df['product_id'].to_numpy(), return_inverse=True)
+            
+            self.user_mapping = {user: idx for idx, user in enumerate(unique_users.tolist())}
+            self.item_mapping = {item: idx for idx, item in enumerate(unique_items.tolist())}
+            self.reverse_user_mapping = {idx: user for user, idx in self.user_mapping.items()}
+            self.reverse_item_mapping = {idx: item for item, idx in self.item_mapping.items()}
+            
+            shape = (len(unique_users), len(unique_items))
+            self.user_item_csr, self.interaction_counts = build_interaction_matrix(
+                df, user_idx, item_idx, shape, self.price_weight
+            )
+            self.user_item_matrix = self.user_item_csr
         
-        # 取引データ取得
-        query = f"""
+        self.compute_popularity(df)
+        
+        logger.info(f"ユーザー-アイテム行列: {self.user_item_csr.shape}, 非ゼロ要素 {self.user_item_csr.nnz}")
+        return self.user_item_csr
+    
+    def transactions_query(self):
+        """直近90日の取引を (ユーザー, アイテム) 単位に集計するクエリ"""
+        return f"""
         SELECT 
             user_id,
             product_id,
             SUM(quantity) as total_quantity,
             AVG(price) as avg_price,
-            COUNT(*) as purchase_count
+            COUNT(*) as purchase_count,
+            TIMESTAMP_DIFF(CURRENT_TIMESTAMP(), MAX(timestamp), DAY) as days_since_last_purchase
         FROM `{PROJECT_ID}.{DATASET_ID}.transactions`
         WHERE timestamp >= TIMESTAMP_SUB(CURRENT_TIMESTAMP(), INTERVAL 90 DAY)
         GROUP BY user_id, product_id
         HAVING total_quantity > 0
         """
+    
+    def daily_transactions_query(self):
+        """@start 以降の取引を (日, ユーザー, アイテム) 単位に集計するクエリ（スナップショット用）
+
+        日をまたいで集計し直せるよう、平均・経過日数の代わりに合計・件数・最終購入時刻を持つ。
+        """
+        return f"""
+        SELECT 
+            DATE(timestamp) as day,
+            user_id,
+            product_id,
+            SUM(quantity) as sum_quantity,
+            SUM(price) as sum_price,
+            COUNT(price) as price_count,
+            COUNT(*) as purchase_count,
+            MAX(timestamp) as last_purchase
+        FROM `{PROJECT_ID}.{DATASET_ID}.transactions`
+        WHERE timestamp >= @start
+        GROUP BY day, user_id, product_id
+        """
+    
+    def query_batches(self, query, job_config=None):
+        """BigQuery の結果を Arrow レコードバッチでページ単位に取得
+
+        google-cloud-bigquery-storage があれば Storage Read API を使用する。
+        """
+        bqstorage_client = None
+        try:
+            from google.cloud import bigquery_storage
+            bqstorage_client = bigquery_storage.BigQueryReadClient()
+        except ImportError:
+            logger.warning("google-cloud-bigquery-storage が未導入のため REST API でページ取得します")
         
-        df = client.query(query).to_dataframe()
+        client = bigquery.Client(project=PROJECT_ID)
+        rows = client.query(query, job_config=job_config).result(page_size=self.stream_page_size)
+        yield from rows.to_arrow_iterable(bqstorage_client=bqstorage_client)
+    
+    def daily_transaction_batches(self, start):
+        """start 以降の日別集計を Arrow レコードバッチで取得"""
+        job_config = bigquery.QueryJobConfig(
+            query_parameters=[bigquery.ScalarQueryParameter('start', 'TIMESTAMP', start)]
+        )
+        return self.query_batches(self.daily_transactions_query(), job_config)
+    
+    def transaction_batches(self):
+        """取引集計を Arrow レコードバッチで逐次取得
+
+        parquet_source 指定時はローカル Parquet、snapshot 指定時は差分取得で更新した
+        日別集計のスナップショット、それ以外は BigQuery の結果をページ単位で読む。
+        スナップショットの更新に失敗した場合は BigQuery で全期間を集計する。
+        """
+        # 取引データ取得（インクリメンタル更新はこの時刻以降の取引が対象）
+        now = datetime.now(timezone.utc)
+        self.data_through = now.isoformat()
+        if self.parquet_source:
+            logger.info(f"取引データ取得（Parquet）: {self.parquet_source}")
+            yield from iter_parquet_batches(self.parquet_source, self.stream_page_size)
+            return
+        
+        if self.snapshot is not None:
+            try:
+                with log_stage('snapshot_refresh', self.stage_timings):
+                    self.snapshot.load()
+                    self.snapshot_summary = self.snapshot.refresh(self.daily_transaction_batches, now)
+            except Exception as e:
+                logger.warning(f"取引スナップショット更新エラー（BigQuery で全期間を集計）: {str(e)}")
+                self.snapshot_summary = None
+            else:
+                yield from self.snapshot.batches(now, self.stream_page_size)
+                return
+        
+        yield from self.query_batches(self.transactions_query())
+    
+    def prepare_data_streaming(self, batches):
+        """レコードバッチから購入行列を作成（取引集計全体を DataFrame に展開しない）
+
+        Returns:
+            取引が1件以上あれば True
+        """
+        accumulator = InteractionAccumulator(self.price_weight, self.popularity_half_life_days)
+        with log_stage('build_matrix', self.stage_timings):
+            n_batches = 0
+            for batch in batches:
+                accumulator.add(batch)
+                n_batches += 1
+            logger.info(f"取引データ取得: {accumulator.size}件（{n_batches}バッチ）")
+            if accumulator.size == 0:
+                return False
+            
+            user_ids, item_ids, self.user_item_csr, self.interaction_counts, decayed = accumulator.finalize()
+        
+        self.user_mapping = {user: idx for idx, user in enumerate(user_ids.tolist())}
+        self.item_mapping = {item: idx for idx, item in enumerate(item_ids.tolist())}
+        self.reverse_user_mapping = {idx: user for user, idx in self.user_mapping.items()}
+        self.reverse_item_mapping = {idx: item for item, idx in self.item_mapping.items()}
+        self.user_item_matrix = self.user_item_csr
+        self.item_popularity = np.asarray(self.user_item_csr.sum(axis=0)).ravel().astype(np.float32)
+        self.item_popularity_decayed = decayed
+        return True
+    
+    def load_transactions(self):
+        """直近90日の取引を (ユーザー, アイテム) 単位に集計して取得（データがない場合はサンプル）"""
+        # 取引データ取得（インクリメンタル更新はこの時刻以降の取引が対象）
+        self.data_through = datetime.now(timezone.utc).isoformat()
+        if self.parquet_source:
+            df = pd.read_parquet(self.parquet_source, columns=TRANSACTION_COLUMNS)
+        else:
+            # BigQueryクライアント
+            client = bigquery.Client(project=PROJECT_ID)
+            df = client.query(self.transactions_query()).to_dataframe()
         logger.info(f"取引データ取得: {len(df)}件")
         
         if len(df) == 0:
             # サンプルデータ生成
             df = self.generate_sample_data()
+        return df
+    
+    def load_evaluation_split(self, holdout_days=EVALUATION_HOLDOUT_DAYS):
+        """直近 holdout_days 日をホールドアウトとする時間分割で取引集計を取得
+
+        クエリの基準時刻を data_through に記録する（分割を結合して学習したモデルの
+        インクリメンタル更新はこの時刻以降の取引が対象）。
+
+        Returns:
+            (train_df, holdout_df): prepare_data と同じ列の取引集計
+        """
+        self.data_through = datetime.now(timezone.utc).isoformat()
+        client = bigquery.Client(project=PROJECT_ID)
+        query = f"""
+        SELECT 
+            user_id,
+            product_id,
+            timestamp >= TIMESTAMP_SUB(CURRENT_TIMESTAMP(), INTERVAL @holdout_days DAY) as is_holdout,
+            SUM(quantity) as total_quantity,
+            AVG(price) as avg_price,
+            COUNT(*) as purchase_count,
+            TIMESTAMP_DIFF(CURRENT_TIMESTAMP(), MAX(timestamp), DAY) as days_since_last_purchase
+        FROM `{PROJECT_ID}.{DATASET_ID}.transactions`
+        WHERE timestamp >= TIMESTAMP_SUB(CURRENT_TIMESTAMP(), INTERVAL 90 DAY)
+        GROUP BY user_id, product_id, is_holdout
+        HAVING total_quantity > 0
+        """
+        job_config = bigquery.QueryJobConfig(
+            query_parameters=[bigquery.ScalarQueryParameter('holdout_days', 'INT64', holdout_days)]
+        )
+        df = client.query(query, job_config=job_config).to_dataframe()
         
-        # ユーザー・アイテムマッピング作成
-        unique_users = df['user_id'].unique()
-        unique_items = df['product_id'].unique()
+        if len(df) == 0:
+            # サンプルデータは最終購入からの経過日数で分割
+            df = self.generate_sample_data()
+            df['is_holdout'] = df['days_since_last_purchase'] < holdout_days
         
-        self.user_mapping = {user: idx for idx, user in enumerate(unique_users)}
-        self.item_mapping = {item: idx for idx, item in enumerate(unique_items)}
-        self.reverse_user_mapping = {idx: user for user, idx in self.user_mapping.items()}
-        self.reverse_item_mapping = {idx: item for item, idx in self.item_mapping.items()}
+        is_holdout = df['is_holdout'].astype(bool).to_numpy()
+        train_df = df[~is_holdout].drop(columns='is_holdout')
+        holdout_df = df[is_holdout].drop(columns='is_holdout')
+        logger.info(f"評価用データ分割: 学習 {len(train_df)}件, ホールドアウト {len(holdout_df)}件（直近{holdout_days}日）")
+        return train_df, holdout_df
+    
+    def compute_popularity(self, df):
+        """アイテム人気度（累計・時間減衰）を計算
+
+        累計は購入行列の列和、時間減衰は最終購入からの経過日数に応じて
+        半減期 popularity_half_life_days で重みを下げた購入スコアの和
+        """
+        self.item_popularity = np.asarray(self.user_item_csr.sum(axis=0)).ravel().astype(np.float32)
+        
+        item_idx = df['product_id'].map(self.item_mapping).to_numpy()
+        scores = df['purchase_count'].to_numpy(dtype=np.float64) * np.log1p(df['avg_price'].to_numpy(dtype=np.float64))
+        days = df['days_since_last_purchase'].fillna(0).to_numpy(dtype=np.float64)
+        decay = np.power(0.5, days / self.popularity_half_life_days)
+        self.item_popularity_decayed = np.bincount(
+            item_idx, weights=scores * decay, minlength=len(self.item_mapping)
+        ).astype(np.float32)
+    
+    def load_item_categories(self):
+        """products テーブルからアイテムのカテゴリと価格を取得
+
+        item_category_codes はアイテムインデックス順のカテゴリ番号（不明は -1）、
+        item_prices は同じ順の価格（不明は NaN）
+        """
+        client = bigquery.Client(project=PROJECT_ID)
+        query = f"""
+        SELECT product_id, category, price
+        FROM `{PROJECT_ID}.{DATASET_ID}.products`
+        """
+        products = client.query(query).to_dataframe()
+        
+        prices = np.full(len(self.item_mapping), np.nan, dtype=np.float32)
+        if len(products) > 0:
+            item_idx = products['product_id'].map(self.item_mapping)
+            known = item_idx.notna().to_numpy()
+            prices[item_idx[known].to_numpy(dtype=np.int64)] = products['price'].to_numpy(
+                dtype=np.float64, na_value=np.nan
+            )[known]
+        self.item_prices = prices
+        
+        codes = np.full(len(self.item_mapping), -1, dtype=np.int32)
+        categories = []
+        if len(products) > 0:
+            products = products.dropna(subset=['category'])
+            categories = sorted(products['category'].astype(str).unique())
+            category_codes = {category: code for code, category in enumerate(categories)}
+            for product_id, category in zip(products['product_id'], products['category'].astype(str)):
+                item_idx = self.item_mapping.get(product_id)
+                if item_idx is not None:
+                    codes[item_idx] = category_codes[category]
+        
+        self.item_category_codes = codes
+        self.categories = categories
+        logger.info(f"アイテムカテゴリ: {len(categories)}種類, 不明 {int(np.sum(codes < 0))}件")
+    
+    def build_segment_rankings(self, top_n=SEGMENT_TOP_N, min_users=SEGMENT_MIN_USERS):
+        """デモグラフィックセグメント別の人気ランキングを計算
+
+        users テーブルの属性から各既知ユーザーを3階層のセグメント（segment_keys）に割り当て、
+        セグメント内ユーザーの購入スコア合計で上位 top_n 件を求める。
+        ユーザー数が min_users 未満のセグメントは保存せず、API 側で上位階層に後退する。
+        """
+        client = bigquery.Client(project=PROJECT_ID)
+        query = f"""
+        SELECT user_id, age, gender, city
+        FROM `{PROJECT_ID}.{DATASET_ID}.users`
+        """
+        users = client.query(query).to_dataframe()
+        users = users[users['user_id'].isin(self.user_mapping.keys())]
+        
+        self.segment_min_users = min_users
+        self.segment_keys = []
+        self.segment_items = None
+        self.segment_scores = None
+        if len(users) == 0:
+            logger.info("セグメント別人気度: 属性のある既知ユーザーなし")
+            return
+        
+        # segment_keys と同じ規則で列単位にキーを作成
+        age = users['age'].to_numpy(dtype=np.float64, na_value=np.nan)
+        bucket = np.searchsorted(self.segment_age_edges, age, side='right').astype(str).astype(object)
+        bucket[np.isnan(age)] = 'unknown'
+        bucket = pd.Series(bucket, index=users.index)
+        gender = users['gender'].astype(object).where(users['gender'].notna(), None).map(segment_value)
+        city = users['city'].astype(object).where(users['city'].notna(), None).map(segment_value)
+        levels = [bucket + '|' + gender + '|' + city, bucket + '|' + gender, bucket]
+        
+        user_idx = users['user_id'].map(self.user_mapping).to_numpy(dtype=np.int64)
+        codes, keys = pd.factorize(pd.concat(levels, ignore_index=True))
+        counts = np.bincount(codes, minlength=len(keys))
+        kept = np.flatnonzero(counts >= min_users)
+        if len(kept) == 0:
+            logger.info(f"セグメント別人気度: ユーザー数 {min_users} 以上のセグメントなし")
+            return
         
-        # ユーザー-アイテム行列作成
-        matrix_data = []
-        for _, row in df.iterrows():
-            user_idx = self.user_mapping[row['user_id']]
-            item_idx = self.item_mapping[row['product_id']]
-            # スコア計算（購入回数と金額を考慮）
-            score = row['purchase_count'] * np.log1p(row['avg_price'])
-            matrix_data.append([user_idx, item_idx, score])
-        
-        matrix_df = pd.DataFrame(matrix_data, columns=['user', 'item', 'score'])
-        
-        # ピボットテーブル作成
-        self.user_item_matrix = matrix_df.pivot_table(
-            index='user', 
-            columns='item', 
-            values='score', 
-            fill_value=0
+        # セグメント所属の疎行列 × 購入行列でセグメント別の購入スコア合計
+        row_of = np.full(len(keys), -1, dtype=np.int64)
+        row_of[kept] = np.arange(len(kept))
+        rows = row_of[codes]
+        member = rows >= 0
+        membership = sparse.csr_matrix(
+            (np.ones(int(member.sum()), dtype=np.float32), (rows[member], np.tile(user_idx, len(levels))[member])),
+            shape=(len(kept), self.user_item_csr.shape[0])
         )
+        segment_scores = (membership @ self.user_item_csr).toarray()
+        items, scores = top_n_items(segment_scores, segment_scores > 0, top_n)
+        if items.shape[1] < top_n:
+            pad = top_n - items.shape[1]
+            items = np.pad(items, ((0, 0), (0, pad)), constant_values=-1)
+            scores = np.pad(scores, ((0, 0), (0, pad)), constant_values=np.nan)
         
-        logger.info(f"ユーザー-アイテム行列: {self.user_item_matrix.shape}")
-        return self.user_item_matrix
+        self.segment_keys = [str(key) for key in keys[kept]]
+        self.segment_items = items
+        self.segment_scores = scores
+        logger.info(f"セグメント別人気度: {len(kept)}セグメント（全 {len(keys)}、対象ユーザー {len(users)}人）")
     
     def generate_sample_data(self):
         """サンプルデータ生成（データがない場合）"""
@@ -122,33 +1489,437 @@ class RecommendationModel:
                 'purchase_count': purchase_count
             })
         
-        return pd.DataFrame(data)
+        df = pd.DataFrame(data)
+        df['days_since_last_purchase'] = np.random.default_rng(42).integers(0, 90, len(df))
+        return df
     
-    def train(self):
-        """モデル訓練"""
-        logger.info("モデル訓練開始")
+    def train(self, engine='svd', als_params=None, df=None, n_components=N_COMPONENTS):
+        """モデル訓練
+
+        Args:
+            engine: 'svd'（スケーリング + TruncatedSVD）または 'als'（暗黙的フィードバックALS）
+            als_params: fit_als に渡す設定
+            df: 学習に使う取引集計（省略時は BigQuery から取得）
+            n_components: SVD の次元数
+        """
+        logger.info(f"モデル訓練開始 (engine={engine})")
         
         # データ準備
-        matrix = self.prepare_data()
+        with log_stage('prepare_data', self.stage_timings):
+            self.prepare_data(df)
         
-        # データ正規化
-        self.scaler = StandardScaler()
-        scaled_matrix = self.scaler.fit_transform(matrix)
+        if engine == 'als':
+            self.fit_als(**(als_params or {}))
+        else:
+            self.fit_svd(n_components)
+        
+        logger.info(f"モデル訓練完了: ピークメモリ {peak_memory_mb():.0f}MB")
+    
+    def fit_svd(self, n_components=N_COMPONENTS):
+        """購入行列のスケーリング + TruncatedSVD でユーザー特徴量を学習"""
+        matrix = self.user_item_csr
+        self.engine = 'svd'
         
-        # SVD次元削減
-        n_components = min(50, min(matrix.shape) - 1)
-        self.svd_model = TruncatedSVD(n_components=n_components, random_state=42)
-        user_features = self.svd_model.fit_transform(scaled_matrix)
+        # データ正規化（疎行列のまま列の標準偏差でスケーリング。平均は引かない）
+        with log_stage('scale', self.stage_timings):
+            self.scaler = StandardScaler(with_mean=False)
+            scaled_matrix = self.scaler.fit_transform(matrix)
+        
+        # SVD次元削減（疎行列に対して直接実行）
+        with log_stage('svd', self.stage_timings):
+            n_components = min(n_components, min(matrix.shape) - 1)
+            self.svd_model = TruncatedSVD(n_components=n_components, random_state=42)
+            user_features = self.svd_model.fit_transform(scaled_matrix)
         
         # ユーザー特徴量を保存
         self.user_features = user_features
         
         # モデル評価（簡易）
-        reconstructed = self.svd_model.inverse_transform(user_features)
-        mse = np.mean((scaled_matrix - reconstructed) ** 2)
+        # 成分は正規直交のため ||X - U V||^2 = ||X||^2 - ||U||^2 で、再構成行列を作らずに求める
+        squared_error = scaled_matrix.multiply(scaled_matrix).sum() - np.sum(user_features ** 2)
+        mse = max(float(squared_error), 0.0) / (matrix.shape[0] * matrix.shape[1])
         logger.info(f"再構成MSE: {mse:.4f}")
+    
+    def confidence_matrix(self, alpha=ALS_ALPHA, signal='purchase_count'):
+        """ALS用の信頼度行列 c_ui = 1 + alpha * log1p(signal)（購入行列と同じ非ゼロ構造）"""
+        counts = self.interaction_counts[signal]
+        return sparse.csr_matrix(
+            (1.0 + alpha * np.log1p(counts), self.user_item_csr.indices, self.user_item_csr.indptr),
+            shape=self.user_item_csr.shape
+        )
+    
+    def fit_als(self, n_factors=ALS_FACTORS, regularization=ALS_REGULARIZATION, alpha=ALS_ALPHA,
+                iterations=ALS_ITERATIONS, cg_steps=ALS_CG_STEPS, n_threads=None,
+                signal='purchase_count'):
+        """暗黙的フィードバックALSでユーザー・アイテム因子を学習
+
+        以降の事前計算・レコメンドは因子の内積によるスコアリングになる
+        """
+        self.engine = 'als'
+        n_factors = min(n_factors, min(self.user_item_csr.shape))
+        with log_stage('als', self.stage_timings):
+            user_factors, item_factors = train_als(
+                self.confidence_matrix(alpha, signal), n_factors=n_factors,
+                regularization=regularization, iterations=iterations,
+                cg_steps=cg_steps, n_threads=n_threads
+            )
+        self.user_features = user_factors
+        self.item_factors = item_factors
+        self.als_params = {'regularization': regularization, 'alpha': alpha, 'signal': signal}
+        self.algorithm = 'als'
+        self.svd_model = None
+        self.scaler = None
+    
+    def compare_engines(self, als_params=None):
+        """同じ購入行列で SVD と ALS の学習時間・メモリを比較
+
+        メモリは tracemalloc による学習中の割り当てピーク（MB）。
+        学習結果はこのモデルには反映しない。
+        """
+        report = {}
+        for engine in ('svd', 'als'):
+            other = RecommendationModel()
+            other.user_item_csr = self.user_item_csr
+            other.interaction_counts = self.interaction_counts
+            
+            tracemalloc.start()
+            started = time.perf_counter()
+            if engine == 'als':
+                other.fit_als(**(als_params or {}))
+            else:
+                other.fit_svd()
+            elapsed = time.perf_counter() - started
+            _, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            
+            report[engine] = {'seconds': round(elapsed, 3), 'peak_traced_mb': round(peak / 1024 ** 2, 1)}
+            logger.info(f"学習比較 {engine}: {elapsed:.2f}秒, 割り当てピーク {peak / 1024 ** 2:.0f}MB")
+        return report
+    
+    def load_updated_interactions(self, since):
+        """since 以降に取引があったユーザーの取引集計を取得（インクリメンタル更新用）
+
+        prepare_data と同じ直近90日の集計を更新対象ユーザーに絞って実行するため、
+        各ユーザーの行はフル再学習時と同じ内容になる。
+        """
+        client = bigquery.Client(project=PROJECT_ID)
+        query = f"""
+        SELECT 
+            user_id,
+            product_id,
+            SUM(quantity) as total_quantity,
+            AVG(price) as avg_price,
+            COUNT(*) as purchase_count,
+            TIMESTAMP_DIFF(CURRENT_TIMESTAMP(), MAX(timestamp), DAY) as days_since_last_purchase
+        FROM `{PROJECT_ID}.{DATASET_ID}.transactions`
+        WHERE timestamp >= TIMESTAMP_SUB(CURRENT_TIMESTAMP(), INTERVAL 90 DAY)
+          AND user_id IN (
+            SELECT DISTINCT user_id
+            FROM `{PROJECT_ID}.{DATASET_ID}.transactions`
+            WHERE timestamp >= @since
+          )
+        GROUP BY user_id, product_id
+        HAVING total_quantity > 0
+        """
+        job_config = bigquery.QueryJobConfig(
+            query_parameters=[bigquery.ScalarQueryParameter('since', 'TIMESTAMP', since)]
+        )
+        
+        self.data_through = datetime.now(timezone.utc).isoformat()
+        df = client.query(query, job_config=job_config).to_dataframe()
+        logger.info(f"更新取引データ取得 (since={since.isoformat()}): {len(df)}件")
+        return df
+    
+    def project_users(self, rows, interaction_counts):
+        """購入行を学習済みの因子空間に射影
+
+        SVD は保存済みの scaler / svd_model による変換、ALS はアイテム因子を固定した
+        信頼度付き最小二乗（因子数ステップの共役勾配法で厳密に解く）。
+        """
+        if self.item_factors is not None:
+            params = self.als_params or {}
+            counts = interaction_counts[params.get('signal', 'purchase_count')]
+            confidence = sparse.csr_matrix(
+                (1.0 + params.get('alpha', ALS_ALPHA) * np.log1p(counts), rows.indices, rows.indptr),
+                shape=rows.shape
+            )
+            item_factors = np.asarray(self.item_factors, dtype=np.float32)
+            n_factors = item_factors.shape[1]
+            return _als_cg_block(
+                confidence, np.zeros((rows.shape[0], n_factors), dtype=np.float32), item_factors,
+                item_factors.T @ item_factors, params.get('regularization', ALS_REGULARIZATION), n_factors
+            )
+        
+        # 平均を引く旧形式のスケーラーは密行列が必要
+        scaled = self.scaler.transform(rows.toarray() if self.scaler.with_mean else rows)
+        return self.svd_model.transform(scaled)
+    
+    def fold_in(self, df, block_size=PRECOMPUTE_BLOCK_SIZE, n_workers=None):
+        """更新ユーザーの購入行を再学習せずにモデルへ反映
+
+        既存ユーザーの行は置き換え、新規ユーザーはID昇順を保って追加する。
+        ユーザー特徴量は project_users で射影し、事前計算レコメンドは更新ユーザーの行だけ、
+        ANN インデックスは既存の重心への割り当てだけをやり直す。
+        アイテム側（アイテム集合・SVD成分・アイテム因子・類似度・セグメント・時間減衰人気度）は
+        基準モデルのままのため、ずれは定期的なフル再学習で解消する。
+
+        Returns:
+            反映件数の dict
+        """
+        n_old = len(self.user_mapping)
+        n_items = len(self.item_mapping)
+        
+        # 既知アイテムの取引のみ（新商品はフル再学習まで対象外）
+        item_idx = df['product_id'].map(self.item_mapping)
+        known = item_idx.notna().to_numpy()
+        df = df[known]
+        item_idx = item_idx[known].to_numpy(dtype=np.int64)
+        
+        changed_users, row_idx = np.unique(df['user_id'].to_numpy(), return_inverse=True)
+        rows, interaction_counts = build_interaction_matrix(
+            df, row_idx, item_idx, (len(changed_users), n_items), self.price_weight
+        )
+        features = self.project_users(rows, interaction_counts)
+        
+        # 新しいID順での各ユーザーの行の出所（基準モデルの行 / 更新行）
+        old_ids = np.array([self.reverse_user_mapping[i] for i in range(n_old)], dtype=np.int64)
+        user_ids = np.union1d(old_ids, changed_users.astype(np.int64))
+        source = np.empty(len(user_ids), dtype=np.int64)
+        source[np.searchsorted(user_ids, old_ids)] = np.arange(n_old)
+        changed_idxs = np.searchsorted(user_ids, changed_users)
+        source[changed_idxs] = n_old + np.arange(len(changed_users))
+        
+        self.user_mapping = {int(user): idx for idx, user in enumerate(user_ids)}
+        self.reverse_user_mapping = {idx: user for user, idx in self.user_mapping.items()}
+        self.user_item_csr = sparse.vstack([self.user_item_csr, rows], format='csr')[source]
+        self.user_item_matrix = self.user_item_csr
+        self.user_features = np.vstack([
+            self.user_features, features.astype(self.user_features.dtype)
+        ])[source]
+        self.interaction_counts = {}
+        self.item_popularity = np.asarray(self.user_item_csr.sum(axis=0)).ravel().astype(np.float32)
+        
+        if self.ann_index is not None:
+            # 既存ユーザーはクラスタを維持し、更新ユーザーのみ最も近い重心に割り当て
+            offsets = self.ann_index['list_offsets']
+            labels = np.empty(n_old, dtype=np.int64)
+            labels[self.ann_index['list_members']] = np.repeat(np.arange(len(offsets) - 1), np.diff(offsets))
+            changed_labels = np.argmax(normalize_rows(features) @ self.ann_index['centroids'].T, axis=1)
+            self.ann_index.update(ivf_lists(np.concatenate([labels, changed_labels])[source], len(offsets) - 1))
+            self.ann_recall = None
+        
+        if self.precomputed_items is not None:
+            top_n = self.precomputed_items.shape[1]
+            self.precomputed_items = np.vstack([
+                self.precomputed_items, np.full((len(changed_users), top_n), -1, dtype=np.int32)
+            ])[source]
+            self.precomputed_scores = np.vstack([
+                self.precomputed_scores, np.full((len(changed_users), top_n), np.nan, dtype=np.float32)
+            ])[source]
+            self.precompute_recommendations(
+                top_n=top_n, block_size=block_size, n_workers=n_workers, user_idxs=changed_idxs
+            )
+        
+        n_added = len(user_ids) - n_old
+        logger.info(
+            f"インクリメンタル反映: 更新 {len(changed_users) - n_added}人, 追加 {n_added}人, "
+            f"未知アイテムの取引 {int((~known).sum())}件（対象外）"
+        )
+        return {
+            'updated_users': int(len(changed_users) - n_added),
+            'added_users': int(n_added),
+            'skipped_unknown_item_rows': int((~known).sum())
+        }
+    
+    def build_item_similarity(self, k=ITEM_NEIGHBORS, block_size=ITEM_SIMILARITY_BLOCK_SIZE):
+        """アイテムベース協調フィルタリング用の類似度行列構築
+
+        以降の事前計算・レコメンドはアイテム類似度によるスコアリングになる
+        """
+        logger.info(f"アイテム類似度計算開始: items={self.user_item_csr.shape[1]}, k={k}")
+        self.item_similarity = build_item_similarity(self.user_item_csr, k=k, block_size=block_size)
+        self.item_neighbors = k
+        self.algorithm = 'item_item'
+        logger.info(f"アイテム類似度計算完了: nnz={self.item_similarity.nnz}")
+    
+    def scoring_initargs(self):
+        """バッチスコアリングワーカー（_init_scoring_worker）の初期化引数"""
+        return (self.user_features, self.user_item_csr, self.item_similarity, self.item_factors, self.n_neighbors)
+    
+    def measure_latency(self, sample_size=SWEEP_LATENCY_SAMPLE, n_recommendations=EVALUATION_K,
+                        clock=time.perf_counter):
+        """1ユーザーずつのスコアリング時間（API のライブスコアリング相当）を計測
+
+        Args:
+            clock: 計測に使う時計（並列実行中は time.process_time で他プロセスの影響を除く）
+
+        Returns:
+            {'latency_p50_ms', 'latency_p95_ms'}
+        """
+        n_users = self.user_item_csr.shape[0]
+        rng = np.random.default_rng(42)
+        sample = rng.choice(n_users, min(sample_size, n_users), replace=False)
+        
+        _init_scoring_worker(*self.scoring_initargs())
+        timings = np.empty(len(sample))
+        for i, user_idx in enumerate(sample):
+            started = clock()
+            _score_user_block((np.array([user_idx]), n_recommendations))
+            timings[i] = (clock() - started) * 1000
+        return {
+            'latency_p50_ms': round(float(np.percentile(timings, 50)), 3),
+            'latency_p95_ms': round(float(np.percentile(timings, 95)), 3)
+        }
+    
+    def score_users(self, user_idxs, top_n, block_size=PRECOMPUTE_BLOCK_SIZE, n_workers=None):
+        """ユーザーをブロックに分割してプロセスプールで上位N件をスコアリング
+
+        Yields:
+            (user_idxs, items, scores): ブロックごとの _score_user_block の結果
+        """
+        n_workers = n_workers or os.cpu_count() or 1
+        blocks = [
+            (user_idxs[start:start + block_size], top_n)
+            for start in range(0, len(user_idxs), block_size)
+        ]
+        
+        initargs = self.scoring_initargs()
+        if n_workers <= 1 or len(blocks) <= 1:
+            _init_scoring_worker(*initargs)
+            for block in blocks:
+                yield _score_user_block(block)
+        else:
+            with ProcessPoolExecutor(
+                max_workers=n_workers,
+                initializer=_init_scoring_worker,
+                initargs=initargs
+            ) as executor:
+                yield from executor.map(_score_user_block, blocks)
+    
+    def evaluate(self, holdout_df, k=EVALUATION_K, block_size=PRECOMPUTE_BLOCK_SIZE, n_workers=None):
+        """ホールドアウト期間の購入に対するランキング指標を計算
+
+        対象は学習済みユーザーのうち、ホールドアウト期間に学習期間で未購入の既知アイテムを
+        購入したユーザー（レコメンドは購入済みアイテムを除外するため）。
+        上位K件は score_users でブロック単位に並列計算し、ヒット判定と指標は
+        (ユーザー × K) の配列でまとめて求める。
+
+        Returns:
+            precision / recall / ndcg @K、カタログカバレッジ、スコアリングスループットの dict
+        """
+        n_items = len(self.item_mapping)
+        user_idx = holdout_df['user_id'].map(self.user_mapping)
+        item_idx = holdout_df['product_id'].map(self.item_mapping)
+        known = (user_idx.notna() & item_idx.notna()).to_numpy()
+        user_idx = user_idx[known].to_numpy(dtype=np.int64)
+        item_idx = item_idx[known].to_numpy(dtype=np.int64)
         
-        logger.info("モデル訓練完了")
+        # 学習期間に購入済みのペアを除いた正解（ユーザー × アイテムのキー、重複なし）
+        keys = np.unique(user_idx * n_items + item_idx)
+        purchased = self.user_item_csr
+        bought = np.repeat(np.arange(purchased.shape[0]), np.diff(purchased.indptr)) * n_items + purchased.indices
+        keys = keys[~np.isin(keys, bought)]
+        eval_users, n_relevant = np.unique(keys // n_items, return_counts=True)
+        
+        n_eval = len(eval_users)
+        logger.info(
+            f"評価開始: users={n_eval}, K={k}, 未知ユーザー/アイテムの取引 {int((~known).sum())}件は対象外"
+        )
+        if n_eval == 0:
+            return {'k': k, 'n_eval_users': 0}
+        
+        recommended = np.full((n_eval, k), -1, dtype=np.int64)
+        row_of = np.full(purchased.shape[0], -1, dtype=np.int64)
+        row_of[eval_users] = np.arange(n_eval)
+        started = time.perf_counter()
+        for block_idxs, items, _ in self.score_users(eval_users, k, block_size, n_workers):
+            recommended[row_of[block_idxs]] = items
+        elapsed = time.perf_counter() - started
+        
+        # ヒット判定（不足分の -1 はヒットしない）
+        hits = (recommended >= 0) & np.isin(eval_users[:, np.newaxis] * n_items + recommended, keys)
+        discounts = 1.0 / np.log2(np.arange(2, k + 2))
+        dcg = hits @ discounts
+        idcg = np.cumsum(discounts)[np.minimum(n_relevant, k) - 1]
+        n_hits = hits.sum(axis=1)
+        
+        recommended_items = recommended[recommended >= 0]
+        report = {
+            'k': k,
+            'n_eval_users': int(n_eval),
+            'n_holdout_pairs': int(len(keys)),
+            f'precision_at_{k}': float(np.mean(n_hits / k)),
+            f'recall_at_{k}': float(np.mean(n_hits / n_relevant)),
+            f'ndcg_at_{k}': float(np.mean(dcg / idcg)),
+            'hit_rate': float(np.mean(n_hits > 0)),
+            'catalog_coverage': float(len(np.unique(recommended_items)) / n_items),
+            'scoring_seconds': round(elapsed, 3),
+            'users_per_second': round(n_eval / elapsed, 1) if elapsed > 0 else None
+        }
+        logger.info(f"評価結果: {report}")
+        return report
+    
+    def precompute_recommendations(self, top_n=PRECOMPUTE_TOP_N,
+                                   block_size=PRECOMPUTE_BLOCK_SIZE, n_workers=None, user_idxs=None):
+        """全既知ユーザーの上位N件レコメンドを事前計算
+
+        ユーザーをブロックに分割し、プロセスプールで並列にスコアリングする。
+        結果は (ユーザー数 × top_n) の配列としてモデルと一緒に保存される。
+        user_idxs を指定した場合は既存の配列のうち該当ユーザーの行だけを計算し直す。
+        その場合、他のユーザーの行は前回の計算のままのため precomputed_at は
+        前回の時刻を維持する（API は最も古い行の時刻で鮮度を判定する）。
+        """
+        n_users = self.user_features.shape[0]
+        partial = user_idxs is not None
+        
+        if not partial:
+            user_idxs = np.arange(n_users)
+            self.precomputed_items = np.full((n_users, top_n), -1, dtype=np.int32)
+            self.precomputed_scores = np.full((n_users, top_n), np.nan, dtype=np.float32)
+        logger.info(f"レコメンド事前計算開始: users={len(user_idxs)}/{n_users}, top_n={top_n}")
+        
+        for block_idxs, items, scores in self.score_users(user_idxs, top_n, block_size, n_workers):
+            self.precomputed_items[block_idxs] = items
+            self.precomputed_scores[block_idxs] = scores
+        
+        if not partial or self.precomputed_at is None:
+            self.precomputed_at = datetime.now(timezone.utc).isoformat()
+        logger.info(f"レコメンド事前計算完了: {self.precomputed_items.shape}")
+        
+    def build_ann_index(self, n_lists=None, n_probe=ANN_N_PROBE,
+                        recall_sample_size=ANN_RECALL_SAMPLE_SIZE, recall_k=ANN_RECALL_K):
+        """類似ユーザー検索用のIVFインデックス構築と recall@recall_k 評価
+
+        recall はスコアリングに使う近傍数（n_neighbors）によらず recall_k で計測する。
+        """
+        logger.info("ANNインデックス構築開始")
+        normalized_features = normalize_rows(self.user_features)
+        self.ann_index = build_ivf_index(normalized_features, n_lists=n_lists)
+        self.ann_index['n_probe'] = n_probe
+        n_lists = len(self.ann_index['centroids'])
+        logger.info(f"ANNインデックス構築完了: n_lists={n_lists}")
+        
+        # 厳密検索との recall@recall_k 比較
+        n_users = normalized_features.shape[0]
+        rng = np.random.default_rng(42)
+        sample = rng.choice(n_users, min(recall_sample_size, n_users), replace=False)
+        probes = sorted({p for p in (1, 2, 4, 8, 16, 32, n_probe) if p <= n_lists})
+        
+        hits = {p: 0 for p in probes}
+        total = 0
+        for user_idx in sample:
+            query = normalized_features[user_idx]
+            exact, _ = search_similar_users_exact(query, normalized_features, recall_k, exclude=user_idx)
+            total += len(exact)
+            for p in probes:
+                approx, _ = search_similar_users_ivf(
+                    query, normalized_features, self.ann_index, recall_k, p, exclude=user_idx
+                )
+                hits[p] += len(np.intersect1d(exact, approx))
+        
+        self.ann_recall = {str(p): hits[p] / total if total else 1.0 for p in probes}
+        for p in probes:
+            logger.info(f"ANN recall@{recall_k} (n_probe={p}): {self.ann_recall[str(p)]:.4f}")
         
     def get_recommendations(self, user_id, n_recommendations=5):
         """レコメンド生成"""
@@ -157,40 +1928,44 @@ class RecommendationModel:
             return self.get_popular_items(n_recommendations)
         
         user_idx = self.user_mapping[user_id]
-        user_vector = self.user_features[user_idx].reshape(1, -1)
-        
-        # 全ユーザーとの類似度計算
-        similarities = cosine_similarity(user_vector, self.user_features)[0]
-        
-        # 類似ユーザー取得
-        similar_users = np.argsort(similarities)[::-1][1:11]  # 上位10人
-        
-        # 類似ユーザーの購入履歴から推薦
-        recommendations = {}
-        for similar_user_idx in similar_users:
-            similar_user_purchases = self.user_item_matrix.iloc[similar_user_idx]
-            for item_idx, score in similar_user_purchases.items():
-                if score > 0:  # 購入済み
-                    if item_idx not in recommendations:
-                        recommendations[item_idx] = 0
-                    recommendations[item_idx] += score * similarities[similar_user_idx]
-        
-        # 既に購入済みの商品を除外
-        user_purchases = self.user_item_matrix.iloc[user_idx]
-        for item_idx in user_purchases[user_purchases > 0].index:
-            recommendations.pop(item_idx, None)
-        
-        # スコア順でソート
-        sorted_recommendations = sorted(
-            recommendations.items(), 
-            key=lambda x: x[1], 
-            reverse=True
-        )[:n_recommendations]
+        
+        if self.algorithm == 'als':
+            # ユーザー因子とアイテム因子の内積
+            items, scores = score_user_factors(
+                self.user_features, self.item_factors, self.user_item_csr, [user_idx], n_recommendations
+            )
+        elif self.algorithm == 'item_item':
+            # 購入アイテムの類似アイテムを集計
+            items, scores = score_items_by_similarity(
+                self.user_item_csr, self.item_similarity, [user_idx], n_recommendations
+            )
+        else:
+            normalized_features = normalize_rows(self.user_features)
+            
+            # 類似ユーザー取得（上位 n_neighbors 人）
+            similar_users, similarities = search_similar_users_exact(
+                normalized_features[user_idx], normalized_features, self.n_neighbors, exclude=user_idx
+            )
+            
+            # 類似ユーザーの購入履歴から推薦（類似度 × 購入行列の疎行列積）
+            neighbor_rows = self.user_item_csr[similar_users]
+            item_scores = neighbor_rows.T @ similarities
+            
+            # 類似ユーザーが購入済み かつ 本人が未購入のアイテムのみ候補
+            candidates = np.zeros(self.user_item_csr.shape[1], dtype=bool)
+            candidates[neighbor_rows.indices[neighbor_rows.data > 0]] = True
+            start, stop = self.user_item_csr.indptr[user_idx], self.user_item_csr.indptr[user_idx + 1]
+            candidates[self.user_item_csr.indices[start:stop]] = False
+            
+            # スコア上位を取得
+            items, scores = top_n_items(item_scores[np.newaxis, :], candidates[np.newaxis, :], n_recommendations)
         
         # 商品IDに変換
         result = []
-        for item_idx, score in sorted_recommendations:
-            product_id = self.reverse_item_mapping[item_idx]
+        for item_idx, score in zip(items[0], scores[0]):
+            if item_idx < 0:
+                break
+            product_id = self.reverse_item_mapping[int(item_idx)]
             result.append({
                 'product_id': int(product_id),
                 'score': float(score)
@@ -200,12 +1975,13 @@ class RecommendationModel:
     
     def get_popular_items(self, n_items=5):
         """人気商品取得（新規ユーザー向け）"""
-        # アイテムの総購入スコア計算
-        item_scores = self.user_item_matrix.sum(axis=0).sort_values(ascending=False)
+        # アイテムの総購入スコア
+        item_scores = self.item_popularity
+        top_items = np.argsort(-item_scores, kind='stable')[:n_items]
         
         result = []
-        for item_idx, score in item_scores.head(n_items).items():
-            product_id = self.reverse_item_mapping[item_idx]
+        for item_idx, score in zip(top_items, item_scores[top_items]):
+            product_id = self.reverse_item_mapping[int(item_idx)]
             result.append({
                 'product_id': int(product_id),
                 'score': float(score)
@@ -213,37 +1989,221 @@ class RecommendationModel:
         
         return result
     
-    def save_model(self, model_path):
-        """モデル保存"""
-        logger.info(f"モデル保存: {model_path}")
-        
-        model_data = {
-            'svd_model': self.svd_model,
-            'scaler': self.scaler,
-            'user_features': self.user_features,
-            'user_mapping': self.user_mapping,
-            'item_mapping': self.item_mapping,
-            'reverse_user_mapping': self.reverse_user_mapping,
-            'reverse_item_mapping': self.reverse_item_mapping,
-            'user_item_matrix': self.user_item_matrix,
-            'trained_at': datetime.now().isoformat()
+    def save_model(self, model_dir, version=None):
+        """モデル保存
+
+        バージョンごとのディレクトリに生の .npy 配列と manifest.json を書き出す。
+        API は各配列を np.load(mmap_mode='r') で開くため、デシリアライズが不要。
+
+        Returns:
+            manifest の dict
+        """
+        version = version or new_model_version()
+        logger.info(f"モデル保存: {model_dir} (version={version})")
+        os.makedirs(model_dir, exist_ok=True)
+        
+        n_users = len(self.reverse_user_mapping)
+        n_items = len(self.reverse_item_mapping)
+        user_ids = np.array([self.reverse_user_mapping[i] for i in range(n_users)], dtype=np.int64)
+        item_ids = np.array([self.reverse_item_mapping[i] for i in range(n_items)], dtype=np.int64)
+        if np.any(np.diff(user_ids) <= 0) or np.any(np.diff(item_ids) <= 0):
+            raise ValueError("ユーザー・アイテムIDはインデックス順に昇順である必要があります")
+        
+        csr = self.user_item_csr
+        arrays = {
+            'user_ids': user_ids,
+            'item_ids': item_ids,
+            'user_features': np.asarray(self.user_features, dtype=np.float32),
+            'normalized_user_features': normalize_rows(self.user_features),
+            'matrix_indptr': csr.indptr,
+            'matrix_indices': csr.indices,
+            'matrix_data': csr.data.astype(np.float32)
+        }
+        if self.svd_model is not None:
+            arrays['svd_components'] = self.svd_model.components_.astype(np.float32)
+            arrays['scaler_mean'] = self.scaler.mean_
+            arrays['scaler_scale'] = self.scaler.scale_
+        if self.item_factors is not None:
+            # ALS のユーザー因子は user_features として保存済み
+            arrays['item_factors'] = np.asarray(self.item_factors, dtype=np.float32)
+        if self.item_popularity is not None:
+            arrays['popularity_scores'] = self.item_popularity
+            arrays['popularity_order'] = np.argsort(-self.item_popularity, kind='stable').astype(np.int32)
+        if self.item_popularity_decayed is not None:
+            arrays['popularity_decayed_scores'] = self.item_popularity_decayed
+            arrays['popularity_decayed_order'] = np.argsort(
+                -self.item_popularity_decayed, kind='stable'
+            ).astype(np.int32)
+        if self.item_category_codes is not None:
+            arrays['item_category_codes'] = self.item_category_codes
+            if self.categories:
+                # カテゴリごとのアイテム所属ビット列（アイテムインデックス順、API のフィルタ用）
+                arrays['category_bitsets'] = np.stack([
+                    np.packbits(self.item_category_codes == code) for code in range(len(self.categories))
+                ])
+        if self.item_prices is not None:
+            arrays['item_prices'] = self.item_prices
+        if self.segment_items is not None:
+            arrays['segment_items'] = self.segment_items
+            arrays['segment_scores'] = self.segment_scores
+        if self.precomputed_items is not None:
+            arrays['precomputed_items'] = self.precomputed_items
+            arrays['precomputed_scores'] = self.precomputed_scores
+        if self.item_similarity is not None:
+            arrays['item_similarity_indptr'] = self.item_similarity.indptr.astype(np.int64)
+            arrays['item_similarity_indices'] = self.item_similarity.indices.astype(np.int32)
+            arrays['item_similarity_data'] = self.item_similarity.data.astype(np.float32)
+        if self.ann_index is not None:
+            arrays['ann_centroids'] = self.ann_index['centroids']
+            arrays['ann_list_offsets'] = self.ann_index['list_offsets']
+            arrays['ann_list_members'] = self.ann_index['list_members']
+        
+        files = {}
+        for name, array in arrays.items():
+            filename = f"{name}.npy"
+            path = os.path.join(model_dir, filename)
+            np.save(path, np.ascontiguousarray(array))
+            files[name] = {
+                'file': filename,
+                'sha256': file_sha256(path),
+                'size': os.path.getsize(path),
+                'dtype': str(array.dtype),
+                'shape': list(array.shape)
+            }
+        
+        manifest = {
+            'format_version': MODEL_FORMAT_VERSION,
+            'version': version,
+            'trained_at': datetime.now().isoformat(),
+            'precomputed_at': self.precomputed_at,
+            'n_users': n_users,
+            'n_items': n_items,
+            'n_components': int(self.user_features.shape[1]),
+            'engine': self.engine,
+            'als': self.als_params,
+            'base_version': self.base_version,
+            'data_through': self.data_through,
+            'scaler_with_mean': bool(self.scaler.with_mean) if self.scaler is not None else None,
+            'algorithm': self.algorithm,
+            'item_neighbors': self.item_neighbors,
+            'n_neighbors': self.n_neighbors,
+            'price_weight': self.price_weight,
+            'ann_n_probe': self.ann_index['n_probe'] if self.ann_index is not None else None,
+            'popularity_half_life_days': self.popularity_half_life_days,
+            'categories': self.categories,
+            'segments': {
+                'keys': self.segment_keys,
+                'age_edges': list(self.segment_age_edges),
+                'min_users': self.segment_min_users
+            } if self.segment_items is not None else None,
+            'files': files
         }
+        with open(os.path.join(model_dir, 'manifest.json'), 'w') as f:
+            json.dump(manifest, f, indent=2)
         
-        joblib.dump(model_data, model_path)
+        return manifest
         
-    def load_model(self, model_path):
+    def load_model(self, model_dir):
         """モデル読み込み"""
-        logger.info(f"モデル読み込み: {model_path}")
-        
-        model_data = joblib.load(model_path)
-        self.svd_model = model_data['svd_model']
-        self.scaler = model_data['scaler']
-        self.user_features = model_data['user_features']
-        self.user_mapping = model_data['user_mapping']
-        self.item_mapping = model_data['item_mapping']
-        self.reverse_user_mapping = model_data['reverse_user_mapping']
-        self.reverse_item_mapping = model_data['reverse_item_mapping']
-        self.user_item_matrix = model_data['user_item_matrix']
+        logger.info(f"モデル読み込み: {model_dir}")
+        
+        with open(os.path.join(model_dir, 'manifest.json')) as f:
+            manifest = json.load(f)
+        
+        def load(name):
+            entry = manifest['files'].get(name)
+            if entry is None:
+                return None
+            return np.load(os.path.join(model_dir, entry['file']))
+        
+        user_ids = load('user_ids')
+        item_ids = load('item_ids')
+        self.user_mapping = {int(user): idx for idx, user in enumerate(user_ids)}
+        self.item_mapping = {int(item): idx for idx, item in enumerate(item_ids)}
+        self.reverse_user_mapping = {idx: user for user, idx in self.user_mapping.items()}
+        self.reverse_item_mapping = {idx: item for item, idx in self.item_mapping.items()}
+        
+        self.user_features = load('user_features')
+        self.user_item_csr = sparse.csr_matrix(
+            (load('matrix_data'), load('matrix_indices'), load('matrix_indptr')),
+            shape=(len(user_ids), len(item_ids))
+        )
+        self.user_item_matrix = None
+        
+        self.engine = manifest.get('engine', 'svd')
+        self.als_params = manifest.get('als')
+        self.data_through = manifest.get('data_through')
+        components = load('svd_components')
+        if components is not None:
+            self.svd_model = TruncatedSVD(n_components=components.shape[0])
+            self.svd_model.components_ = components
+            self.svd_model.n_features_in_ = components.shape[1]
+            self.scaler = StandardScaler(with_mean=manifest.get('scaler_with_mean', True))
+            self.scaler.mean_ = load('scaler_mean')
+            self.scaler.scale_ = load('scaler_scale')
+            self.scaler.var_ = self.scaler.scale_ ** 2
+            self.scaler.n_features_in_ = len(self.scaler.mean_)
+        else:
+            self.svd_model = None
+            self.scaler = None
+        self.item_factors = load('item_factors')
+        
+        self.item_popularity = load('popularity_scores')
+        if self.item_popularity is None:
+            self.item_popularity = np.asarray(self.user_item_csr.sum(axis=0)).ravel().astype(np.float32)
+        self.item_popularity_decayed = load('popularity_decayed_scores')
+        self.popularity_half_life_days = manifest.get('popularity_half_life_days', POPULARITY_HALF_LIFE_DAYS)
+        self.item_category_codes = load('item_category_codes')
+        self.item_prices = load('item_prices')
+        self.categories = manifest.get('categories', [])
+        
+        segments = manifest.get('segments') or {}
+        self.segment_keys = segments.get('keys', [])
+        self.segment_age_edges = segments.get('age_edges', SEGMENT_AGE_EDGES)
+        self.segment_min_users = segments.get('min_users', SEGMENT_MIN_USERS)
+        self.segment_items = load('segment_items')
+        self.segment_scores = load('segment_scores')
+        
+        self.precomputed_items = load('precomputed_items')
+        self.precomputed_scores = load('precomputed_scores')
+        self.precomputed_at = manifest.get('precomputed_at')
+        
+        self.algorithm = manifest.get('algorithm', 'user_user')
+        self.item_neighbors = manifest.get('item_neighbors')
+        self.n_neighbors = manifest.get('n_neighbors') or N_NEIGHBORS
+        self.price_weight = manifest.get('price_weight', PRICE_WEIGHT)
+        self.item_similarity = None
+        if self.algorithm == 'item_item':
+            self.item_similarity = sparse.csr_matrix(
+                (load('item_similarity_data'), load('item_similarity_indices'), load('item_similarity_indptr')),
+                shape=(len(item_ids), len(item_ids))
+            )
+        
+        self.ann_index = None
+        if 'ann_centroids' in manifest['files']:
+            self.ann_index = {
+                'centroids': load('ann_centroids'),
+                'list_offsets': load('ann_list_offsets'),
+                'list_members': load('ann_list_members'),
+                'n_probe': manifest.get('ann_n_probe')
+            }
+        return manifest
+
+def new_model_version():
+    """モデルバージョンID（UTC時刻 + 衝突回避のランダムな接尾辞）
+
+    同じ秒に学習したフル・インクリメンタルなどのバージョンが同じ GCS プレフィックスを
+    共有しないよう、時刻だけに頼らない。
+    """
+    return f"{datetime.now(timezone.utc).strftime('%Y%m%dT%H%M%SZ')}-{uuid.uuid4().hex[:8]}"
+
+def file_sha256(path):
+    """ファイルのSHA-256チェックサム"""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
 
 def upload_to_gcs(local_path, gcs_path):
     """GCSにファイルアップロード"""
@@ -253,60 +2213,487 @@ def upload_to_gcs(local_path, gcs_path):
     blob.upload_from_filename(local_path)
     logger.info(f"GCSアップロード完了: gs://{BUCKET_NAME}/{gcs_path}")
 
-def main():
+def download_model_artifact(local_dir):
+    """LATEST.json が指す現行モデルをGCSからダウンロード（チェックサム検証付き）
+
+    Returns:
+        manifest の dict
+    """
+    storage_client = storage.Client(project=PROJECT_ID)
+    bucket = storage_client.bucket(BUCKET_NAME)
+    pointer = json.loads(bucket.blob(f"{MODEL_ARTIFACT_PREFIX}/LATEST.json").download_as_bytes())
+    prefix = pointer['prefix']
+    
+    os.makedirs(local_dir, exist_ok=True)
+    manifest_path = os.path.join(local_dir, 'manifest.json')
+    bucket.blob(f"{prefix}/manifest.json").download_to_filename(manifest_path)
+    with open(manifest_path) as f:
+        manifest = json.load(f)
+    
+    for entry in manifest['files'].values():
+        path = os.path.join(local_dir, entry['file'])
+        bucket.blob(f"{prefix}/{entry['file']}").download_to_filename(path)
+        if file_sha256(path) != entry['sha256']:
+            raise ValueError(f"チェックサム不一致: {entry['file']}")
+    logger.info(f"GCSダウンロード完了: gs://{BUCKET_NAME}/{prefix} (version={manifest['version']})")
+    return manifest
+
+def upload_model_artifact(local_dir, manifest):
+    """モデルアーティファクトをGCSにアップロードし、LATEST.json を更新
+
+    ポインタは全ファイルのアップロード完了後に書き換えるため、
+    API が書き込み途中のバージョンを参照することはない。公開済みのバージョン
+    （manifest.json があるプレフィックス）への上書きは拒否する。
+    """
+    version_prefix = f"{MODEL_ARTIFACT_PREFIX}/{manifest['version']}"
+    storage_client = storage.Client(project=PROJECT_ID)
+    if storage_client.bucket(BUCKET_NAME).blob(f"{version_prefix}/manifest.json").exists():
+        raise ValueError(f"モデルバージョンが既に公開されています: gs://{BUCKET_NAME}/{version_prefix}")
+    for entry in manifest['files'].values():
+        upload_to_gcs(os.path.join(local_dir, entry['file']), f"{version_prefix}/{entry['file']}")
+    upload_to_gcs(os.path.join(local_dir, 'manifest.json'), f"{version_prefix}/manifest.json")
+    
+    pointer_path = os.path.join(local_dir, 'LATEST.json')
+    with open(pointer_path, 'w') as f:
+        json.dump({'version': manifest['version'], 'prefix': version_prefix}, f)
+    upload_to_gcs(pointer_path, f"{MODEL_ARTIFACT_PREFIX}/LATEST.json")
+
+def int_list(value):
+    """カンマ区切りの整数リスト"""
+    return [int(v) for v in value.split(',')]
+
+def float_list(value):
+    """カンマ区切りの実数リスト"""
+    return [float(v) for v in value.split(',')]
+
+def parse_args(argv=None):
+    """コマンドライン引数解析"""
+    parser = argparse.ArgumentParser(description="レコメンドモデル訓練")
+    parser.add_argument('--mode', choices=['full', 'incremental', 'sweep'], default='full',
+                        help="full: フル再学習 / incremental: 現行モデルに更新ユーザーを射影して差分版を公開 / "
+                             "sweep: ハイパーパラメータ探索の上で最良の設定を公開")
+    parser.add_argument('--since', type=datetime.fromisoformat, default=None,
+                        help="incremental で対象にする取引の開始時刻（ISO 8601、省略時は現行モデルのデータ取得時刻）")
+    parser.add_argument('--n-components', type=int, default=N_COMPONENTS, help="SVDの次元数")
+    parser.add_argument('--n-neighbors', type=int, default=N_NEIGHBORS,
+                        help="user_user でスコアリングに使う類似ユーザー数（API もモデルの値を使用）")
+    parser.add_argument('--price-weight', type=float, default=PRICE_WEIGHT,
+                        help="購入スコア 購入回数 × log1p(平均価格)^w の価格の重み w")
+    parser.add_argument('--sweep-components', type=int_list, default=SWEEP_COMPONENTS,
+                        help="sweep で試す次元数（カンマ区切り。ALS は因子数）")
+    parser.add_argument('--sweep-neighbors', type=int_list, default=SWEEP_NEIGHBORS,
+                        help="sweep で試す近傍数（カンマ区切り。user_user は類似ユーザー数、item_item は類似アイテム数）")
+    parser.add_argument('--sweep-price-weights', type=float_list, default=SWEEP_PRICE_WEIGHTS,
+                        help="sweep で試す価格の重み（カンマ区切り）")
+    parser.add_argument('--sweep-workers', type=int, default=None,
+                        help="sweep のプロセス数（省略時はCPU数）")
+    parser.add_argument('--sweep-max-latency-ms', type=float, default=None,
+                        help="sweep で採用する設定の p95 スコアリング時間の上限（ミリ秒）")
+    parser.add_argument('--sweep-latency-sample', type=int, default=SWEEP_LATENCY_SAMPLE,
+                        help="sweep でスコアリング時間を計測するユーザー数")
+    parser.add_argument('--extract', choices=['stream', 'dataframe'], default='stream',
+                        help="取引集計の取得方法（stream: Arrow バッチを逐次行列化 / dataframe: 一括で DataFrame 化）")
+    parser.add_argument('--parquet-source', default=None,
+                        help="BigQuery の代わりにローカル Parquet（ファイルまたはディレクトリ）から取引集計を読み込む")
+    parser.add_argument('--stream-page-size', type=int, default=STREAM_PAGE_SIZE,
+                        help="ストリーミング取得の1バッチあたりの行数")
+    parser.add_argument('--snapshot', choices=['none', 'local', 'gcs'], default='none',
+                        help="stream 取得で日別集計の Parquet スナップショットを使い、前回以降の差分のみ BigQuery から取得"
+                             "（local: --snapshot-dir のみ / gcs: GCS と同期 / none: 毎回全期間を集計）")
+    parser.add_argument('--snapshot-dir', default='transaction_snapshot',
+                        help="スナップショットのローカルディレクトリ")
+    parser.add_argument('--snapshot-overlap-days', type=int, default=SNAPSHOT_OVERLAP_DAYS,
+                        help="遅延到着する取引のため、前回の取得日より前に取り直す日数")
+    parser.add_argument('--algorithm', choices=['user_user', 'item_item'], default='user_user',
+                        help="レコメンド方式（user_user: 類似ユーザー / item_item: 類似アイテム）")
+    parser.add_argument('--item-neighbors', type=int, default=ITEM_NEIGHBORS,
+                        help="item_item で保持するアイテムごとの類似アイテム数")
+    parser.add_argument('--precompute-top-n', type=int, default=PRECOMPUTE_TOP_N,
+                        help="事前計算するユーザーごとのレコメンド件数（0で無効）")
+    parser.add_argument('--precompute-workers', type=int, default=None,
+                        help="事前計算のプロセス数（省略時はCPU数）")
+    parser.add_argument('--precompute-block-size', type=int, default=PRECOMPUTE_BLOCK_SIZE,
+                        help="事前計算で1ワーカーが処理するユーザー数")
+    parser.add_argument('--ann-lists', type=int, default=None,
+                        help="IVFインデックスのクラスタ数（省略時は sqrt(ユーザー数)）")
+    parser.add_argument('--ann-probe', type=int, default=ANN_N_PROBE,
+                        help="検索時に走査するクラスタ数の既定値（再現率とレイテンシの調整）")
+    parser.add_argument('--popularity-half-life-days', type=float, default=POPULARITY_HALF_LIFE_DAYS,
+                        help="時間減衰人気度の半減期（日）")
+    parser.add_argument('--segment-top-n', type=int, default=SEGMENT_TOP_N,
+                        help="新規ユーザー向けセグメント別ランキングの件数（0で無効）")
+    parser.add_argument('--segment-min-users', type=int, default=SEGMENT_MIN_USERS,
+                        help="セグメント別ランキングを作成する最小ユーザー数（未満は上位階層で代替）")
+    parser.add_argument('--no-ann', action='store_true',
+                        help="ANNインデックスを構築しない（API は厳密検索のみ）")
+    parser.add_argument('--engine', choices=['svd', 'als'], default='svd',
+                        help="学習エンジン（svd: スケーリング + TruncatedSVD / als: 暗黙的フィードバックALS）")
+    parser.add_argument('--als-signal', choices=['purchase_count', 'total_quantity'], default='purchase_count',
+                        help="ALSの信頼度に使う購入シグナル（c = 1 + alpha * log1p(signal)）")
+    parser.add_argument('--als-factors', type=int, default=ALS_FACTORS, help="ALSの因子数")
+    parser.add_argument('--als-iterations', type=int, default=ALS_ITERATIONS, help="ALSの反復回数")
+    parser.add_argument('--als-regularization', type=float, default=ALS_REGULARIZATION, help="ALSの正則化係数")
+    parser.add_argument('--als-alpha', type=float, default=ALS_ALPHA, help="ALSの信頼度スケール")
+    parser.add_argument('--als-threads', type=int, default=None, help="ALSのスレッド数（省略時はCPU数）")
+    parser.add_argument('--evaluate', action='store_true',
+                        help="時間分割ホールドアウトでランキング指標を計算して evaluation.json に保存")
+    parser.add_argument('--eval-holdout-days', type=int, default=EVALUATION_HOLDOUT_DAYS,
+                        help="評価でホールドアウトする直近の日数")
+    parser.add_argument('--eval-k', type=int, default=EVALUATION_K, help="評価指標の K")
+    parser.add_argument('--compare-engines', action='store_true',
+                        help="同じデータで SVD と ALS の学習時間・メモリを比較して統計に記録")
+    args = parser.parse_args(argv)
+    if args.engine == 'als' and args.algorithm == 'item_item':
+        parser.error("--engine als は --algorithm user_user とのみ併用できます")
+    return args
+
+def run_evaluation(args, als_params, model_version):
+    """オフライン評価
+
+    直近 eval_holdout_days 日より前の取引で本番と同じ設定のモデルを学習し、
+    ホールドアウト期間の購入に対する指標を evaluation.json（model_stats.json と同じ場所と
+    モデルバージョンのディレクトリ）に保存する。
+
+    Returns:
+        評価結果の dict
+    """
+    model = RecommendationModel()
+    model.popularity_half_life_days = args.popularity_half_life_days
+    model.n_neighbors = args.n_neighbors
+    model.price_weight = args.price_weight
+    train_df, holdout_df = model.load_evaluation_split(args.eval_holdout_days)
+    model.train(engine=args.engine, als_params=als_params, df=train_df, n_components=args.n_components)
+    if args.algorithm == 'item_item':
+        model.build_item_similarity(k=args.item_neighbors)
+    
+    report = model.evaluate(
+        holdout_df, k=args.eval_k,
+        block_size=args.precompute_block_size, n_workers=args.precompute_workers
+    )
+    evaluation = {
+        'model_version': model_version,
+        'engine': model.engine,
+        'algorithm': model.algorithm,
+        'holdout_days': args.eval_holdout_days,
+        'n_train_users': len(model.user_mapping),
+        'n_train_items': len(model.item_mapping),
+        **report,
+        'evaluated_at': datetime.now().isoformat()
+    }
+    
+    evaluation_path = "evaluation.json"
+    with open(evaluation_path, 'w') as f:
+        json.dump(evaluation, f, indent=2)
+    upload_to_gcs(evaluation_path, f"{MODEL_DIR}/evaluation.json")
+    upload_to_gcs(evaluation_path, f"{MODEL_ARTIFACT_PREFIX}/{model_version}/evaluation.json")
+    return evaluation
+
+def run_sweep(args):
+    """ハイパーパラメータ探索
+
+    評価用の時間分割データで学習行列を一度だけ作成してプロセスプールのワーカーと共有し、
+    候補設定（次元数 × 近傍数 × 価格の重み）を並列に学習・評価する。
+    レイテンシ予算内で NDCG@K が最も高い設定で全期間のモデルを学習して公開し、
+    全候補の結果を sweep.json に保存する。
+
+    Returns:
+        公開したモデルの manifest
+    """
+    neighbors = args.sweep_neighbors if args.engine != 'als' else [args.n_neighbors]
+    components = args.sweep_components
+    if args.algorithm == 'item_item':
+        # 次元数はアイテムベースのスコアに影響しないため探索しない（公開モデルは --n-components）
+        components = [args.n_components]
+    configs = [
+        {'n_components': n_components, 'n_neighbors': n_neighbors, 'price_weight': price_weight}
+        for n_components in components
+        for n_neighbors in neighbors
+        for price_weight in args.sweep_price_weights
+    ]
+    settings = {
+        'engine': args.engine,
+        'algorithm': args.algorithm,
+        'als_params': als_params_from_args(args),
+        'k': args.eval_k,
+        'block_size': args.precompute_block_size,
+        'latency_sample': args.sweep_latency_sample
+    }
+    n_workers = min(len(configs), args.sweep_workers or os.cpu_count() or 1)
+    settings['blas_threads'] = max(1, (os.cpu_count() or 1) // n_workers)
+    logger.info(f"ハイパーパラメータ探索開始: 候補 {len(configs)}件, workers={n_workers}")
+    
+    model = RecommendationModel()
+    train_df, holdout_df = model.load_evaluation_split(args.eval_holdout_days)
+    
+    with tempfile.TemporaryDirectory(prefix='sweep_') as shared_dir:
+        write_sweep_arrays(shared_dir, train_df, holdout_df, args.sweep_price_weights)
+        initargs = (shared_dir, args.sweep_price_weights, settings)
+        with log_stage('sweep'):
+            if n_workers <= 1:
+                _init_sweep_worker(*initargs)
+                results = [_fit_sweep_config(config) for config in configs]
+            else:
+                with ProcessPoolExecutor(
+                    max_workers=n_workers,
+                    initializer=_init_sweep_worker,
+                    initargs=initargs
+                ) as executor:
+                    results = list(executor.map(_fit_sweep_config, configs))
+    
+    ranked = rank_sweep_results(results, args.eval_k, args.sweep_max_latency_ms)
+    for result in ranked:
+        logger.info(
+            f"探索結果 #{result['rank']}: components={result['n_components']}, "
+            f"neighbors={result['n_neighbors']}, price_weight={result['price_weight']}, "
+            f"ndcg@{args.eval_k}={result.get(f'ndcg_at_{args.eval_k}', 0.0):.4f}, "
+            f"p95={result['latency_p95_ms']:.2f}ms"
+        )
+    
+    # 採用した設定で全期間のモデルを学習して公開（取引は再取得しない）
+    winner = ranked[0]
+    args.n_components = winner['n_components']
+    args.als_factors = winner['n_components']
+    args.price_weight = winner['price_weight']
+    if args.algorithm == 'item_item':
+        args.item_neighbors = winner['n_neighbors']
+    else:
+        args.n_neighbors = winner['n_neighbors']
+    manifest = run_training(
+        args, df=merge_evaluation_split(train_df, holdout_df), data_through=model.data_through
+    )
+    
+    sweep = {
+        'model_version': manifest['version'],
+        'engine': args.engine,
+        'algorithm': args.algorithm,
+        'k': args.eval_k,
+        'holdout_days': args.eval_holdout_days,
+        'max_latency_ms': args.sweep_max_latency_ms,
+        'latency_clock': 'process_cpu',
+        'winner': winner,
+        'results': ranked,
+        'swept_at': datetime.now().isoformat()
+    }
+    sweep_path = "sweep.json"
+    with open(sweep_path, 'w') as f:
+        json.dump(sweep, f, indent=2)
+    upload_to_gcs(sweep_path, f"{MODEL_DIR}/sweep.json")
+    upload_to_gcs(sweep_path, f"{MODEL_ARTIFACT_PREFIX}/{manifest['version']}/sweep.json")
+    return manifest
+
+def run_incremental(args):
+    """インクリメンタル更新
+
+    現行モデルをダウンロードし、前回のデータ取得以降に取引があったユーザーの行を
+    再学習なしで反映した差分バージョン（manifest の base_version に基準版）を公開する。
+    """
+    base_dir = "base_model"
+    with log_stage('download'):
+        base_manifest = download_model_artifact(base_dir)
+    
+    model = RecommendationModel()
+    model.load_model(base_dir)
+    
+    since = args.since or datetime.fromisoformat(base_manifest.get('data_through') or base_manifest['trained_at'])
+    if since.tzinfo is None:
+        since = since.replace(tzinfo=timezone.utc)
+    df = model.load_updated_interactions(since)
+    if len(df) == 0:
+        logger.info("更新対象の取引がないため差分バージョンは公開しません")
+        return None
+    
+    with log_stage('fold_in', model.stage_timings):
+        summary = model.fold_in(
+            df, block_size=args.precompute_block_size, n_workers=args.precompute_workers
+        )
+    model.base_version = base_manifest['version']
+    
+    local_model_dir = "recommend_model"
+    with log_stage('save', model.stage_timings):
+        manifest = model.save_model(local_model_dir)
+    if manifest['version'] == model.base_version:
+        raise ValueError(f"差分バージョンが基準版と同じです: {manifest['version']}")
+    with log_stage('upload', model.stage_timings):
+        upload_model_artifact(local_model_dir, manifest)
+    
+    stats = {
+        'mode': 'incremental',
+        'model_version': manifest['version'],
+        'base_version': model.base_version,
+        'since': since.isoformat(),
+        'n_users': len(model.user_mapping),
+        'n_items': len(model.item_mapping),
+        'engine': model.engine,
+        'algorithm': model.algorithm,
+        **summary,
+        'stage_seconds': model.stage_timings,
+        'peak_memory_mb': round(peak_memory_mb(), 1),
+        'trained_at': datetime.now().isoformat()
+    }
+    stats_path = "model_stats.json"
+    with open(stats_path, 'w') as f:
+        json.dump(stats, f, indent=2)
+    upload_to_gcs(stats_path, f"{MODEL_DIR}/model_stats.json")
+    
+    logger.info(f"インクリメンタル更新完了: {base_manifest['version']} → {manifest['version']}")
+    return manifest
+
+def als_params_from_args(args):
+    """コマンドライン引数から fit_als の設定を作成"""
+    return {
+        'n_factors': args.als_factors,
+        'regularization': args.als_regularization,
+        'alpha': args.als_alpha,
+        'iterations': args.als_iterations,
+        'n_threads': args.als_threads,
+        'signal': args.als_signal
+    }
+
+def run_training(args, df=None, data_through=None):
+    """フル学習からアップロード・評価までの一連の処理
+
+    Args:
+        df: 学習に使う取引集計（省略時は BigQuery から取得）
+        data_through: df の取得時刻（ISO 8601、manifest に記録してインクリメンタル更新の起点にする）
+
+    Returns:
+        公開したモデルの manifest
+    """
+    logger.info("レコメンドモデル訓練開始")
+    
+    # モデル初期化
+    model = RecommendationModel()
+    model.popularity_half_life_days = args.popularity_half_life_days
+    model.n_neighbors = args.n_neighbors
+    model.price_weight = args.price_weight
+    model.extract = args.extract
+    model.parquet_source = args.parquet_source
+    model.stream_page_size = args.stream_page_size
+    model.data_through = data_through
+    if args.snapshot != 'none':
+        model.snapshot = TransactionSnapshot(
+            args.snapshot_dir,
+            gcs_prefix=SNAPSHOT_PREFIX if args.snapshot == 'gcs' else None,
+            overlap_days=args.snapshot_overlap_days
+        )
+    
+    # 訓練実行
+    als_params = als_params_from_args(args)
+    model.train(engine=args.engine, als_params=als_params, df=df, n_components=args.n_components)
+    
+    # 学習エンジンの比較（同じ購入行列で SVD / ALS を学習し直す）
+    engine_comparison = None
+    if args.compare_engines:
+        engine_comparison = model.compare_engines(als_params)
+    
+    # カテゴリ別人気ランキング用のアイテムカテゴリ
+    try:
+        model.load_item_categories()
+    except Exception as e:
+        logger.warning(f"アイテムカテゴリ取得エラー（カテゴリ別人気度なし）: {str(e)}")
+    
+    # 新規ユーザー向けのデモグラフィックセグメント別ランキング
+    if args.segment_top_n > 0:
+        try:
+            model.build_segment_rankings(top_n=args.segment_top_n, min_users=args.segment_min_users)
+        except Exception as e:
+            logger.warning(f"ユーザー属性取得エラー（セグメント別人気度なし）: {str(e)}")
+    
+    # アイテムベースの場合は類似アイテム行列を構築
+    if args.algorithm == 'item_item':
+        with log_stage('item_similarity', model.stage_timings):
+            model.build_item_similarity(k=args.item_neighbors)
+    
+    # 全ユーザーのレコメンド事前計算
+    if args.precompute_top_n > 0:
+        with log_stage('precompute', model.stage_timings):
+            model.precompute_recommendations(
+                top_n=args.precompute_top_n,
+                block_size=args.precompute_block_size,
+                n_workers=args.precompute_workers
+            )
+    
+    # 類似ユーザー検索用ANNインデックス（SVDのユーザーベースのみ）
+    if not args.no_ann and model.algorithm == 'user_user':
+        with log_stage('ann_index', model.stage_timings):
+            model.build_ann_index(n_lists=args.ann_lists, n_probe=args.ann_probe)
+    
+    # ローカル保存
+    local_model_dir = "recommend_model"
+    with log_stage('save', model.stage_timings):
+        manifest = model.save_model(local_model_dir)
+    
+    # GCSにアップロード
+    with log_stage('upload', model.stage_timings):
+        upload_model_artifact(local_model_dir, manifest)
+    
+    # テストレコメンド
+    test_user_id = list(model.user_mapping.keys())[0] if model.user_mapping else 1001
+    recommendations = model.get_recommendations(test_user_id)
+    logger.info(f"テストレコメンド (user_id: {test_user_id}): {recommendations}")
+    
+    # モデル統計情報保存
+    stats = {
+        'mode': 'full',
+        'n_users': len(model.user_mapping),
+        'n_items': len(model.item_mapping),
+        'matrix_shape': list(model.user_item_csr.shape),
+        'n_components': int(model.user_features.shape[1]),
+        'engine': model.engine,
+        'algorithm': model.algorithm,
+        'item_neighbors': model.item_neighbors,
+        'n_neighbors': model.n_neighbors,
+        'price_weight': model.price_weight,
+        'n_segments': len(model.segment_keys),
+        'model_version': manifest['version'],
+        'precomputed_top_n': args.precompute_top_n,
+        'ann_n_lists': len(model.ann_index['centroids']) if model.ann_index else 0,
+        'ann_n_probe': args.ann_probe,
+        f'ann_recall_at_{ANN_RECALL_K}': model.ann_recall,
+        'stage_seconds': model.stage_timings,
+        'peak_memory_mb': round(peak_memory_mb(), 1),
+        'engine_comparison': engine_comparison,
+        'snapshot': model.snapshot_summary,
+        'trained_at': datetime.now().isoformat()
+    }
+    
+    stats_path = "model_stats.json"
+    with open(stats_path, 'w') as f:
+        json.dump(stats, f, indent=2)
+    
+    upload_to_gcs(stats_path, f"{MODEL_DIR}/model_stats.json")
+    
+    # オフライン評価（時間分割ホールドアウト）
+    if args.evaluate:
+        with log_stage('evaluate'):
+            run_evaluation(args, als_params, manifest['version'])
+    
+    logger.info("モデル訓練完了")
+    return manifest
+
+def main(argv=None):
     """メイン訓練処理"""
+    args = parse_args(argv)
+    if args.mode == 'incremental':
+        try:
+            run_incremental(args)
+        except Exception as e:
+            logger.error(f"インクリメンタル更新エラー: {str(e)}")
+            raise
+        return
+    if args.mode == 'sweep':
+        try:
+            run_sweep(args)
+        except Exception as e:
+            logger.error(f"ハイパーパラメータ探索エラー: {str(e)}")
+            raise
+        return
+    
     try:
-        logger.info("レコメンドモデル訓練開始")
-        
-        # モデル初期化
-        model = RecommendationModel()
-        
-        # 訓練実行
-        model.train()
-        
-        # ローカル保存
-        local_model_path = "recommend_model.pkl"
-        model.save_model(local_model_path)
-        
-        # GCSにアップロード
-        gcs_model_path = f"{MODEL_DIR}/recommend_model.pkl"
-        upload_to_gcs(local_model_path, gcs_model_path)
-        
-        # テストレコメンド
-        test_user_id = list(model.user_mapping.keys())[0] if model.user_mapping else 1001
-        recommendations = model.get_recommendations(test_user_id)
-        logger.info(f"テストレコメンド (user_id: {test_user_id}): {recommendations}")
-        
-        # モデル統計情報保存
-        stats = {
-            'n_users': len(model.user_mapping),
-            'n_items': len(model.item_mapping),
-            'matrix_shape': list(model.user_item_matrix.shape),
-            'n_components': model.svd_model.n_components,
-            'trained_at': datetime.now().isoformat()
-        }
-        
-        stats_path = "model_stats.json"
-        with open(stats_path, 'w') as f:
-            json.dump(stats, f, indent=2)
-        
-        upload_to_gcs(stats_path, f"{MODEL_DIR}/model_stats.json")
-        
-        logger.info("モデル訓練完了")
-        
+        run_training(args)
     except Exception as e:
         logger.error(f"訓練エラー: {str(e)}")
         raise
 
 if __name__ == "__main__":
     main()
-
-# vertex-ai/training/requirements.txt
-
-google-cloud-bigquery==3.13.0
-google-cloud-storage==2.10.0
-google-cloud-aiplatform==1.38.1
-pandas==2.1.4
-numpy==1.24.4
-scikit-learn==1.3.2
-joblib==1.3.2